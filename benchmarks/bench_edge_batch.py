@@ -0,0 +1,58 @@
+"""
+Compare bulk variant to gene results held as lists of (SimpleEdge, SimpleNode) with the columnar EdgeBatch:
+the time to find them, the memory they hold on to, and the time to encode them for the cache.
+
+Uses the same synthetic genes database as bench_variant_to_gene.
+
+    python -m benchmarks.bench_edge_batch --variants 200000
+"""
+import argparse
+import gc
+import random
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.bench_variant_to_gene import make_genes_db, make_variants
+from robokop_genetics.genetics_cache import encode_service_results
+from robokop_genetics.services.ensembl import EnsemblService
+
+
+def measure(ensembl_service: EnsemblService, variants: list, as_edge_batch: bool):
+    gc.collect()
+    start_time = time.perf_counter()
+    results = ensembl_service.batch_sequence_variant_to_gene(variants, as_edge_batch=as_edge_batch)
+    find_seconds = time.perf_counter() - start_time
+    del results
+
+    gc.collect()
+    tracemalloc.start()
+    results = ensembl_service.batch_sequence_variant_to_gene(variants, as_edge_batch=as_edge_batch)
+    results_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start_time = time.perf_counter()
+    encoded_size = sum(len(encode_service_results(variant_results)) for variant_results in results.values())
+    encode_seconds = time.perf_counter() - start_time
+    num_edges = sum(len(variant_results) for variant_results in results.values())
+    return find_seconds, results_memory, encode_seconds, encoded_size, num_edges
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variants', type=int, default=200_000)
+    args = parser.parse_args()
+
+    randomizer = random.Random(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ensembl_service = EnsemblService(temp_dir=temp_dir)
+        make_genes_db(ensembl_service, randomizer)
+        variants = make_variants(args.variants, randomizer)
+        ensembl_service.get_gene_index()
+
+        for label, as_edge_batch in (('lists', False), ('edge batch', True)):
+            find_seconds, results_memory, encode_seconds, encoded_size, num_edges = \
+                measure(ensembl_service, variants, as_edge_batch)
+            print(f'{label:10}  {num_edges} edges found in {find_seconds:.1f}s, '
+                  f'{results_memory / 1_000_000:,.0f}MB ({results_memory / num_edges:.0f} bytes/edge), '
+                  f'encoded for the cache in {encode_seconds:.1f}s ({encoded_size / 1_000_000:,.0f}MB)')
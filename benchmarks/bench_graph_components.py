@@ -0,0 +1,112 @@
+"""
+Compare the slotted SimpleNode and SimpleEdge dataclasses with the plain dataclasses they replaced: construction time,
+memory, and get_synonyms_by_prefix on variant nodes with normalized synonyms and gene nodes with only their id, first
+once per node and then 12 more times.
+
+    python -m benchmarks.bench_graph_components --nodes 1000000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+
+from robokop_genetics.simple_graph_components import SimpleNode, SimpleEdge
+from robokop_genetics.util import Text
+
+
+@dataclass
+class DataclassNode:
+    id: str
+    type: str
+    name: str
+    properties: dict = field(default_factory=dict)
+    synonyms: set = field(default_factory=set)
+
+    def __post_init__(self):
+        if not self.synonyms:
+            self.synonyms = {self.id}
+
+    def get_synonyms_by_prefix(self, prefix: str):
+        return set(filter(lambda x: Text.get_curie(x) == prefix, self.synonyms))
+
+
+@dataclass
+class DataclassEdge:
+    source_id: str
+    target_id: str
+    provided_by: str
+    input_id: str
+    predicate_id: str
+    predicate_label: str
+    ctime: int
+    properties: dict = field(default_factory=dict)
+
+
+def make_variant_synonyms(i: int):
+    return [f'CAID:CA{i}',
+            f'DBSNP:rs{i}',
+            f'CLINVARVARIANT:{i}',
+            f'HGVS:NC_000001.11:g.{i}A>G',
+            f'HGVS:NC_000001.10:g.{i}A>G',
+            f'ROBO_VARIANT:HG38|1|{i}|{i + 1}|A|G',
+            f'ROBO_VARIANT:HG19|1|{i}|{i + 1}|A|G']
+
+
+def create_graph(node_class, edge_class, num_nodes: int, synonyms: list):
+    variant_nodes = [node_class(id=f'CAID:CA{i}', type='biolink:SequenceVariant', name='', synonyms=set(synonyms[i]))
+                     for i in range(num_nodes)]
+    gene_nodes = [node_class(id=f'ENSEMBL:ENSG{i:011d}', type='biolink:Gene', name=f'GENE{i}')
+                  for i in range(num_nodes)]
+    edges = [edge_class(source_id=f'CAID:CA{i}', target_id=f'ENSEMBL:ENSG{i:011d}',
+                        provided_by='ensembl.sequence_variant_to_gene', input_id='',
+                        predicate_id='GAMMA:0000102', predicate_label='is_nearby_variant_of', ctime=1,
+                        properties={'distance': i})
+             for i in range(num_nodes)]
+    return variant_nodes, gene_nodes, edges
+
+
+def measure(node_class, edge_class, num_nodes: int):
+    # the strings are made up front so only the graph objects are measured
+    synonyms = [make_variant_synonyms(i) for i in range(num_nodes)]
+    gc.collect()
+    tracemalloc.start()
+    variant_nodes, gene_nodes, edges = create_graph(node_class, edge_class, num_nodes, synonyms)
+    graph_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del variant_nodes, gene_nodes, edges
+    gc.collect()
+
+    start_time = time.perf_counter()
+    variant_nodes, gene_nodes, edges = create_graph(node_class, edge_class, num_nodes, synonyms)
+    construction_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for variant_node in variant_nodes:
+        variant_node.get_synonyms_by_prefix('ROBO_VARIANT')
+    for gene_node in gene_nodes:
+        gene_node.get_synonyms_by_prefix('ROBO_VARIANT')
+    lookup_seconds = time.perf_counter() - start_time
+
+    # nodes looked up again, for each prefix the normalizer uses
+    start_time = time.perf_counter()
+    for prefix in ('CAID', 'HGVS', 'ROBO_VARIANT', 'DBSNP') * 3:
+        for variant_node in variant_nodes:
+            variant_node.get_synonyms_by_prefix(prefix)
+    repeated_lookup_seconds = time.perf_counter() - start_time
+    return construction_seconds, graph_memory, lookup_seconds, repeated_lookup_seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=1_000_000,
+                        help='number of variant nodes, gene nodes and edges each')
+    args = parser.parse_args()
+
+    for label, node_class, edge_class in (('dataclass', DataclassNode, DataclassEdge),
+                                          ('slotted', SimpleNode, SimpleEdge)):
+        construction_seconds, graph_memory, lookup_seconds, repeated_lookup_seconds = \
+            measure(node_class, edge_class, args.nodes)
+        print(f'{label:10} construction {construction_seconds:6.2f}s, '
+              f'memory {graph_memory / 1_000_000:7.1f}MB ({graph_memory / (3 * args.nodes):.0f} bytes/object), '
+              f'get_synonyms_by_prefix {lookup_seconds:6.2f}s, 12 more {repeated_lookup_seconds:6.2f}s')
@@ -0,0 +1,106 @@
+"""
+Compare HGNCService startup time when downloading the HGNC complete set, when loading the persisted symbol index,
+and when revalidating an old index with a conditional request, plus the peak memory used while downloading.
+
+A synthetic complete set shaped like the real one (about 44,000 genes with all of their fields) is served from a
+local http server, so no HGNC download is needed.
+
+    python -m benchmarks.bench_hgnc_startup
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+from robokop_genetics.services.hgnc import HGNCService
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def make_hgnc_complete_set(num_genes: int, file_path: str, randomizer: random.Random):
+    docs = []
+    for i in range(num_genes):
+        symbol = f'GENE{i}'
+        docs.append({'hgnc_id': f'HGNC:{i + 1}',
+                     'symbol': symbol,
+                     'name': f'synthetic gene {i} with a reasonably long descriptive name',
+                     'status': 'Approved',
+                     'locus_group': 'protein-coding gene',
+                     'locus_type': 'gene with protein product',
+                     'location': f'{randomizer.randint(1, 22)}q{randomizer.randint(11, 35)}.{randomizer.randint(1, 3)}',
+                     'location_sortable': f'{randomizer.randint(1, 22):02d}q{randomizer.randint(11, 35)}',
+                     'alias_symbol': [f'ALIAS{i}_{j}' for j in range(randomizer.randint(0, 4))],
+                     'prev_symbol': [f'PREV{i}_{j}' for j in range(randomizer.randint(0, 2))],
+                     'gene_group': ['Synthetic gene group'],
+                     'gene_group_id': [randomizer.randint(1, 2000)],
+                     'entrez_id': str(100000 + i),
+                     'ensembl_gene_id': f'ENSG{i:011d}',
+                     'vega_id': f'OTTHUMG{i:011d}',
+                     'ucsc_id': f'uc{i:06d}abc.1',
+                     'refseq_accession': [f'NM_{i:06d}'],
+                     'ccds_id': [f'CCDS{i}.1', f'CCDS{i}.2'],
+                     'uniprot_ids': [f'P{i:05d}'],
+                     'pubmed_id': [randomizer.randint(1, 40_000_000) for _ in range(randomizer.randint(1, 6))],
+                     'mgd_id': [f'MGI:{randomizer.randint(1, 9_999_999)}'],
+                     'rgd_id': [f'RGD:{randomizer.randint(1, 9_999_999)}'],
+                     'omim_id': [str(randomizer.randint(100000, 699999))],
+                     'orphanet': randomizer.randint(1, 600000),
+                     'agr': f'HGNC:{i + 1}',
+                     'uuid': f'{randomizer.getrandbits(128):032x}',
+                     'date_approved_reserved': '1986-01-01',
+                     'date_modified': '2023-01-20',
+                     '_version_': randomizer.getrandbits(60)})
+    with open(file_path, 'w') as hgnc_file:
+        json.dump({'responseHeader': {'status': 0}, 'response': {'numFound': num_genes, 'start': 0, 'docs': docs}},
+                  hgnc_file)
+
+
+def time_startup(hgnc_url: str, temp_dir: str, **hgnc_parameters):
+    start_time = time.perf_counter()
+    hgnc_service = HGNCService(temp_dir=temp_dir, hgnc_url=hgnc_url, **hgnc_parameters)
+    hgnc_service.init_symbol_lookup()
+    assert hgnc_service.hgnc_symbol_index
+    return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--genes', type=int, default=44_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        make_hgnc_complete_set(args.genes, os.path.join(temp_dir, 'hgnc_complete_set.json'), random.Random(1))
+        server = HTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=temp_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        hgnc_url = f'http://127.0.0.1:{server.server_address[1]}/hgnc_complete_set.json'
+        index_dir = os.path.join(temp_dir, 'index')
+        os.makedirs(index_dir)
+
+        # tracemalloc slows everything down, so peak memory is measured separately from the timings
+        tracemalloc.start()
+        time_startup(hgnc_url, index_dir, symbol_index_max_age=0, symbol_index_path=os.path.join(temp_dir, 'peak'))
+        download_peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        download_seconds = time_startup(hgnc_url, index_dir)
+        index_seconds = time_startup(hgnc_url, index_dir)
+        revalidate_seconds = time_startup(hgnc_url, index_dir, symbol_index_max_age=0)
+        offline_seconds = time_startup(hgnc_url, index_dir, offline=True)
+        index_size = os.path.getsize(os.path.join(index_dir, 'hgnc_symbols.index'))
+        download_size = os.path.getsize(os.path.join(temp_dir, 'hgnc_complete_set.json'))
+        server.shutdown()
+
+    print(f'download:   {download_seconds * 1000:,.0f}ms ({download_size / 1_000_000:.1f}MB complete set, '
+          f'{download_peak_memory / 1_000_000:.0f}MB peak memory)')
+    print(f'index:      {index_seconds * 1000:,.0f}ms ({index_size / 1_000_000:.1f}MB symbol index)')
+    print(f'revalidate: {revalidate_seconds * 1000:,.0f}ms (304 not modified)')
+    print(f'offline:    {offline_seconds * 1000:,.0f}ms')
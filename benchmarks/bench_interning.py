@@ -0,0 +1,104 @@
+"""
+Measure the memory saved by sharing gene nodes and repeated strings between variant to gene results, for results
+found by EnsemblService and for results decoded from cached payloads.
+
+Each measurement runs in a fresh process and reports how much its resident memory grew while holding all of the
+results (Linux only). The default 1M variant workload keeps the nearest 3 genes to each variant so the unshared
+results fit in memory on a small machine, use --nearest-k 0 for every gene in the flanking region.
+
+    python -m benchmarks.bench_interning --variants 1000000
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_variant_to_gene import make_genes_db, make_variants
+from robokop_genetics.genetics_cache import decode_service_result, encode_service_results
+from robokop_genetics.services.ensembl import EnsemblService
+from robokop_genetics.simple_graph_components import GraphInterner
+
+BATCH_SIZE = 10_000
+
+
+def get_resident_memory():
+    with open('/proc/self/statm') as statm_file:
+        return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure_ensembl(temp_dir: str, num_variants: int, nearest_k: int, share_gene_nodes: bool):
+    ensembl_service = EnsemblService(temp_dir=temp_dir, share_gene_nodes=share_gene_nodes)
+    ensembl_service.get_gene_index()
+    variants = make_variants(num_variants, random.Random(2))
+    gc.collect()
+    memory_before = get_resident_memory()
+    start_time = time.perf_counter()
+    all_results = {}
+    for i in range(0, len(variants), BATCH_SIZE):
+        all_results.update(ensembl_service.batch_sequence_variant_to_gene(variants[i:i + BATCH_SIZE],
+                                                                          nearest_k=nearest_k))
+    seconds = time.perf_counter() - start_time
+    gc.collect()
+    num_edges = sum(len(variant_results) for variant_results in all_results.values())
+    return seconds, get_resident_memory() - memory_before, num_edges
+
+
+def measure_cache_decode(temp_dir: str, num_variants: int, nearest_k: int, share_gene_nodes: bool):
+    ensembl_service = EnsemblService(temp_dir=temp_dir)
+    variants = make_variants(num_variants, random.Random(2))
+    payloads = []
+    for i in range(0, len(variants), BATCH_SIZE):
+        edge_batch = ensembl_service.batch_sequence_variant_to_gene(variants[i:i + BATCH_SIZE], nearest_k=nearest_k,
+                                                                    as_edge_batch=True)
+        payloads.extend(encode_service_results(variant_results).encode('utf-8')
+                        for variant_results in edge_batch.values())
+    del variants, edge_batch
+    interner = GraphInterner() if share_gene_nodes else None
+    gc.collect()
+    memory_before = get_resident_memory()
+    start_time = time.perf_counter()
+    all_results = [[decode_service_result(result, interner) for result in json.loads(payload)]
+                   for payload in payloads]
+    seconds = time.perf_counter() - start_time
+    gc.collect()
+    num_edges = sum(len(variant_results) for variant_results in all_results)
+    return seconds, get_resident_memory() - memory_before, num_edges
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variants', type=int, default=1_000_000)
+    parser.add_argument('--decode-variants', type=int, default=None,
+                        help='number of variants for the cache decoding workload, defaults to --variants')
+    parser.add_argument('--nearest-k', type=int, default=3)
+    parser.add_argument('--measure', choices=['ensembl', 'cache'], default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--temp-dir', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--share-gene-nodes', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    nearest_k = args.nearest_k if args.nearest_k else None
+
+    if args.measure:
+        measure = measure_ensembl if args.measure == 'ensembl' else measure_cache_decode
+        print(json.dumps(measure(args.temp_dir, args.variants, nearest_k, args.share_gene_nodes)))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        make_genes_db(EnsemblService(temp_dir=temp_dir), random.Random(1))
+        EnsemblService(temp_dir=temp_dir).get_gene_index()
+        for workload, num_variants in (('ensembl', args.variants), ('cache', args.decode_variants or args.variants)):
+            for share_gene_nodes in (False, True):
+                command = [sys.executable, '-m', 'benchmarks.bench_interning', '--measure', workload,
+                           '--temp-dir', temp_dir, '--variants', str(num_variants),
+                           '--nearest-k', str(args.nearest_k)]
+                if share_gene_nodes:
+                    command.append('--share-gene-nodes')
+                output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+                seconds, memory, num_edges = json.loads(output.strip().splitlines()[-1])
+                label = f'{workload} {"shared" if share_gene_nodes else "unshared"}'
+                print(f'{label:16} {num_variants} variants, {num_edges} edges in {seconds:.1f}s, '
+                      f'{memory / 1_000_000:,.0f}MB ({memory / num_edges:.0f} bytes/edge)')
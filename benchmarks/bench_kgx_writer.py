@@ -0,0 +1,88 @@
+"""
+Compare writing variant to gene results as KGX JSONL by collecting everything and serializing it at the end, against
+streaming each batch to a KGXWriter as it's produced, plain and gzip compressed, with the peak memory used.
+
+    python -m benchmarks.bench_kgx_writer
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from robokop_genetics import node_types
+from robokop_genetics.edge_batch import EdgeBatch
+from robokop_genetics.kgx_writer import KGXWriter, VARIANT_TO_GENE_PREDICATE
+
+BATCH_SIZE = 10_000
+
+
+def iter_edge_batches(num_variants: int, num_genes: int, edges_per_variant: int, randomizer: random.Random):
+    for batch_start in range(0, num_variants, BATCH_SIZE):
+        edge_batch = EdgeBatch(provided_by='ensembl.sequence_variant_to_gene', target_type=node_types.GENE)
+        for i in range(batch_start, min(batch_start + BATCH_SIZE, num_variants)):
+            edge_batch.add_source(f'CAID:CA{i}', f'ROBO_VARIANT:HG38|1|{i}|{i + 1}|A|G')
+            for _ in range(edges_per_variant):
+                gene = randomizer.randrange(num_genes)
+                edge_batch.add_edge(f'ENSEMBL:ENSG{gene:011d}', f'GENE{gene}', 'SNPEFF:upstream_gene_variant',
+                                    'upstream_gene_variant', randomizer.randrange(500_000))
+        yield edge_batch
+
+
+def write_at_end(edge_batches, nodes_path: str, edges_path: str):
+    # what consumers did before, every result is kept until the end of the run
+    all_results = {}
+    for edge_batch in edge_batches:
+        all_results.update((variant_id, list(variant_results)) for variant_id, variant_results in edge_batch.items())
+    gene_nodes = {}
+    with open(edges_path, 'w') as edges_file:
+        for variant_results in all_results.values():
+            for edge, node in variant_results:
+                gene_nodes[node.id] = node
+                edges_file.write(json.dumps({'subject': edge.source_id,
+                                             'predicate': VARIANT_TO_GENE_PREDICATE,
+                                             'object': edge.target_id,
+                                             'primary_knowledge_source': 'infores:ensembl',
+                                             'snpeff_effect': edge.predicate_label,
+                                             **edge.properties}) + '\n')
+    with open(nodes_path, 'w') as nodes_file:
+        for node in gene_nodes.values():
+            nodes_file.write(json.dumps({'id': node.id, 'name': node.name, 'category': [node.type]}) + '\n')
+
+
+def write_streaming(edge_batches, nodes_path: str, edges_path: str):
+    with KGXWriter(nodes_path, edges_path) as kgx_writer:
+        for edge_batch in edge_batches:
+            kgx_writer.write_variant_to_gene_results(edge_batch)
+
+
+def measure(write_function, args, nodes_path: str, edges_path: str):
+    edge_batches = iter_edge_batches(args.variants, args.genes, args.edges, random.Random(1))
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    write_function(edge_batches, nodes_path, edges_path)
+    seconds = time.perf_counter() - start_time
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak_memory, os.path.getsize(edges_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variants', type=int, default=200_000)
+    parser.add_argument('--genes', type=int, default=60_000)
+    parser.add_argument('--edges', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for label, write_function, extension in (('collect then write', write_at_end, 'jsonl'),
+                                                 ('streaming', write_streaming, 'jsonl'),
+                                                 ('streaming gzip', write_streaming, 'jsonl.gz')):
+            seconds, peak_memory, edges_size = measure(write_function, args,
+                                                       os.path.join(temp_dir, f'nodes.{extension}'),
+                                                       os.path.join(temp_dir, f'edges.{extension}'))
+            print(f'{label:>18}: {seconds:6.2f}s, {peak_memory / 1_000_000:7.1f}MB peak memory, '
+                  f'{edges_size / 1_000_000:6.1f}MB edges file ({args.variants * args.edges:,} edges, '
+                  f'tracemalloc on)')
@@ -0,0 +1,59 @@
+"""
+Measure how much the GeneticsCache membership filter saves on lookups that mostly miss.
+
+Requires a redis instance selected with the ROBO_GENETICS_CACHE environment variables. Keys are written with a
+benchmark prefix and deleted afterwards.
+
+    python -m benchmarks.bench_membership_filter --cached 100000 --lookups 500000 --hit-rate 0.1
+"""
+import argparse
+import time
+
+from robokop_genetics.genetics_cache import GeneticsCache, MEMBERSHIP_FILTER_LOCAL
+
+BENCHMARK_PREFIX = 'robo-benchmark-membership-'
+
+
+def time_lookups(cache: GeneticsCache, lookup_ids: list, batch_size: int):
+    start_time = time.perf_counter()
+    num_found = 0
+    for i in range(0, len(lookup_ids), batch_size):
+        num_found += len(cache.get_batch_normalization(lookup_ids[i:i + batch_size]))
+    return time.perf_counter() - start_time, num_found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cached', type=int, default=100_000, help='number of normalizations in the cache')
+    parser.add_argument('--lookups', type=int, default=500_000, help='number of ids to look up')
+    parser.add_argument('--hit-rate', type=float, default=0.1, help='fraction of lookups that are cached')
+    parser.add_argument('--batch-size', type=int, default=50_000)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    plain_cache = GeneticsCache(prefix=BENCHMARK_PREFIX)
+    plain_cache.delete_all_keys_with_prefix(BENCHMARK_PREFIX)
+    cached_ids = [f'CAID:CA{i}' for i in range(args.cached)]
+    for i in range(0, len(cached_ids), args.batch_size):
+        plain_cache.set_batch_normalization({node_id: [{'id': node_id}] for node_id in cached_ids[i:i + args.batch_size]})
+
+    num_hits = int(args.lookups * args.hit_rate)
+    lookup_ids = cached_ids[:num_hits] + [f'HGVS:NC_000001.11:g.{i}A>G' for i in range(args.lookups - num_hits)]
+
+    plain_seconds, plain_found = time_lookups(plain_cache, lookup_ids, args.batch_size)
+
+    build_start = time.perf_counter()
+    filtered_cache = GeneticsCache(prefix=BENCHMARK_PREFIX,
+                                   membership_filter=MEMBERSHIP_FILTER_LOCAL,
+                                   membership_filter_capacity=max(args.cached, 1000),
+                                   membership_filter_error_rate=args.error_rate)
+    build_seconds = time.perf_counter() - build_start
+    filtered_seconds, filtered_found = time_lookups(filtered_cache, lookup_ids, args.batch_size)
+
+    print(f'{args.lookups} lookups, {num_hits} cached, filter error rate {args.error_rate} '
+          f'({filtered_cache.membership_filter.get_memory_size()} bytes, built in {build_seconds:.2f}s)')
+    print(f'without filter: {plain_seconds:.2f}s ({plain_found} found)')
+    print(f'with filter:    {filtered_seconds:.2f}s ({filtered_found} found)')
+    print(f'speedup: {plain_seconds / filtered_seconds:.1f}x')
+
+    plain_cache.delete_all_keys_with_prefix(BENCHMARK_PREFIX)
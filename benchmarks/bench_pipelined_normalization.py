@@ -0,0 +1,111 @@
+"""
+Compare normalize_variants running its stages one after another against the pipelined stages, for an input mixing
+CAIDs, HGVS and dbSNP ids, against a local ClinGen stand-in that adds a fixed latency to each request and a small per
+variant cost. With --cache a redis cache from the ROBO_GENETICS_CACHE_* environment variables is used too, emptied
+before each run so every variant goes through every stage.
+
+    python -m benchmarks.bench_pipelined_normalization
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from robokop_genetics import node_types
+from robokop_genetics.genetics_cache import GeneticsCache
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+from robokop_genetics.metrics import MetricsRegistry, NORMALIZATION_STAGE_SECONDS
+
+BENCHMARK_PREFIX = 'robo-benchmark-pipelined-'
+
+
+class ClinGenStandIn(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        ids = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8').split('\n')
+        time.sleep(self.server.latency + self.server.variant_latency * len(ids))
+        self.send_json([{'@id': f'http://reg.genome.network/allele/CA{i}',
+                         'externalRecords': {'dbSNP': [{'rs': i}]}} for i in range(len(ids))])
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.send_json([{'@id': 'http://reg.genome.network/allele/CA1', 'externalRecords': {'dbSNP': [{'rs': 1}]}}])
+
+    def send_json(self, response_json):
+        response_body = json.dumps(response_json).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_clingen_stand_in(latency: float, variant_latency: float):
+    clingen_server = ThreadingHTTPServer(('127.0.0.1', 0), ClinGenStandIn)
+    clingen_server.daemon_threads = True
+    clingen_server.latency = latency
+    clingen_server.variant_latency = variant_latency
+    threading.Thread(target=clingen_server.serve_forever, daemon=True).start()
+    return clingen_server
+
+
+def make_variant_ids(args):
+    return [f'CAID:CA{i}' for i in range(args.caids)] + \
+           [f'HGVS:NC_000011.10:g.{68_000_000 + i}C>G' for i in range(args.hgvs)] + \
+           [f'DBSNP:rs{i}' for i in range(args.dbsnp)]
+
+
+def run(pipelined: bool, clingen_url: str, variant_ids: list, args):
+    cache = None
+    if args.cache:
+        cache = GeneticsCache(prefix=BENCHMARK_PREFIX)
+        cache.delete_all_keys_with_prefix(BENCHMARK_PREFIX)
+    metrics = MetricsRegistry()
+    normalizer = GeneticsNormalizer(cache=cache, metrics=metrics, clingen_url=clingen_url, pipelined=pipelined,
+                                    pipeline_chunk_size=args.chunk_size)
+    normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+    start_time = time.perf_counter()
+    normalization_results = normalizer.normalize_variants(variant_ids)
+    seconds = time.perf_counter() - start_time
+    assert len(normalization_results) == len(variant_ids)
+
+    label = 'pipelined' if pipelined else 'sequential'
+    print(f'{label:>10}: {seconds:6.2f}s end to end', end='')
+    if not pipelined:
+        # one after another, the time in each stage is what the pipelined run is compared to
+        for stage in ('cache_lookup', 'clingen_batch', 'clingen_single', 'cache_write', 'cache_flush'):
+            histogram = metrics.get_histogram(NORMALIZATION_STAGE_SECONDS, stage=stage)
+            if histogram:
+                print(f', {stage} {histogram.sum:.2f}s', end='')
+    print()
+    if cache:
+        cache.delete_all_keys_with_prefix(BENCHMARK_PREFIX)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--caids', type=int, default=20_000)
+    parser.add_argument('--hgvs', type=int, default=20_000)
+    parser.add_argument('--dbsnp', type=int, default=200)
+    parser.add_argument('--chunk-size', type=int, default=10_000)
+    parser.add_argument('--clingen-latency', type=float, default=0.05)
+    parser.add_argument('--clingen-variant-latency', type=float, default=0.00005)
+    parser.add_argument('--cache', action='store_true', help='use the cache from the environment variables')
+    args = parser.parse_args()
+    if args.cache and 'ROBO_GENETICS_CACHE_HOST' not in os.environ:
+        parser.error('--cache needs the ROBO_GENETICS_CACHE_* environment variables')
+
+    clingen_server = start_clingen_stand_in(args.clingen_latency, args.clingen_variant_latency)
+    clingen_url = f'http://127.0.0.1:{clingen_server.server_address[1]}/'
+    benchmark_variant_ids = make_variant_ids(args)
+    for pipelined_run in (False, True):
+        run(pipelined_run, clingen_url, benchmark_variant_ids, args)
+    clingen_server.shutdown()
+    clingen_server.server_close()
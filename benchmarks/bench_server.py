@@ -0,0 +1,128 @@
+"""
+Compare the genetics server with and without micro-batching, with many concurrent clients sending small normalization
+requests (and optionally a few bulk ones), against a local ClinGen stand-in that adds a fixed latency to each request
+and a small per variant cost, and only handles a few requests at a time like the real one.
+
+    python -m benchmarks.bench_server
+"""
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from robokop_genetics import node_types
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+from robokop_genetics.server import GeneticsServer
+
+
+class ClinGenStandIn(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        caids = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8').split('\n')
+        with self.server.request_slots:
+            self.server.num_requests += 1
+            time.sleep(self.server.latency + self.server.variant_latency * len(caids))
+        response_body = json.dumps([{'@id': f'http://reg.genome.network/allele/{caid}',
+                                     'externalRecords': {'dbSNP': [{'rs': i}]}}
+                                    for i, caid in enumerate(caids)]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_clingen_stand_in(latency: float, variant_latency: float, max_concurrent_requests: int):
+    clingen_server = ThreadingHTTPServer(('127.0.0.1', 0), ClinGenStandIn)
+    clingen_server.daemon_threads = True
+    clingen_server.latency = latency
+    clingen_server.variant_latency = variant_latency
+    clingen_server.request_slots = threading.Semaphore(max_concurrent_requests)
+    clingen_server.num_requests = 0
+    threading.Thread(target=clingen_server.serve_forever, daemon=True).start()
+    return clingen_server
+
+
+def run_client(server_port: int, num_requests: int, variants_per_request: int, randomizer: random.Random,
+               latencies: list):
+    connection = http.client.HTTPConnection('127.0.0.1', server_port)
+    for _ in range(num_requests):
+        curies = [f'CAID:CA{randomizer.randrange(10_000_000)}' for _ in range(variants_per_request)]
+        start_time = time.perf_counter()
+        connection.request('POST', '/normalize', body=json.dumps({'curies': curies}))
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start_time)
+        assert response.status == 200
+    connection.close()
+
+
+def get_percentile(latencies: list, percentile: float):
+    return sorted(latencies)[min(len(latencies) - 1, int(len(latencies) * percentile))]
+
+
+def run(batching: bool, args):
+    clingen_server = start_clingen_stand_in(args.clingen_latency, args.clingen_variant_latency,
+                                            args.clingen_concurrency)
+    normalizer = GeneticsNormalizer(clingen_url=f'http://127.0.0.1:{clingen_server.server_address[1]}/')
+    normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+    genetics_server = GeneticsServer(('127.0.0.1', 0), normalizer, batching=batching,
+                                     batch_window=args.batch_window, priority_batch_window=args.priority_batch_window)
+    threading.Thread(target=genetics_server.serve_forever, daemon=True).start()
+
+    small_latencies = []
+    bulk_latencies = []
+    client_threads = [threading.Thread(target=run_client,
+                                       args=(genetics_server.server_address[1], args.requests,
+                                             args.variants_per_request, random.Random(i), small_latencies))
+                      for i in range(args.clients)]
+    client_threads += [threading.Thread(target=run_client,
+                                        args=(genetics_server.server_address[1], args.bulk_requests,
+                                              args.bulk_variants_per_request, random.Random(-i - 1), bulk_latencies))
+                       for i in range(args.bulk_clients)]
+    start_time = time.perf_counter()
+    for client_thread in client_threads:
+        client_thread.start()
+    for client_thread in client_threads:
+        client_thread.join()
+    seconds = time.perf_counter() - start_time
+
+    genetics_server.shutdown()
+    genetics_server.server_close()
+    clingen_server.shutdown()
+    clingen_server.server_close()
+
+    label = 'micro-batched' if batching else 'per request'
+    print(f'{label:>14}: {len(small_latencies) / seconds:7.1f} requests/s, '
+          f'small p50 {get_percentile(small_latencies, 0.5) * 1000:6.1f}ms '
+          f'p99 {get_percentile(small_latencies, 0.99) * 1000:7.1f}ms, ', end='')
+    if bulk_latencies:
+        print(f'bulk p50 {get_percentile(bulk_latencies, 0.5) * 1000:7.1f}ms, ', end='')
+    print(f'{clingen_server.num_requests} clingen requests')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=40, help='requests sent by each client, one at a time')
+    parser.add_argument('--variants-per-request', type=int, default=3)
+    parser.add_argument('--bulk-clients', type=int, default=2)
+    parser.add_argument('--bulk-requests', type=int, default=5)
+    parser.add_argument('--bulk-variants-per-request', type=int, default=5_000)
+    parser.add_argument('--clingen-latency', type=float, default=0.05)
+    parser.add_argument('--clingen-variant-latency', type=float, default=0.000005)
+    parser.add_argument('--clingen-concurrency', type=int, default=4)
+    parser.add_argument('--batch-window', type=float, default=0.02)
+    parser.add_argument('--priority-batch-window', type=float, default=0.002)
+    args = parser.parse_args()
+
+    for batching in (False, True):
+        run(batching, args)
@@ -0,0 +1,127 @@
+"""
+Compare EnsemblService variant to gene throughput using the batch sweep, the in memory gene index one variant at a
+time, and the SQLite queries, plus the batch path only returning the nearest genes to each variant and the batch path run in a pool of processes by
+GeneticsServices.
+
+A synthetic genes database shaped like the Ensembl human gene set is generated in a temporary directory,
+so no biomart download is needed.
+
+    python -m benchmarks.bench_variant_to_gene --variants 1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from robokop_genetics.genetics_services import GeneticsServices, ENSEMBL
+from robokop_genetics.services.ensembl import EnsemblService, EnsemblGene
+from robokop_genetics.simple_graph_components import SimpleNode
+
+BATCH_SIZE = 10_000
+
+# roughly the number of genes in the human Ensembl gene set and the GRCh38 chromosome lengths
+NUM_GENES = 62_000
+CHROMOSOME_LENGTHS = {'1': 248_956_422, '2': 242_193_529, '3': 198_295_559, '4': 190_214_555, '5': 181_538_259,
+                      '6': 170_805_979, '7': 159_345_973, '8': 145_138_636, '9': 138_394_717, '10': 133_797_422,
+                      '11': 135_086_622, '12': 133_275_309, '13': 114_364_328, '14': 107_043_718, '15': 101_991_189,
+                      '16': 90_338_345, '17': 83_257_441, '18': 80_373_285, '19': 58_617_616, '20': 64_444_167,
+                      '21': 46_709_983, '22': 50_818_468, 'X': 156_040_895, 'Y': 57_227_415}
+
+
+def make_genes_db(ensembl_service: EnsemblService, randomizer: random.Random):
+    chromosomes = list(CHROMOSOME_LENGTHS.keys())
+    weights = list(CHROMOSOME_LENGTHS.values())
+    genes = []
+    for i in range(NUM_GENES):
+        chromosome = randomizer.choices(chromosomes, weights)[0]
+        start_position = randomizer.randint(1, CHROMOSOME_LENGTHS[chromosome])
+        end_position = start_position + int(randomizer.lognormvariate(9.5, 1.2))
+        genes.append(EnsemblGene(f'ENSG{i:011d}', f'GENE{i}', chromosome, start_position, end_position,
+                                 'protein_coding', ''))
+    ensembl_service.write_genes_db(genes, ensembl_release='synthetic')
+
+
+def make_variants(num_variants: int, randomizer: random.Random):
+    chromosomes = list(CHROMOSOME_LENGTHS.keys())
+    weights = list(CHROMOSOME_LENGTHS.values())
+    variants = []
+    for i in range(num_variants):
+        chromosome = randomizer.choices(chromosomes, weights)[0]
+        position = randomizer.randint(1, CHROMOSOME_LENGTHS[chromosome])
+        variant_id = f'CAID:CA{i}'
+        variants.append((variant_id, {variant_id, f'ROBO_VARIANT:HG38|{chromosome}|{position}|{position + 1}|A|G'}))
+    return variants
+
+
+def time_variant_to_gene(ensembl_service: EnsemblService, variants: list):
+    # results are kept for batches of variants like GeneticsServices.get_variant_to_gene does,
+    # which matters because of the garbage collection cost of holding many edge and node objects
+    start_time = time.perf_counter()
+    num_edges = 0
+    for i in range(0, len(variants), BATCH_SIZE):
+        batch_results = {variant_id: ensembl_service.sequence_variant_to_gene(variant_id, variant_synonyms)
+                         for variant_id, variant_synonyms in variants[i:i + BATCH_SIZE]}
+        num_edges += sum(len(variant_results) for variant_results in batch_results.values())
+    return time.perf_counter() - start_time, num_edges
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variants', type=int, default=1_000_000)
+    parser.add_argument('--sql-variants', type=int, default=None,
+                        help='number of variants to run through the SQLite path, defaults to --variants')
+    parser.add_argument('--nearest-k', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    randomizer = random.Random(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_service = EnsemblService(temp_dir=temp_dir)
+        make_genes_db(index_service, randomizer)
+        variants = make_variants(args.variants, randomizer)
+
+        load_start = time.perf_counter()
+        index_service.get_gene_index()
+        load_seconds = time.perf_counter() - load_start
+        index_seconds, index_edges = time_variant_to_gene(index_service, variants)
+
+        batch_start = time.perf_counter()
+        batch_edges = 0
+        for i in range(0, len(variants), BATCH_SIZE):
+            batch_results = index_service.batch_sequence_variant_to_gene(variants[i:i + BATCH_SIZE])
+            batch_edges += sum(len(variant_results) for variant_results in batch_results.values())
+        batch_seconds = time.perf_counter() - batch_start
+
+        nearest_start = time.perf_counter()
+        nearest_edges = 0
+        for i in range(0, len(variants), BATCH_SIZE):
+            batch_results = index_service.batch_sequence_variant_to_gene(variants[i:i + BATCH_SIZE],
+                                                                         nearest_k=args.nearest_k)
+            nearest_edges += sum(len(variant_results) for variant_results in batch_results.values())
+        nearest_seconds = time.perf_counter() - nearest_start
+
+        genetics_services = GeneticsServices(use_cache=False)
+        genetics_services.ensembl = index_service
+        variant_nodes = [SimpleNode(id=variant_id, type='biolink:SequenceVariant', name='', synonyms=variant_synonyms)
+                         for variant_id, variant_synonyms in variants]
+        parallel_start = time.perf_counter()
+        parallel_edges = 0
+        for batch_results in genetics_services.iter_ensembl_variant_to_gene(variant_nodes, num_workers=args.workers):
+            parallel_edges += sum(len(variant_results) for variant_results in batch_results.values())
+        parallel_seconds = time.perf_counter() - parallel_start
+
+        sql_service = EnsemblService(temp_dir=temp_dir, use_gene_index=False)
+        sql_variants = variants[:args.sql_variants] if args.sql_variants else variants
+        sql_seconds, sql_edges = time_variant_to_gene(sql_service, sql_variants)
+
+    print(f'gene index: {len(variants)} variants in {index_seconds:.1f}s '
+          f'({len(variants) / index_seconds:,.0f} variants/s, {index_edges} edges, index loaded in {load_seconds:.2f}s)')
+    print(f'batch:      {len(variants)} variants in {batch_seconds:.1f}s '
+          f'({len(variants) / batch_seconds:,.0f} variants/s, {batch_edges} edges)')
+    print(f'nearest {args.nearest_k}:  {len(variants)} variants in {nearest_seconds:.1f}s '
+          f'({len(variants) / nearest_seconds:,.0f} variants/s, {nearest_edges} edges)')
+    print(f'{args.workers} workers: {len(variants)} variants in {parallel_seconds:.1f}s '
+          f'({len(variants) / parallel_seconds:,.0f} variants/s, {parallel_edges} edges)')
+    print(f'sqlite:     {len(sql_variants)} variants in {sql_seconds:.1f}s '
+          f'({len(sql_variants) / sql_seconds:,.0f} variants/s, {sql_edges} edges)')
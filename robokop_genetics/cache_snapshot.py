@@ -0,0 +1,189 @@
+import argparse
+import gzip
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+
+from robokop_genetics.genetics_cache import GeneticsCache, DEFAULT_SERVICE_KEY_PREFIXES
+from robokop_genetics.util import LoggingUtil
+
+logger = LoggingUtil.init_logging(__name__,
+                                  logging.INFO,
+                                  log_file_path=LoggingUtil.get_logging_path())
+
+SNAPSHOT_FORMAT = 'robokop-genetics-cache-snapshot'
+SNAPSHOT_VERSION = 1
+DEFAULT_CHUNK_SIZE = 10_000
+DEFAULT_NUM_LOADERS = 4
+
+
+#
+# Snapshot files are gzipped JSON lines:
+#   a header line - {"format": ..., "version": ..., "key_prefixes": [...], "created": ...}
+#   one line per chunk - {"keys": [...], "values": [...]}
+#   a footer line - {"chunks": <num chunks>, "entries": <num entries>}
+# Values are stored exactly as they are in redis (they are already JSON strings), so exporting and importing never
+# decode them. Only one chunk is held in memory at a time when exporting, and a bounded number when importing.
+#
+def export_cache_snapshot(cache: GeneticsCache,
+                          snapshot_path: str,
+                          key_prefixes: list = None,
+                          chunk_size: int = DEFAULT_CHUNK_SIZE,
+                          compression_level: int = 6):
+    """
+    Stream every cache entry with one of the given key prefixes into a compressed snapshot file.
+
+    :param cache: the GeneticsCache to export from
+    :param snapshot_path: the file to write, it will be gzip compressed
+    :param key_prefixes: redis key prefixes to export, defaults to normalization and variant to gene results
+    :param chunk_size: the number of entries read from redis with one pipeline and written as one chunk
+    :param compression_level: gzip compression level
+    :return: the number of entries exported
+    """
+    if key_prefixes is None:
+        key_prefixes = [cache.NORMALIZATION_KEY_PREFIX] + DEFAULT_SERVICE_KEY_PREFIXES
+
+    num_chunks = 0
+    num_entries = 0
+    with gzip.open(snapshot_path, 'wt', encoding='utf-8', compresslevel=compression_level) as snapshot_file:
+        header = {'format': SNAPSHOT_FORMAT,
+                  'version': SNAPSHOT_VERSION,
+                  'key_prefixes': key_prefixes,
+                  'created': datetime.now(timezone.utc).isoformat()}
+        snapshot_file.write(json.dumps(header) + '\n')
+
+        for key_prefix in key_prefixes:
+            chunk_keys = []
+            for key in cache.scan_keys_with_prefix(key_prefix, count=chunk_size):
+                chunk_keys.append(key)
+                if len(chunk_keys) >= chunk_size:
+                    num_entries += _write_snapshot_chunk(cache, snapshot_file, chunk_keys)
+                    num_chunks += 1
+                    chunk_keys = []
+            if chunk_keys:
+                num_entries += _write_snapshot_chunk(cache, snapshot_file, chunk_keys)
+                num_chunks += 1
+            logger.info(f'Cache snapshot exported {num_entries} entries so far (finished prefix {key_prefix}).')
+
+        snapshot_file.write(json.dumps({'chunks': num_chunks, 'entries': num_entries}) + '\n')
+
+    logger.info(f'Cache snapshot export complete: {num_entries} entries in {num_chunks} chunks ({snapshot_path}).')
+    return num_entries
+
+
+def _write_snapshot_chunk(cache: GeneticsCache, snapshot_file, chunk_keys: list):
+    pipeline = cache.redis.pipeline(transaction=False)
+    for key in chunk_keys:
+        pipeline.get(key)
+    values = pipeline.execute()
+
+    # keys can expire or be deleted between the scan and the get, those are skipped
+    keys_to_write = []
+    values_to_write = []
+    for key, value in zip(chunk_keys, values):
+        if value is not None:
+            keys_to_write.append(key.decode('utf-8'))
+            values_to_write.append(value.decode('utf-8'))
+    if keys_to_write:
+        snapshot_file.write(json.dumps({'keys': keys_to_write, 'values': values_to_write}) + '\n')
+    return len(keys_to_write)
+
+
+def import_cache_snapshot(cache: GeneticsCache,
+                          snapshot_path: str,
+                          num_loaders: int = DEFAULT_NUM_LOADERS,
+                          max_pending_chunks: int = None,
+                          overwrite: bool = True):
+    """
+    Load a snapshot file created by export_cache_snapshot into a cache.
+
+    Chunks are written with pipelined bulk writes by a pool of parallel loaders. Reading the file stops while
+    max_pending_chunks are waiting to be written, so memory stays bounded no matter how big the snapshot is.
+
+    :param cache: the GeneticsCache to import into
+    :param snapshot_path: a snapshot file created by export_cache_snapshot
+    :param num_loaders: the number of parallel loaders writing to redis
+    :param max_pending_chunks: the max number of chunks read but not yet written, defaults to twice num_loaders
+    :param overwrite: if False, existing entries in the cache are kept instead of being replaced
+    :return: the number of entries imported
+    """
+    if max_pending_chunks is None:
+        max_pending_chunks = num_loaders * 2
+
+    num_entries = 0
+    footer = None
+    with gzip.open(snapshot_path, 'rt', encoding='utf-8') as snapshot_file:
+        header = json.loads(snapshot_file.readline() or '{}')
+        if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f'{snapshot_path} is not a supported cache snapshot file.')
+
+        pending_loads = set()
+        with ThreadPoolExecutor(max_workers=num_loaders) as executor:
+            for line in snapshot_file:
+                chunk = json.loads(line)
+                if 'keys' not in chunk:
+                    footer = chunk
+                    continue
+                if len(pending_loads) >= max_pending_chunks:
+                    finished_loads, pending_loads = wait(pending_loads, return_when=FIRST_COMPLETED)
+                    num_entries += sum(load.result() for load in finished_loads)
+                pending_loads.add(executor.submit(_load_snapshot_chunk,
+                                                  cache,
+                                                  chunk['keys'],
+                                                  chunk['values'],
+                                                  overwrite))
+            num_entries += sum(load.result() for load in pending_loads)
+
+    if footer is None:
+        logger.warning(f'Cache snapshot {snapshot_path} had no footer, the export may not have completed.')
+    elif footer['entries'] != num_entries:
+        logger.warning(f'Cache snapshot {snapshot_path} claims {footer["entries"]} entries '
+                       f'but {num_entries} were imported.')
+    logger.info(f'Cache snapshot import complete: {num_entries} entries ({snapshot_path}).')
+    return num_entries
+
+
+def _load_snapshot_chunk(cache: GeneticsCache, keys: list, values: list, overwrite: bool):
+    pipeline = cache.redis.pipeline(transaction=False)
+    if overwrite:
+        pipeline.mset(dict(zip(keys, values)))
+    else:
+        for key, value in zip(keys, values):
+            pipeline.set(key, value, nx=True)
+    # keeps the cache's membership filter, if there is one in redis, up to date with the imported keys
+    cache.execute_write_pipeline(pipeline, keys, 'import_cache_snapshot')
+    return len(keys)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export or import robokop-genetics cache snapshots. '
+                                                 'The cache is located using the ROBO_GENETICS_CACHE environment '
+                                                 'variables.')
+    parser.add_argument('--cache-prefix', default='', help='the prefix the GeneticsCache was created with')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='write cache entries to a snapshot file')
+    export_parser.add_argument('snapshot_path')
+    export_parser.add_argument('--key-prefix', action='append', dest='key_prefixes',
+                               help='a redis key prefix to export, may be repeated '
+                                    '(defaults to normalizations and variant to gene results)')
+    export_parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    import_parser = subparsers.add_parser('import', help='load a snapshot file into the cache')
+    import_parser.add_argument('snapshot_path')
+    import_parser.add_argument('--loaders', type=int, default=DEFAULT_NUM_LOADERS)
+    import_parser.add_argument('--no-overwrite', action='store_true', help='keep entries that already exist')
+
+    args = parser.parse_args()
+    genetics_cache = GeneticsCache(prefix=args.cache_prefix)
+    if args.command == 'export':
+        export_cache_snapshot(genetics_cache,
+                              args.snapshot_path,
+                              key_prefixes=args.key_prefixes,
+                              chunk_size=args.chunk_size)
+    else:
+        import_cache_snapshot(genetics_cache,
+                              args.snapshot_path,
+                              num_loaders=args.loaders,
+                              overwrite=not args.no_overwrite)
@@ -0,0 +1,196 @@
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from robokop_genetics.util import LoggingUtil
+
+DEFAULT_MAX_PENDING_WRITES = 100_000
+DEFAULT_WRITE_BATCH_SIZE = 10_000
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class WriteBehindCacheWriter(object):
+    """
+    Writes results to a GeneticsCache from a background thread, so callers can keep working while they're persisted.
+
+    Writes are held in memory and coalesced (a later write to the same key replaces an earlier one that hasn't been
+    written yet). The background thread writes everything pending once there are batch_size writes waiting, once the
+    oldest one has waited flush_interval seconds, or when flush is called. If max_pending_writes are already waiting,
+    new writes block until the background thread catches up, so memory stays bounded when redis is slower than the
+    callers.
+
+    Pending writes are only visible in the cache after they're written, call flush to wait for them. Writes that fail
+    are kept and tried again with the next batch, flush only returns once everything written before it is in the
+    cache and raises if that fails. Everything pending is also flushed when the writer is closed, or when the
+    interpreter exits, writes that still fail then are dropped.
+    """
+
+    logger = LoggingUtil.init_logging(__name__,
+                                      logging.INFO,
+                                      log_file_path=LoggingUtil.get_logging_path())
+
+    def __init__(self,
+                 cache,
+                 max_pending_writes: int = DEFAULT_MAX_PENDING_WRITES,
+                 batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        """
+        :param cache: the GeneticsCache to write to
+        :param max_pending_writes: writes waiting beyond this make new writes block
+        :param batch_size: the number of pending writes that triggers writing them
+        :param flush_interval: the max number of seconds a write waits before it's written
+        """
+        self.cache = cache
+        self.max_pending_writes = max_pending_writes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.condition = threading.Condition()
+        self.pending_normalizations = {}
+        self.pending_service_results = defaultdict(dict)
+        self.num_pending = 0
+        self.oldest_pending_time = None
+        # every call that adds writes increments submitted_generation, and the background thread sets
+        # written_generation to the latest generation it has written successfully, so flush knows when its writes
+        # are done, failed_writes counts the failed attempts so flush knows when to give up
+        self.submitted_generation = 0
+        self.written_generation = 0
+        self.failed_writes = 0
+        self.flush_requested = False
+        self.closed = False
+        # the error from the last failed write, and whether the latest write failed
+        self.write_error = None
+        self.writes_failing = False
+
+        self.thread = threading.Thread(target=self.__write_pending, name='genetics-cache-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def set_batch_normalization(self, normalization_map: dict):
+        self.__add_writes(None, normalization_map)
+
+    def set_service_results(self, service_key: str, results_dict: dict):
+        self.__add_writes(service_key, results_dict)
+
+    def __add_writes(self, service_key: str, new_writes: dict):
+        if not new_writes:
+            return
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('Genetics cache writer was already closed.')
+            # back-pressure - wait for the background thread to catch up, unless it can't write at all
+            while self.num_pending >= self.max_pending_writes:
+                if self.writes_failing:
+                    raise self.write_error
+                self.condition.wait()
+            pending_writes = self.pending_normalizations if service_key is None \
+                else self.pending_service_results[service_key]
+            num_pending_before = self.num_pending
+            for key, value in new_writes.items():
+                if key not in pending_writes:
+                    self.num_pending += 1
+                pending_writes[key] = value
+            if not num_pending_before:
+                self.oldest_pending_time = time.monotonic()
+            self.submitted_generation += 1
+            if not num_pending_before or self.num_pending >= self.batch_size:
+                self.condition.notify_all()
+
+    def flush(self):
+        """
+        Wait until everything written before this call is in the cache.
+
+        :raises: the error from the failed write, if writing them failed, they're kept to be tried again later
+        """
+        with self.condition:
+            flush_generation = self.submitted_generation
+            if self.written_generation < flush_generation:
+                self.flush_requested = True
+                self.condition.notify_all()
+                failed_writes = self.failed_writes
+                while self.written_generation < flush_generation:
+                    # give up on a failed attempt, or if the writer was closed and dropped the writes
+                    if self.failed_writes > failed_writes or self.closed and self.writes_failing:
+                        raise self.write_error
+                    self.condition.wait()
+
+    def close(self):
+        """Flush everything pending and stop the background thread."""
+        with self.condition:
+            if self.closed:
+                return
+        try:
+            self.flush()
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+            self.thread.join()
+            atexit.unregister(self.close)
+
+    def __write_pending(self):
+        while True:
+            with self.condition:
+                # after a failed write, wait flush_interval before trying again even if a batch is waiting
+                while not self.closed and not self.flush_requested and \
+                        (self.num_pending < self.batch_size or self.writes_failing):
+                    if self.num_pending:
+                        wait_time = self.oldest_pending_time + self.flush_interval - time.monotonic()
+                        if wait_time <= 0:
+                            break
+                        self.condition.wait(wait_time)
+                    else:
+                        self.condition.wait()
+                if self.closed and not self.num_pending:
+                    return
+                closed = self.closed
+                normalizations = self.pending_normalizations
+                service_results = {service_key: results for service_key, results in
+                                   self.pending_service_results.items() if results}
+                generation = self.submitted_generation
+                self.pending_normalizations = {}
+                self.pending_service_results = defaultdict(dict)
+                self.num_pending = 0
+                self.flush_requested = False
+                # wake up anyone blocked by back-pressure
+                self.condition.notify_all()
+
+            try:
+                if normalizations:
+                    self.cache.set_batch_normalization(normalizations)
+                for service_key, results in service_results.items():
+                    self.cache.set_service_results(service_key, results)
+            except Exception as e:
+                with self.condition:
+                    self.write_error = e
+                    self.writes_failing = True
+                    self.failed_writes += 1
+                    num_failed = len(normalizations) + sum(len(results) for results in service_results.values())
+                    if closed:
+                        self.logger.error(f'Genetics cache writer failed to write to the cache, dropping {num_failed} '
+                                          f'writes because it was closed: {e}')
+                        self.condition.notify_all()
+                        return
+                    self.logger.error(f'Genetics cache writer failed to write to the cache, will try {num_failed} '
+                                      f'writes again: {e}')
+                    self.__keep_failed_writes(normalizations, service_results)
+                    self.condition.notify_all()
+                continue
+
+            with self.condition:
+                self.written_generation = generation
+                self.writes_failing = False
+                self.condition.notify_all()
+
+    def __keep_failed_writes(self, normalizations: dict, service_results: dict):
+        # put failed writes back with the pending ones, unless they were written again since
+        for pending_writes, failed_writes in [(self.pending_normalizations, normalizations)] + \
+                [(self.pending_service_results[service_key], results)
+                 for service_key, results in service_results.items()]:
+            for key, value in failed_writes.items():
+                if key not in pending_writes:
+                    pending_writes[key] = value
+                    self.num_pending += 1
+        self.oldest_pending_time = time.monotonic()
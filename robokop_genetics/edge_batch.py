@@ -0,0 +1,237 @@
+import json
+from array import array
+from collections.abc import Mapping, Sequence
+
+from robokop_genetics.simple_graph_components import SimpleEdge, SimpleNode, GraphInterner
+
+# the same layout json.dumps gives the encoded results in genetics_cache.encode_service_results
+ENCODED_EDGE_TEMPLATE = '{{"edge": {{"source_id": {source_id}, "target_id": {target_id}, ' \
+                        '"provided_by": {provided_by}, "input_id": {input_id}, "predicate_id": {predicate_id}, ' \
+                        '"predicate_label": {predicate_label}, "ctime": {ctime}, ' \
+                        '"properties": {{"distance": {distance}}}}}, ' \
+                        '"node": {{"id": {target_id}, "category": {target_type}, "name": {target_name}}}}}'
+
+
+class EdgeBatch(Mapping):
+    """
+    Service results for many source nodes, stored in columns instead of as (SimpleEdge, SimpleNode) objects.
+
+    Every edge is a row in parallel arrays of source index, target index, predicate code and distance. The ids, names
+    and predicates they refer to are stored once each in shared tables, and the edges for one source are contiguous.
+    Provided by, ctime and the target node type are the same for the whole batch. With an interner, target nodes and
+    strings are shared with everything else using the same interner. The interner isn't pickled with the batch.
+
+    An EdgeBatch can be used like the dictionary of source_id -> list of (SimpleEdge, SimpleNode) the bulk service
+    calls return otherwise. Each value is an EdgeBatchResults, which only creates edge and node objects for the items
+    that are accessed. Results are encoded for the cache, or written to a file, straight from the columns.
+    """
+
+    def __init__(self, provided_by: str, target_type: str, ctime: int = 1, interner: GraphInterner = None):
+        self.provided_by = provided_by
+        self.target_type = target_type
+        self.ctime = ctime
+        self.interner = interner
+
+        self.source_ids = []
+        self.source_input_ids = []
+        # the index of the first edge of each source
+        self.source_edge_starts = array('Q')
+        self.source_lookup = {}
+
+        self.target_ids = []
+        self.target_names = []
+        self.target_lookup = {}
+
+        # (predicate_id, predicate_label)
+        self.predicates = []
+        self.predicate_lookup = {}
+
+        self.edge_sources = array('I')
+        self.edge_targets = array('I')
+        self.edge_predicates = array('H')
+        self.edge_distances = array('q')
+
+        # json encoded table entries, filled in as they're first needed
+        self.__encoded_target_ids = []
+        self.__encoded_target_names = []
+        self.__encoded_predicates = []
+
+    def add_source(self, source_id: str, input_id: str = None):
+        """
+        Start the results for a source node, following add_edge calls add edges to it.
+
+        Adding a source that is already in the batch replaces its results, like setting a dictionary key.
+        """
+        self.source_lookup[source_id] = len(self.source_ids)
+        self.source_ids.append(source_id)
+        self.source_input_ids.append(input_id)
+        self.source_edge_starts.append(len(self.edge_targets))
+
+    def add_edge(self, target_id: str, target_name: str, predicate_id: str, predicate_label: str, distance: int):
+        """Add an edge from the last source added."""
+        target_index = self.target_lookup.get(target_id)
+        if target_index is None:
+            if self.interner is not None:
+                target_id = self.interner.intern(target_id)
+                target_name = self.interner.intern(target_name)
+            target_index = self.target_lookup[target_id] = len(self.target_ids)
+            self.target_ids.append(target_id)
+            self.target_names.append(target_name)
+        predicate = (predicate_id, predicate_label)
+        predicate_code = self.predicate_lookup.get(predicate)
+        if predicate_code is None:
+            predicate_code = self.predicate_lookup[predicate] = len(self.predicates)
+            self.predicates.append(predicate)
+        self.edge_sources.append(len(self.source_ids) - 1)
+        self.edge_targets.append(target_index)
+        self.edge_predicates.append(predicate_code)
+        self.edge_distances.append(distance)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['interner'] = None
+        return state
+
+    @property
+    def num_edges(self):
+        return len(self.edge_targets)
+
+    def get_source_edge_range(self, source_index: int):
+        edge_end = self.source_edge_starts[source_index + 1] if source_index + 1 < len(self.source_ids) \
+            else len(self.edge_targets)
+        return range(self.source_edge_starts[source_index], edge_end)
+
+    def __getitem__(self, source_id: str):
+        return EdgeBatchResults(self, self.source_lookup[source_id])
+
+    def __len__(self):
+        return len(self.source_lookup)
+
+    def __iter__(self):
+        return iter(self.source_lookup)
+
+    def create_result(self, edge_index: int):
+        """
+        :return: a (SimpleEdge, SimpleNode) tuple for one edge
+        """
+        source_index = self.edge_sources[edge_index]
+        target_index = self.edge_targets[edge_index]
+        predicate_id, predicate_label = self.predicates[self.edge_predicates[edge_index]]
+        target_id = self.target_ids[target_index]
+        edge = SimpleEdge(source_id=self.source_ids[source_index],
+                          target_id=target_id,
+                          provided_by=self.provided_by,
+                          input_id=self.source_input_ids[source_index],
+                          predicate_id=predicate_id,
+                          predicate_label=predicate_label,
+                          ctime=self.ctime,
+                          properties={'distance': self.edge_distances[edge_index]})
+        if self.interner is not None:
+            node = self.interner.get_node(target_id, self.target_type, self.target_names[target_index])
+        else:
+            node = SimpleNode(id=target_id, type=self.target_type, name=self.target_names[target_index])
+        return edge, node
+
+    def iter_encoded_edges(self, edge_range: range = None):
+        """
+        Encode edges as json without creating edge or node objects.
+
+        :param edge_range: the edges to encode, defaults to all of them
+        :return: an iterator of one json string per edge, in the format GeneticsCache stores service results in
+        """
+        # each table entry is only encoded once no matter how many edges use it
+        encoded_target_ids = self.__encode_new_entries(self.__encoded_target_ids, self.target_ids)
+        encoded_target_names = self.__encode_new_entries(self.__encoded_target_names, self.target_names)
+        encoded_predicates = self.__encode_new_entries(self.__encoded_predicates, self.predicates)
+        encoded_provided_by = json.dumps(self.provided_by)
+        encoded_target_type = json.dumps(self.target_type)
+        encoded_ctime = json.dumps(self.ctime)
+
+        last_source_index = None
+        encoded_source_id = encoded_input_id = None
+        for edge_index in (edge_range if edge_range is not None else range(len(self.edge_targets))):
+            source_index = self.edge_sources[edge_index]
+            if source_index != last_source_index:
+                encoded_source_id = json.dumps(self.source_ids[source_index])
+                encoded_input_id = json.dumps(self.source_input_ids[source_index])
+                last_source_index = source_index
+            target_index = self.edge_targets[edge_index]
+            encoded_predicate_id, encoded_predicate_label = encoded_predicates[self.edge_predicates[edge_index]]
+            yield ENCODED_EDGE_TEMPLATE.format(source_id=encoded_source_id,
+                                               target_id=encoded_target_ids[target_index],
+                                               provided_by=encoded_provided_by,
+                                               input_id=encoded_input_id,
+                                               predicate_id=encoded_predicate_id,
+                                               predicate_label=encoded_predicate_label,
+                                               ctime=encoded_ctime,
+                                               distance=self.edge_distances[edge_index],
+                                               target_type=encoded_target_type,
+                                               target_name=encoded_target_names[target_index])
+
+    @staticmethod
+    def __encode_new_entries(encoded_entries: list, table: list):
+        for entry in table[len(encoded_entries):]:
+            encoded_entries.append(json.dumps(entry) if isinstance(entry, str) else tuple(map(json.dumps, entry)))
+        return encoded_entries
+
+    def encode_source_results(self, source_id: str):
+        """
+        :return: the json payload GeneticsCache stores for one source's results
+        """
+        return self[source_id].encode()
+
+    def write_jsonl(self, output_file):
+        """
+        Write every edge to a text file, one json object per line, in the same format as the cached results.
+
+        :param output_file: a file opened for writing text
+        :return: the number of edges written
+        """
+        num_edges = 0
+        # only the latest results for each source, in case a source was added more than once
+        for source_index in self.source_lookup.values():
+            for encoded_edge in self.iter_encoded_edges(self.get_source_edge_range(source_index)):
+                output_file.write(encoded_edge)
+                output_file.write('\n')
+                num_edges += 1
+        return num_edges
+
+
+class EdgeBatchResults(Sequence):
+    """
+    A read only list of the (SimpleEdge, SimpleNode) results for one source in an EdgeBatch.
+
+    Edge and node objects are created each time an item is accessed.
+    """
+
+    __slots__ = ('edge_batch', 'source_index')
+
+    def __init__(self, edge_batch: EdgeBatch, source_index: int):
+        self.edge_batch = edge_batch
+        self.source_index = source_index
+
+    def __len__(self):
+        return len(self.edge_batch.get_source_edge_range(self.source_index))
+
+    def __getitem__(self, index):
+        source_edges = self.edge_batch.get_source_edge_range(self.source_index)
+        if isinstance(index, slice):
+            return [self.edge_batch.create_result(edge_index) for edge_index in source_edges[index]]
+        return self.edge_batch.create_result(source_edges[index])
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'EdgeBatchResults({list(self)!r})'
+
+    def encode(self):
+        """
+        :return: the json payload GeneticsCache stores for these results
+        """
+        source_edges = self.edge_batch.get_source_edge_range(self.source_index)
+        return f'[{", ".join(self.edge_batch.iter_encoded_edges(source_edges))}]'
@@ -1,9 +1,133 @@
 import os
 import json
+import time
+import uuid
+import atexit
+import socket
 import redis
 import logging
+from collections.abc import Sequence
 from robokop_genetics.util import LoggingUtil
-from robokop_genetics.simple_graph_components import SimpleEdge, SimpleNode
+from robokop_genetics.simple_graph_components import SimpleEdge, SimpleNode, GraphInterner
+from robokop_genetics.edge_batch import EdgeBatchResults
+from robokop_genetics.membership_filter import BloomFilter, get_bit_positions
+from robokop_genetics.metrics import MetricsSink, get_metrics_sink, CACHE_LOOKUPS, CACHE_PIPELINE_COMMANDS, \
+    CACHE_PIPELINE_SECONDS
+from robokop_genetics.tracing import span
+
+# the service results written by GeneticsServices.get_variant_to_gene, including results cached with non default
+# query parameters, see get_variant_to_gene_cache_key there
+DEFAULT_SERVICE_KEY_PREFIXES = ['Ensembl_sequence_variant_to_gene']
+
+# options for where the membership filter is kept, see GeneticsCache.init_membership_filter
+MEMBERSHIP_FILTER_REDIS = 'redis'
+MEMBERSHIP_FILTER_LOCAL = 'local'
+
+# options for how GeneticsCache.get_service_results returns each cached value
+SERVICE_RESULTS_DECODED = 'decoded'
+SERVICE_RESULTS_LAZY = 'lazy'
+SERVICE_RESULTS_RAW = 'raw'
+
+
+def encode_service_results(service_results):
+    """
+    :param service_results: a list of (SimpleEdge, SimpleNode), LazyServiceResults which are already encoded,
+    or EdgeBatchResults which are encoded straight from the batch columns
+    :return: the JSON payload cached for the results
+    """
+    if isinstance(service_results, LazyServiceResults):
+        return service_results.raw
+    if isinstance(service_results, EdgeBatchResults):
+        return service_results.encode()
+    encoded_results = []
+    for (edge, node) in service_results:
+        json_node = {"id": node.id, "category": node.type, "name": node.name}
+        json_edge = {"source_id": edge.source_id,
+                     "target_id": edge.target_id,
+                     "provided_by": edge.provided_by,
+                     "input_id": edge.input_id,
+                     "predicate_id": edge.predicate_id,
+                     "predicate_label": edge.predicate_label,
+                     "ctime": edge.ctime,
+                     "properties": edge.properties}
+        encoded_result = {"edge": json_edge, "node": json_node}
+        encoded_results.append(encoded_result)
+    return json.dumps(encoded_results)
+
+
+def decode_service_result(result: dict, interner: GraphInterner = None):
+    """
+    :param result: one decoded edge and node from a cached payload
+    :param interner: if provided the node, and the strings repeated across results, are shared through it
+    """
+    edge_json = result["edge"]
+    node_json = result["node"]
+    if interner is not None:
+        intern = interner.intern
+        edge_json['target_id'] = intern(edge_json['target_id'])
+        edge_json['provided_by'] = intern(edge_json['provided_by'])
+        edge_json['predicate_id'] = intern(edge_json['predicate_id'])
+        edge_json['predicate_label'] = intern(edge_json['predicate_label'])
+    edge_object = SimpleEdge(source_id=edge_json['source_id'],
+                             target_id=edge_json['target_id'],
+                             provided_by=edge_json['provided_by'],
+                             input_id=edge_json['input_id'],
+                             predicate_id=edge_json['predicate_id'],
+                             predicate_label=edge_json['predicate_label'],
+                             ctime=edge_json['ctime'],
+                             properties=edge_json['properties'])
+    # note that right now we're not caching properties or synonyms for service nodes,
+    # properties aren't used yet, synonyms will come from normalization after the fact
+    if interner is not None:
+        node_object = interner.get_node(node_json["id"], node_json["category"], node_json["name"])
+    else:
+        node_object = SimpleNode(id=node_json["id"],
+                                 type=node_json["category"],
+                                 name=node_json["name"])
+    return edge_object, node_object
+
+
+class LazyServiceResults(Sequence):
+    """
+    A read only list of the (SimpleEdge, SimpleNode) results cached for one node.
+
+    It holds the raw cached payload. The payload is only parsed the first time the results are accessed, and each
+    edge and node is only created when that item is accessed, so the cost scales with what is actually used.
+    The raw payload is available for writing the results out without decoding them.
+    """
+
+    __slots__ = ('raw', 'interner', '_results_json', '_results')
+
+    def __init__(self, raw: bytes, interner: GraphInterner = None):
+        self.raw = raw
+        self.interner = interner
+        self._results_json = None
+        self._results = None
+
+    def __get_results_json(self):
+        if self._results_json is None:
+            self._results_json = json.loads(self.raw)
+            self._results = [None] * len(self._results_json)
+        return self._results_json
+
+    def __len__(self):
+        return len(self.__get_results_json())
+
+    def __getitem__(self, index):
+        results_json = self.__get_results_json()
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(results_json)))]
+        result = self._results[index]
+        if result is None:
+            result = self._results[index] = decode_service_result(results_json[index], self.interner)
+        return result
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return f'LazyServiceResults({self.raw!r})'
 
 
 class GeneticsCache:
@@ -18,8 +142,21 @@ class GeneticsCache:
                  redis_port: int = 6379,
                  redis_db: int = 0,
                  redis_password: str = "",
-                 prefix: str = ""):
+                 prefix: str = "",
+                 membership_filter: str = None,
+                 membership_filter_capacity: int = 10_000_000,
+                 membership_filter_error_rate: float = 0.01,
+                 membership_filter_path: str = None,
+                 membership_filter_refresh_interval: int = 60,
+                 metrics: MetricsSink = None):
+        self.prefix = prefix
+        self.metrics = metrics
         self.NORMALIZATION_KEY_PREFIX = f'{prefix}normalize-'
+        self.MEMBERSHIP_FILTER_KEY = f'{prefix}membership-filter'
+        self.MEMBERSHIP_FILTER_PARAMS_KEY = f'{prefix}membership-filter-params'
+        self.NORMALIZATION_LEASE_KEY_PREFIX = f'{prefix}lease-normalize-'
+        # identifies leases held by this client
+        self.lease_token = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}'
 
         if use_default_credentials:
             try:
@@ -47,16 +184,183 @@ class GeneticsCache:
             self.logger.error(f"Genetics cache failed to connect to redis at {redis_host}:{redis_port}/{redis_db}.")
             raise e
 
+        self.membership_filter = None
+        self.membership_filter_mode = membership_filter
+        self.membership_filter_path = membership_filter_path
+        self.membership_filter_refresh_interval = membership_filter_refresh_interval
+        self.membership_filter_loaded_at = 0
+        # The parameters of the filter kept in redis, as they were last read from redis (None if there isn't one).
+        # Every client writing to the cache adds its keys to that filter, even without a filter of its own, see
+        # execute_write_pipeline.
+        self.redis_filter_parameters = None
+        if membership_filter:
+            self.init_membership_filter(membership_filter_capacity, membership_filter_error_rate)
+
+    def init_membership_filter(self, capacity: int, error_rate: float):
+        """
+        Set up a bloom filter of the keys in the cache, so lookups can skip keys that are definitely not cached.
+
+        With MEMBERSHIP_FILTER_REDIS the filter is kept in redis and shared by every cache client with the same prefix,
+        each client keeps a local copy which is refreshed from redis every membership_filter_refresh_interval seconds.
+        With MEMBERSHIP_FILTER_LOCAL the filter is kept in memory and saved to membership_filter_path on exit.
+
+        If no existing filter is found a new one is built from the keys currently in the cache. Keys cached by other
+        clients since the local copy was loaded are reported as misses until the next refresh.
+
+        Every GeneticsCache adds the keys it writes to the filter in redis, whether it was created with a filter or
+        not (see execute_write_pipeline), so the filter never misses keys written through a GeneticsCache. Keys written
+        to redis any other way aren't in the filter until rebuild_membership_filter is run. A local filter only knows
+        about keys written by its own client, so it should only be used by a client that is the only writer, or be
+        rebuilt after anything else writes to the cache.
+        """
+        if self.membership_filter_mode == MEMBERSHIP_FILTER_REDIS:
+            new_filter = BloomFilter(capacity=capacity, error_rate=error_rate)
+            # only the first client to get here decides the filter parameters, everyone else uses them
+            filter_parameters = json.dumps(new_filter.get_parameters()).encode('utf-8')
+            created = self.redis.set(self.MEMBERSHIP_FILTER_PARAMS_KEY, filter_parameters, nx=True)
+            if created:
+                self.membership_filter = new_filter
+                self.redis_filter_parameters = filter_parameters
+                self.rebuild_membership_filter()
+            else:
+                self.refresh_membership_filter()
+        elif self.membership_filter_mode == MEMBERSHIP_FILTER_LOCAL:
+            if self.membership_filter_path and os.path.exists(self.membership_filter_path):
+                self.membership_filter = BloomFilter.load(self.membership_filter_path)
+            else:
+                self.membership_filter = BloomFilter(capacity=capacity, error_rate=error_rate)
+                self.rebuild_membership_filter()
+            if self.membership_filter_path:
+                atexit.register(self.save_membership_filter)
+        else:
+            raise ValueError(f'Unknown membership filter option: {self.membership_filter_mode}')
+        self.membership_filter_loaded_at = time.time()
+        self.logger.info(f'Genetics cache membership filter ({self.membership_filter_mode}) ready '
+                         f'({self.membership_filter.get_memory_size()} bytes).')
+
+    def refresh_membership_filter(self):
+        self.redis_filter_parameters = self.redis.get(self.MEMBERSHIP_FILTER_PARAMS_KEY)
+        if self.redis_filter_parameters is None:
+            # the filter was deleted from redis, keep the local copy until one is created again
+            return
+        filter_bits = self.redis.get(self.MEMBERSHIP_FILTER_KEY) or b''
+        refreshed_filter = BloomFilter(bit_array=filter_bits, **json.loads(self.redis_filter_parameters))
+        if self.membership_filter is not None and \
+                self.membership_filter.get_parameters() == refreshed_filter.get_parameters():
+            # keep anything added locally that hasn't reached redis yet
+            num_bytes = len(refreshed_filter.bits)
+            merged_bits = int.from_bytes(refreshed_filter.bits, 'big') | int.from_bytes(self.membership_filter.bits, 'big')
+            refreshed_filter.bits = bytearray(merged_bits.to_bytes(num_bytes, 'big'))
+        self.membership_filter = refreshed_filter
+        self.membership_filter_loaded_at = time.time()
+
+    def rebuild_membership_filter(self, key_prefixes: list = None):
+        if key_prefixes is None:
+            key_prefixes = [self.NORMALIZATION_KEY_PREFIX] + DEFAULT_SERVICE_KEY_PREFIXES
+        num_keys = 0
+        for key_prefix in key_prefixes:
+            keys = []
+            for key in self.scan_keys_with_prefix(key_prefix):
+                keys.append(key.decode('utf-8'))
+                if len(keys) == 10000:
+                    self.__add_keys_and_execute(keys)
+                    num_keys += len(keys)
+                    keys = []
+            if keys:
+                self.__add_keys_and_execute(keys)
+                num_keys += len(keys)
+        self.logger.info(f'Genetics cache membership filter built from {num_keys} existing keys.')
+
+    def __add_keys_and_execute(self, keys: list):
+        pipeline = self.redis.pipeline(transaction=False)
+        self.add_to_membership_filter(keys, pipeline)
+        self.__execute_pipeline(pipeline, 'rebuild_membership_filter')
+
+    def add_to_membership_filter(self, keys: list, pipeline=None):
+        """
+        Add redis keys to the membership filter. If there is a filter in redis the bits are also set with the
+        provided pipeline, so the caller should add this to the same pipeline that writes the keys. Use
+        execute_write_pipeline to do both.
+        """
+        if self.membership_filter is not None:
+            for key in keys:
+                bit_positions = self.membership_filter.add(key)
+                if pipeline is not None and self.membership_filter_mode == MEMBERSHIP_FILTER_REDIS:
+                    self.__set_redis_filter_bits(pipeline, bit_positions)
+        elif pipeline is not None and self.redis_filter_parameters is not None:
+            # no filter in this client, only the one in redis is updated
+            filter_parameters = json.loads(self.redis_filter_parameters)
+            for key in keys:
+                self.__set_redis_filter_bits(pipeline, get_bit_positions(key,
+                                                                         filter_parameters['num_bits'],
+                                                                         filter_parameters['num_hashes']))
+
+    def __set_redis_filter_bits(self, pipeline, bit_positions: list):
+        bitfield_args = []
+        for bit_position in bit_positions:
+            bitfield_args.extend(('SET', 'u1', bit_position, 1))
+        pipeline.execute_command('BITFIELD', self.MEMBERSHIP_FILTER_KEY, *bitfield_args)
+
+    def execute_write_pipeline(self, pipeline, keys: list, operation: str):
+        """
+        Execute a pipeline that writes cache keys, adding the keys to the membership filter in the same pipeline.
+
+        The pipeline also reads the parameters of the filter in redis. If a filter was created, replaced or deleted
+        since this client last looked, for example by another client starting up with membership_filter set, the keys
+        are added again to the filter that's there now. So clients without a filter of their own, like a cache
+        snapshot import or an existing worker, never leave keys out of a filter, which would make them look uncached
+        to everyone using it.
+
+        :param keys: the redis keys written by the pipeline
+        :param operation: the name used for the pipeline's metrics and spans
+        :return: the pipeline results for the commands added by the caller
+        """
+        self.add_to_membership_filter(keys, pipeline)
+        check_redis_filter = self.membership_filter_mode != MEMBERSHIP_FILTER_LOCAL
+        if check_redis_filter:
+            pipeline.get(self.MEMBERSHIP_FILTER_PARAMS_KEY)
+        results = self.__execute_pipeline(pipeline, operation)
+        if check_redis_filter:
+            redis_filter_parameters = results.pop()
+            if redis_filter_parameters != self.redis_filter_parameters:
+                if self.membership_filter is not None:
+                    self.refresh_membership_filter()
+                else:
+                    self.redis_filter_parameters = redis_filter_parameters
+                if self.redis_filter_parameters is not None:
+                    filter_pipeline = self.redis.pipeline(transaction=False)
+                    self.add_to_membership_filter(keys, filter_pipeline)
+                    self.__execute_pipeline(filter_pipeline, 'add_to_membership_filter')
+        return results
+
+    def save_membership_filter(self):
+        if self.membership_filter is not None and self.membership_filter_path:
+            self.membership_filter.save(self.membership_filter_path)
+
+    def __filter_possibly_cached(self, node_ids: list, key_prefix: str):
+        if self.membership_filter is None:
+            return node_ids
+        if self.membership_filter_mode == MEMBERSHIP_FILTER_REDIS and \
+                time.time() - self.membership_filter_loaded_at > self.membership_filter_refresh_interval:
+            self.refresh_membership_filter()
+        membership_filter = self.membership_filter
+        possibly_cached = [node_id for node_id in node_ids if f'{key_prefix}{node_id}' in membership_filter]
+        self.logger.debug(f'Genetics cache membership filter skipped {len(node_ids) - len(possibly_cached)}/'
+                          f'{len(node_ids)} lookups.')
+        return possibly_cached
+
     #def set_normalization(self, node_id: str, normalization: tuple):
     #    normalization_key = f'{self.NORMALIZATION_KEY_PREFIX}{node_id}'
     #    self.redis.set(normalization_key, json.dumps(normalization))
 
     def set_batch_normalization(self, normalization_map: dict):
         pipeline = self.redis.pipeline()
+        normalization_keys = []
         for node_id, normalization in normalization_map.items():
             normalization_key = f'{self.NORMALIZATION_KEY_PREFIX}{node_id}'
             pipeline.set(normalization_key, json.dumps(normalization))
-        pipeline.execute()
+            normalization_keys.append(normalization_key)
+        self.execute_write_pipeline(pipeline, normalization_keys, 'set_normalization')
 
     #def get_normalization(self, node_id: str):
     #    normalization_key = f'{self.NORMALIZATION_KEY_PREFIX}{node_id}'
@@ -64,73 +368,159 @@ class GeneticsCache:
     #    normalization = json.loads(result) if result is not None else None
     #    return normalization
 
-    def get_batch_normalization(self, node_ids: list):
+    # check_membership_filter: set to False to always look in redis, for keys that could have just been written elsewhere
+    def get_batch_normalization(self, node_ids: list, check_membership_filter: bool = True):
+        num_requested = len(node_ids)
+        if check_membership_filter:
+            node_ids = self.__filter_possibly_cached(node_ids, self.NORMALIZATION_KEY_PREFIX)
+        if not node_ids:
+            self.__record_lookups('normalization', num_requested, 0, 0)
+            return {}
         pipeline = self.redis.pipeline()
         for node_id in node_ids:
             normalization_key = f'{self.NORMALIZATION_KEY_PREFIX}{node_id}'
             pipeline.get(normalization_key)
-        results = pipeline.execute()
+        results = self.__execute_pipeline(pipeline, 'get_normalization')
 
         normalization_map = {}
-        for i, result in enumerate(results):
-            if result is not None:
-                normalization_map[node_ids[i]] = json.loads(result)
+        with span('json_decode') as decode_span:
+            for i, result in enumerate(results):
+                if result is not None:
+                    normalization_map[node_ids[i]] = json.loads(result)
+            decode_span.set(values=len(normalization_map))
+        self.__record_lookups('normalization', num_requested, len(node_ids), len(normalization_map))
         return normalization_map
 
+    def acquire_normalization_leases(self, node_ids: list, lease_seconds: float):
+        """
+        Try to take short lived leases on normalizing node ids, so that other workers sharing this cache know
+        they are being normalized and can wait for the results instead of duplicating the work.
+
+        :param node_ids: node ids to lease
+        :param lease_seconds: how long until the leases expire, if they aren't released first
+        :return: the list of node ids that were leased, the others are already leased by someone else
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for node_id in node_ids:
+            pipeline.set(f'{self.NORMALIZATION_LEASE_KEY_PREFIX}{node_id}',
+                         self.lease_token,
+                         nx=True,
+                         px=int(lease_seconds * 1000))
+        lease_results = self.__execute_pipeline(pipeline, 'acquire_leases')
+        return [node_id for node_id, leased in zip(node_ids, lease_results) if leased]
+
+    def renew_normalization_leases(self, node_ids: list, lease_seconds: float):
+        """
+        Extend the leases this client still holds on normalizing node ids, so they don't run out while a long
+        normalization is still going. Leases that already expired (and may be held by someone else now) are left alone.
+
+        :param node_ids: node ids leased with acquire_normalization_leases
+        :param lease_seconds: how long from now until the leases expire, if they aren't released or renewed first
+        :return: the list of node ids whose leases were renewed
+        """
+        lease_keys = [f'{self.NORMALIZATION_LEASE_KEY_PREFIX}{node_id}' for node_id in node_ids]
+        if not lease_keys:
+            return []
+        our_lease_token = self.lease_token.encode('utf-8')
+        with self.redis.pipeline() as pipeline:
+            while True:
+                try:
+                    # the transaction fails if a lease changes hands between checking and renewing it
+                    pipeline.watch(*lease_keys)
+                    lease_tokens = pipeline.mget(lease_keys)
+                    our_leases = [(node_id, lease_key)
+                                  for node_id, lease_key, lease_token in zip(node_ids, lease_keys, lease_tokens)
+                                  if lease_token == our_lease_token]
+                    pipeline.multi()
+                    for node_id, lease_key in our_leases:
+                        pipeline.pexpire(lease_key, int(lease_seconds * 1000))
+                    pipeline.execute()
+                    return [node_id for node_id, lease_key in our_leases]
+                except redis.WatchError:
+                    continue
+
+    def release_normalization_leases(self, node_ids: list):
+        lease_keys = [f'{self.NORMALIZATION_LEASE_KEY_PREFIX}{node_id}' for node_id in node_ids]
+        if not lease_keys:
+            return
+        # only release leases that are still ours, if one expired someone else may hold it now
+        lease_tokens = self.redis.mget(lease_keys)
+        our_lease_token = self.lease_token.encode('utf-8')
+        our_lease_keys = [lease_key for lease_key, lease_token in zip(lease_keys, lease_tokens)
+                          if lease_token == our_lease_token]
+        if our_lease_keys:
+            self.redis.delete(*our_lease_keys)
+
     def set_service_results(self, service_key: str, results_dict: dict):
         pipeline = self.redis.pipeline()
+        redis_keys = []
         for node_id, results in results_dict.items():
             redis_key = f'{service_key}-{node_id}'
-            pipeline.set(redis_key, self.__encode_service_results(results))
-        pipeline.execute()
-
-    def __encode_service_results(self, service_results: list):
-        encoded_results = []
-        for (edge, node) in service_results:
-            json_node = {"id": node.id, "category": node.type, "name": node.name}
-            json_edge = {"source_id": edge.source_id,
-                         "target_id": edge.target_id,
-                         "provided_by": edge.provided_by,
-                         "input_id": edge.input_id,
-                         "predicate_id": edge.predicate_id,
-                         "predicate_label": edge.predicate_label,
-                         "ctime": edge.ctime,
-                         "properties": edge.properties}
-            encoded_result = {"edge": json_edge, "node": json_node}
-            encoded_results.append(encoded_result)
-        return json.dumps(encoded_results)
-
-    def get_service_results(self, service_key: str, node_ids: list):
+            pipeline.set(redis_key, encode_service_results(results))
+            redis_keys.append(redis_key)
+        self.execute_write_pipeline(pipeline, redis_keys, 'set_service_results')
+
+    def get_service_results(self,
+                            service_key: str,
+                            node_ids: list,
+                            results_format: str = SERVICE_RESULTS_DECODED,
+                            interner: GraphInterner = None):
+        """
+        Look up cached service results for a list of node ids.
+
+        :param service_key: the key the results were cached with
+        :param node_ids: the node ids to look up
+        :param results_format: SERVICE_RESULTS_DECODED for lists of (SimpleEdge, SimpleNode),
+        SERVICE_RESULTS_LAZY for LazyServiceResults which only decode what is accessed,
+        or SERVICE_RESULTS_RAW for the raw cached payloads
+        :param interner: if provided decoded results share their nodes and repeated strings through it
+        :return: a list of results lined up with node_ids, None for nodes with nothing cached
+        """
+        possibly_cached_ids = self.__filter_possibly_cached(node_ids, f'{service_key}-')
         pipeline = self.redis.pipeline()
-        for node_id in node_ids:
+        for node_id in possibly_cached_ids:
             pipeline.get(f'{service_key}-{node_id}')
-        redis_results = pipeline.execute()
-        local_decode_results = self.__decode_service_results
-        decoded_results = list(map(lambda result: local_decode_results(result) if result else None, redis_results))
+        redis_results = self.__execute_pipeline(pipeline, 'get_service_results') if possibly_cached_ids else []
+        self.__record_lookups(service_key, len(node_ids), len(possibly_cached_ids),
+                              sum(1 for redis_result in redis_results if redis_result))
+        if results_format == SERVICE_RESULTS_DECODED:
+            def local_decode_results(redis_result):
+                return [decode_service_result(result, interner) for result in json.loads(redis_result)]
+        elif results_format == SERVICE_RESULTS_LAZY:
+            def local_decode_results(redis_result):
+                return LazyServiceResults(redis_result, interner)
+        elif results_format == SERVICE_RESULTS_RAW:
+            local_decode_results = bytes
+        else:
+            raise ValueError(f'Unknown service results format: {results_format}')
+        with span('json_decode', values=len(redis_results), results_format=results_format):
+            decoded_results = list(map(lambda result: local_decode_results(result) if result else None, redis_results))
+        if len(possibly_cached_ids) < len(node_ids):
+            # definite misses never went to redis, fill them in with None to line the results up with node_ids
+            decoded_results_lookup = dict(zip(possibly_cached_ids, decoded_results))
+            decoded_results = [decoded_results_lookup.get(node_id) for node_id in node_ids]
         return decoded_results
 
-    def __decode_service_results(self, redis_results):
-        decoded_results = []
-        json_object = json.loads(redis_results)
-        for result in json_object:
-            edge_json = result["edge"]
-            edge_object = SimpleEdge(source_id=edge_json['source_id'],
-                                     target_id=edge_json['target_id'],
-                                     provided_by=edge_json['provided_by'],
-                                     input_id=edge_json['input_id'],
-                                     predicate_id=edge_json['predicate_id'],
-                                     predicate_label=edge_json['predicate_label'],
-                                     ctime=edge_json['ctime'],
-                                     properties=edge_json['properties'])
-            # note that right now we're not caching properties or synonyms for service nodes,
-            # properties aren't used yet, synonyms will come from normalization after the fact
-            node_json = result["node"]
-            node_object = SimpleNode(id=node_json["id"],
-                                     type=node_json["category"],
-                                     name=node_json["name"])
-            decoded_results.append((edge_object,
-                                   node_object))
-        return decoded_results
+    def __execute_pipeline(self, pipeline, operation: str):
+        metrics = get_metrics_sink(self.metrics)
+        num_commands = len(pipeline)
+        metrics.observe(CACHE_PIPELINE_COMMANDS, num_commands, operation=operation)
+        with metrics.timer(CACHE_PIPELINE_SECONDS, operation=operation), \
+                span('redis_pipeline', operation=operation, commands=num_commands):
+            return pipeline.execute()
+
+    # num_requested: keys looked up, num_checked: keys that passed the membership filter and were looked up in redis
+    def __record_lookups(self, cache: str, num_requested: int, num_checked: int, num_hits: int):
+        metrics = get_metrics_sink(self.metrics)
+        metrics.increment(CACHE_LOOKUPS, num_hits, cache=cache, result='hit')
+        metrics.increment(CACHE_LOOKUPS, num_checked - num_hits, cache=cache, result='miss')
+        metrics.increment(CACHE_LOOKUPS, num_requested - num_checked, cache=cache, result='filtered')
+
+    def scan_keys_with_prefix(self, prefix: str, count: int = 1000):
+        # SCAN walks the keyspace incrementally so the full key list never has to be held in memory,
+        # unlike KEYS. Glob characters in the prefix are escaped so it is matched literally.
+        escaped_prefix = ''.join(f'\\{c}' if c in '*?[]\\' else c for c in prefix)
+        return self.redis.scan_iter(match=f'{escaped_prefix}*', count=count)
 
     def delete_all_keys_with_prefix(self, prefix: str):
         keys = self.redis.keys(f'{prefix}*')
@@ -1,12 +1,34 @@
 import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from bmt import Toolkit as BiolinkModelToolkit
 
 import robokop_genetics.node_types as node_types
 from robokop_genetics.genetics_cache import GeneticsCache
-from robokop_genetics.services.clingen import ClinGenService, batchable_variant_curie_prefixes
+from robokop_genetics.cache_writer import WriteBehindCacheWriter
+from robokop_genetics.services.clingen import ClinGenService, batchable_variant_curie_prefixes, CLINGEN_URL
+from robokop_genetics.request_coalescing import SingleFlight
+from robokop_genetics.metrics import MetricsSink, get_metrics_sink, NORMALIZATION_VARIANTS, \
+    NORMALIZATION_STAGE_SECONDS
+from robokop_genetics.tracing import get_tracer, span, record_span
+from robokop_genetics.kgx_writer import KGXWriter
 from robokop_genetics.util import LoggingUtil
 
+# the number of variants normalized at a time by write_normalized_variants
+NORMALIZATION_WRITE_CHUNK_SIZE = 100_000
+
+# pipelined normalization works through the variants in chunks this size
+PIPELINE_CHUNK_SIZE = 10_000
+# how many chunks can be looked up in the cache, or waiting on clingen, ahead of the oldest unfinished chunk
+PIPELINE_MAX_CHUNKS_AHEAD = 2
+# single variant clingen lookups run at the same time in pipelined normalization
+PIPELINE_SINGLE_LOOKUP_WORKERS = 8
+
 
 class GeneticsNormalizer:
 
@@ -14,18 +36,59 @@ class GeneticsNormalizer:
                                       logging.INFO,
                                       log_file_path=LoggingUtil.get_logging_path())
 
-    def __init__(self, use_cache: bool = False, bl_version: str = None):
+    def __init__(self,
+                 use_cache: bool = False,
+                 bl_version: str = None,
+                 cache: GeneticsCache = None,
+                 cache_lease_seconds: float = None,
+                 cache_write_behind: bool = False,
+                 metrics: MetricsSink = None,
+                 tracing: bool = None,
+                 clingen_url: str = CLINGEN_URL,
+                 pipelined: bool = False,
+                 pipeline_chunk_size: int = PIPELINE_CHUNK_SIZE,
+                 pipeline_single_lookup_workers: int = PIPELINE_SINGLE_LOOKUP_WORKERS):
+
+        # also used by the clingen service and by the cache if one is created here
+        self.metrics = metrics
+        # if True normalize_variants calls are traced and a summary of where the time went is logged, by default
+        # they're traced if the ROBO_GENETICS_TRACING environment variable is set (see tracing.Tracer)
+        self.tracer = get_tracer(tracing)
 
-        if use_cache:
-            self.cache = GeneticsCache()
+        # a preconfigured cache can be provided instead of one using the default credentials
+        if cache is not None:
+            self.cache = cache
+            self.logger.info('Robokop Genetics Normalizer initialized with provided cache activated.')
+        elif use_cache:
+            self.cache = GeneticsCache(metrics=metrics)
             self.logger.info('Robokop Genetics Normalizer initialized with redis cache activated.')
         else:
             self.cache = None
 
+        # if cache_write_behind is True results are written to the cache in the background while the next batches are
+        # normalized, everything is flushed to the cache before normalize_variants returns, the writer's thread runs until close is called
+        self.cache_writer = WriteBehindCacheWriter(self.cache) if self.cache and cache_write_behind else None
+
+        # if set, variants are leased in the cache while they're normalized so that other workers sharing the cache
+        # don't normalize them at the same time, see __normalize_with_cache_leases
+        self.cache_lease_seconds = cache_lease_seconds
+        self.cache_lease_poll_interval = 0.5
+
+        # if pipelined is True the stages of normalize_variants overlap instead of running one after another,
+        # see __normalize_variants_pipelined, it can't be used together with cache leases
+        if pipelined and self.cache and cache_lease_seconds:
+            raise ValueError('pipelined normalization can not be used together with cache_lease_seconds')
+        self.pipelined = pipelined
+        self.pipeline_chunk_size = pipeline_chunk_size
+        self.pipeline_single_lookup_workers = pipeline_single_lookup_workers
+
+        # coalesces concurrent requests for the same variants within this normalizer
+        self.in_flight_normalizations = SingleFlight()
+
         # lazily load a list of biolink categories ie "biolink:SequenceVariant", "biolink:NamedThing"
         self.sequence_variant_node_types = None
         self.bl_version = bl_version
-        self.clingen = ClinGenService()
+        self.clingen = ClinGenService(metrics=metrics, url=clingen_url)
 
     def get_sequence_variant_node_types(self):
         """
@@ -37,6 +100,10 @@ class GeneticsNormalizer:
         return self.sequence_variant_node_types
 
     def fetch_sequence_variant_node_types(self):
+        with span('biolink_load', bl_version=self.bl_version or 'default'):
+            return self.__fetch_sequence_variant_node_types()
+
+    def __fetch_sequence_variant_node_types(self):
         try:
             if self.bl_version:
                 versioned_biolink_url = (f"https://raw.githubusercontent.com/biolink/biolink-model/"
@@ -54,45 +121,330 @@ class GeneticsNormalizer:
                               f'using defaults. ({e})')
             return [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
 
+    def close(self):
+        """
+        Write everything still pending to the cache and stop the background cache writer. Use the normalizer as a
+        context manager to close it when it's done with.
+        """
+        if self.cache_writer:
+            self.cache_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
     def normalize_variants(self, variant_ids):
         """
         Normalize a list of variants in the most efficient way ie. check the cache, then process in batches if possible.
+
+        Concurrent calls on the same normalizer share work - a variant already being normalized by another thread
+        is waited on instead of being looked up again.
+
         :param variant_ids: a list of variant curie identifiers
         :return: a dictionary of normalization information, with the provided curie list as keys
         """
+        metrics = get_metrics_sink(self.metrics)
+        with self.tracer.profile('normalize_variants'), \
+                self.tracer.trace_run('normalize_variants', variants=len(variant_ids)), \
+                metrics.timer(NORMALIZATION_STAGE_SECONDS, stage='total'):
+            metrics.increment(NORMALIZATION_VARIANTS, len(variant_ids), stage='requested')
+            claimed_variant_ids, in_flight_normalizations = self.in_flight_normalizations.claim(variant_ids)
+            try:
+                all_normalization_results = self.__normalize_variants(claimed_variant_ids) if claimed_variant_ids else {}
+            except BaseException as e:
+                self.in_flight_normalizations.fail(claimed_variant_ids, e)
+                raise
+            self.in_flight_normalizations.resolve(claimed_variant_ids, all_normalization_results)
+
+            if in_flight_normalizations:
+                self.logger.info(f'Batch normalizing waiting on {len(in_flight_normalizations)}/{len(variant_ids)} '
+                                 f'variants already being normalized.')
+                metrics.increment(NORMALIZATION_VARIANTS, len(in_flight_normalizations), stage='in_flight')
+                with metrics.timer(NORMALIZATION_STAGE_SECONDS, stage='in_flight'), \
+                        span('in_flight', variants=len(in_flight_normalizations)):
+                    all_normalization_results.update(self.in_flight_normalizations.wait(in_flight_normalizations))
+        return all_normalization_results
+
+    def write_normalized_variants(self, variant_ids, kgx_writer: KGXWriter,
+                                  chunk_size: int = NORMALIZATION_WRITE_CHUNK_SIZE):
+        """
+        Normalize variants in chunks, writing the normalized nodes to a KGXWriter as each chunk is done, so only one
+        chunk of results is held in memory at a time.
+
+        :param variant_ids: an iterable of variant curie identifiers, eg. a generator reading them from a file
+        :param kgx_writer: where to write the nodes
+        :param chunk_size: the number of variants to normalize at a time
+        :return: the number of nodes written
+        """
+        num_nodes = 0
+        variant_ids = iter(variant_ids)
+        while True:
+            variant_id_chunk = list(islice(variant_ids, chunk_size))
+            if not variant_id_chunk:
+                return num_nodes
+            num_nodes += kgx_writer.write_normalized_variants(self.normalize_variants(variant_id_chunk))
+
+    def __normalize_variants(self, variant_ids: list):
+        if self.pipelined:
+            return self.__normalize_variants_pipelined(variant_ids)
 
         # if there is a cache active, check it for existing results and grab them
+        metrics = get_metrics_sink(self.metrics)
         if self.cache:
-            all_normalization_results = self.cache.get_batch_normalization(variant_ids)
+            with metrics.timer(NORMALIZATION_STAGE_SECONDS, stage='cache_lookup'), \
+                    span('cache_lookup', variants=len(variant_ids)):
+                all_normalization_results = self.cache.get_batch_normalization(variant_ids)
             variants_that_need_normalizing = [variant_id for variant_id in variant_ids if variant_id not in all_normalization_results]
             self.logger.info(f'Batch normalizing found {len(all_normalization_results)}/{len(variant_ids)} results in the cache.')
+            metrics.increment(NORMALIZATION_VARIANTS, len(all_normalization_results), stage='cache_lookup')
         else:
             all_normalization_results = {}
             variants_that_need_normalizing = variant_ids
 
+        if self.cache and self.cache_lease_seconds:
+            all_normalization_results.update(self.__normalize_with_cache_leases(variants_that_need_normalizing))
+        else:
+            all_normalization_results.update(self.__normalize_uncached_variants(variants_that_need_normalizing))
+            if self.cache_writer:
+                with metrics.timer(NORMALIZATION_STAGE_SECONDS, stage='cache_flush'), span('cache_flush'):
+                    self.cache_writer.flush()
+        return all_normalization_results
+
+    def __normalize_variants_pipelined(self, variant_ids: list):
+        # The stages overlap instead of running one after another. A lookup thread checks the cache for the next
+        # chunks while clingen works on earlier ones, each chunk's CAID batch, HGVS batch and single variant lookups
+        # run at the same time, and each of them writes its results to the cache as soon as they arrive. At most
+        # PIPELINE_MAX_CHUNKS_AHEAD chunks are looked up or in flight beyond the oldest unfinished one, so memory
+        # stays bounded. Stages run on other threads, so they're traced as spans recorded with their durations.
+        metrics = get_metrics_sink(self.metrics)
+        # load the node types up front instead of in every stage thread
+        self.get_sequence_variant_node_types()
+        chunks = [variant_ids[i:i + self.pipeline_chunk_size]
+                  for i in range(0, len(variant_ids), self.pipeline_chunk_size)]
+        looked_up_chunks = queue.Queue(maxsize=PIPELINE_MAX_CHUNKS_AHEAD)
+        stop_looking_up = threading.Event()
+        lookup_thread = threading.Thread(target=self.__look_up_chunks,
+                                         args=(chunks, looked_up_chunks, stop_looking_up),
+                                         name='normalization-cache-lookup',
+                                         daemon=True)
+        all_normalization_results = {}
+        num_cached_results = 0
+        in_flight_chunks = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=len(batchable_variant_curie_prefixes) * PIPELINE_MAX_CHUNKS_AHEAD,
+                                    thread_name_prefix='normalization-batch') as batch_executor, \
+                    ThreadPoolExecutor(max_workers=self.pipeline_single_lookup_workers,
+                                       thread_name_prefix='normalization-single') as single_executor:
+                lookup_thread.start()
+                while True:
+                    looked_up_chunk = looked_up_chunks.get()
+                    if looked_up_chunk is None:
+                        break
+                    if isinstance(looked_up_chunk, BaseException):
+                        raise looked_up_chunk
+                    chunk, cached_results, lookup_seconds = looked_up_chunk
+                    if self.cache:
+                        record_span('cache_lookup', lookup_seconds, variants=len(chunk))
+                    num_cached_results += len(cached_results)
+                    all_normalization_results.update(cached_results)
+                    variants_that_need_normalizing = [variant_id for variant_id in chunk
+                                                      if variant_id not in cached_results]
+                    in_flight_chunks.append(self.__submit_pipelined_stages(variants_that_need_normalizing,
+                                                                           batch_executor,
+                                                                           single_executor))
+                    while len(in_flight_chunks) > PIPELINE_MAX_CHUNKS_AHEAD:
+                        self.__collect_pipelined_stages(in_flight_chunks.popleft(), all_normalization_results)
+                while in_flight_chunks:
+                    self.__collect_pipelined_stages(in_flight_chunks.popleft(), all_normalization_results)
+        finally:
+            stop_looking_up.set()
+        if self.cache:
+            self.logger.info(f'Pipelined normalizing found {num_cached_results}/{len(variant_ids)} results in the cache.')
+        if self.cache_writer:
+            with metrics.timer(NORMALIZATION_STAGE_SECONDS, stage='cache_flush'), span('cache_flush'):
+                self.cache_writer.flush()
+        return all_normalization_results
+
+    def __look_up_chunks(self, chunks: list, looked_up_chunks: queue.Queue, stop_looking_up: threading.Event):
+        metrics = get_metrics_sink(self.metrics)
+        try:
+            for chunk in chunks:
+                start_time = time.perf_counter()
+                if self.cache:
+                    with metrics.timer(NORMALIZATION_STAGE_SECONDS, stage='cache_lookup'):
+                        cached_results = self.cache.get_batch_normalization(chunk)
+                    metrics.increment(NORMALIZATION_VARIANTS, len(cached_results), stage='cache_lookup')
+                else:
+                    cached_results = {}
+                looked_up_chunk = (chunk, cached_results, time.perf_counter() - start_time)
+                if not self.__put_looked_up_chunk(looked_up_chunks, looked_up_chunk, stop_looking_up):
+                    return
+            self.__put_looked_up_chunk(looked_up_chunks, None, stop_looking_up)
+        except BaseException as e:
+            self.__put_looked_up_chunk(looked_up_chunks, e, stop_looking_up)
+
+    @staticmethod
+    def __put_looked_up_chunk(looked_up_chunks: queue.Queue, looked_up_chunk, stop_looking_up: threading.Event):
+        # wait for room in the queue, unless the normalization was abandoned and nothing will take from it again
+        while not stop_looking_up.is_set():
+            try:
+                looked_up_chunks.put(looked_up_chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __submit_pipelined_stages(self, variants_that_need_normalizing: list, batch_executor, single_executor):
+        stage_futures = []
+        batched_variant_ids = set()
+        for curie_prefix in batchable_variant_curie_prefixes:
+            batchable_variant_curies = [v_curie for v_curie in variants_that_need_normalizing if v_curie.startswith(curie_prefix)]
+            if batchable_variant_curies:
+                batched_variant_ids.update(batchable_variant_curies)
+                stage_futures.append(batch_executor.submit(self.__run_pipelined_stage,
+                                                           'clingen_batch',
+                                                           self.get_batch_sequence_variant_normalization,
+                                                           batchable_variant_curies))
+        unbatchable_variant_ids = [v_curie for v_curie in variants_that_need_normalizing if v_curie not in batched_variant_ids]
+        # split the single lookups between the workers, each writes its results when it's done
+        num_groups = min(self.pipeline_single_lookup_workers, len(unbatchable_variant_ids))
+        for i in range(num_groups):
+            stage_futures.append(single_executor.submit(self.__run_pipelined_stage,
+                                                        'clingen_single',
+                                                        self.__get_sequence_variant_normalizations,
+                                                        unbatchable_variant_ids[i::num_groups]))
+        return stage_futures
+
+    def __get_sequence_variant_normalizations(self, variant_ids: list):
+        return {variant_id: self.get_sequence_variant_normalization(variant_id) for variant_id in variant_ids}
+
+    def __run_pipelined_stage(self, stage: str, normalize, variant_ids: list):
+        metrics = get_metrics_sink(self.metrics)
+        metrics.increment(NORMALIZATION_VARIANTS, len(variant_ids), stage=stage)
+        start_time = time.perf_counter()
+        with metrics.timer(NORMALIZATION_STAGE_SECONDS, stage=stage):
+            normalization_map = normalize(variant_ids)
+        stage_seconds = time.perf_counter() - start_time
+        write_start_time = time.perf_counter()
+        if self.cache:
+            self.__cache_normalizations(normalization_map)
+        return stage, normalization_map, stage_seconds, time.perf_counter() - write_start_time
+
+    def __collect_pipelined_stages(self, stage_futures: list, all_normalization_results: dict):
+        for stage_future in stage_futures:
+            stage, normalization_map, stage_seconds, write_seconds = stage_future.result()
+            all_normalization_results.update(normalization_map)
+            record_span(stage, stage_seconds, variants=len(normalization_map))
+            if self.cache:
+                record_span('cache_write', write_seconds, variants=len(normalization_map))
+
+    def __normalize_with_cache_leases(self, variant_ids: list):
+        # Lease the variants before normalizing them, so other workers sharing the cache wait for these results
+        # instead of requesting the same variants from clingen. The leases are renewed in the background until the
+        # results are cached, so they only run out if this worker dies. Variants leased by other workers are polled
+        # for in the cache. If a lease expires without a result (the other worker died) the variant is leased again.
+        normalization_results = {}
+        remaining_variant_ids = variant_ids
+        while remaining_variant_ids:
+            leased_variant_ids = self.cache.acquire_normalization_leases(remaining_variant_ids, self.cache_lease_seconds)
+            if leased_variant_ids:
+                stop_renewing = threading.Event()
+                lease_renewer = threading.Thread(target=self.__renew_cache_leases,
+                                                 args=(leased_variant_ids, stop_renewing),
+                                                 name='normalization-lease-renewer',
+                                                 daemon=True)
+                lease_renewer.start()
+                try:
+                    normalization_results.update(self.__normalize_uncached_variants(leased_variant_ids))
+                    # the results have to be in the cache before the leases go, other workers will look for them there
+                    if self.cache_writer:
+                        with get_metrics_sink(self.metrics).timer(NORMALIZATION_STAGE_SECONDS, stage='cache_flush'), \
+                                span('cache_flush'):
+                            self.cache_writer.flush()
+                finally:
+                    stop_renewing.set()
+                    lease_renewer.join()
+                    self.cache.release_normalization_leases(leased_variant_ids)
+
+            leased_elsewhere = [variant_id for variant_id in remaining_variant_ids if variant_id not in normalization_results]
+            if not leased_elsewhere:
+                break
+            if not leased_variant_ids:
+                with span('lease_wait', variants=len(leased_elsewhere)):
+                    time.sleep(self.cache_lease_poll_interval)
+            # the results may have just been written by another worker, so skip the membership filter
+            results_from_elsewhere = self.cache.get_batch_normalization(leased_elsewhere, check_membership_filter=False)
+            get_metrics_sink(self.metrics).increment(NORMALIZATION_VARIANTS, len(results_from_elsewhere),
+                                                     stage='leased_elsewhere')
+            normalization_results.update(results_from_elsewhere)
+            remaining_variant_ids = [variant_id for variant_id in leased_elsewhere if variant_id not in normalization_results]
+            if remaining_variant_ids:
+                self.logger.debug(f'Batch normalizing waiting on {len(remaining_variant_ids)} variants '
+                                  f'leased by other workers.')
+        return normalization_results
+
+    def __renew_cache_leases(self, leased_variant_ids: list, stop_renewing: threading.Event):
+        while leased_variant_ids and not stop_renewing.wait(self.cache_lease_seconds / 3):
+            try:
+                renewed_variant_ids = self.cache.renew_normalization_leases(leased_variant_ids,
+                                                                             self.cache_lease_seconds)
+            except Exception as e:
+                self.logger.error(f'Batch normalizing failed to renew cache leases: {e}')
+                continue
+            if len(renewed_variant_ids) < len(leased_variant_ids):
+                self.logger.warning(f'Batch normalizing lost {len(leased_variant_ids) - len(renewed_variant_ids)} '
+                                    f'cache leases before they could be renewed, other workers may normalize those '
+                                    f'variants too.')
+            leased_variant_ids = renewed_variant_ids
+
+    def __normalize_uncached_variants(self, variants_that_need_normalizing: list):
+        metrics = get_metrics_sink(self.metrics)
+        all_normalization_results = {}
+
         # normalize batches of variants with the same curie prefix because that's how clingen accepts them
         for curie_prefix in batchable_variant_curie_prefixes:
             batchable_variant_curies = [v_curie for v_curie in variants_that_need_normalizing if v_curie.startswith(curie_prefix)]
-            batched_normalizations = self.get_batch_sequence_variant_normalization(batchable_variant_curies)
+            if not batchable_variant_curies:
+                continue
+            metrics.increment(NORMALIZATION_VARIANTS, len(batchable_variant_curies), stage='clingen_batch')
+            with metrics.timer(NORMALIZATION_STAGE_SECONDS, stage='clingen_batch'), \
+                    span('clingen_batch', variants=len(batchable_variant_curies)):
+                batched_normalizations = self.get_batch_sequence_variant_normalization(batchable_variant_curies)
             all_normalization_results.update(batched_normalizations)
             if self.cache:
                 # cache the results if possible
-                self.cache.set_batch_normalization(batched_normalizations)
+                self.__cache_normalizations(batched_normalizations)
 
         # for remaining variants batching is not possible - try to find results one at a time
         unbatchable_variant_ids = [v_curie for v_curie in variants_that_need_normalizing if v_curie not in all_normalization_results]
+        if not unbatchable_variant_ids:
+            return all_normalization_results
+        metrics.increment(NORMALIZATION_VARIANTS, len(unbatchable_variant_ids), stage='clingen_single')
         unbatchable_norm_results = map(self.get_sequence_variant_normalization, unbatchable_variant_ids)
         # this could probably be done more efficiently, we only create unbatchable_norm_result_map for the cache
         unbatchable_norm_result_map = {}
-        for i, result in enumerate(unbatchable_norm_results):
-            if self.cache:
-                unbatchable_norm_result_map[unbatchable_variant_ids[i]] = result
-            all_normalization_results[unbatchable_variant_ids[i]] = result
+        with metrics.timer(NORMALIZATION_STAGE_SECONDS, stage='clingen_single'), \
+                span('clingen_single', variants=len(unbatchable_variant_ids)):
+            for i, result in enumerate(unbatchable_norm_results):
+                if self.cache:
+                    unbatchable_norm_result_map[unbatchable_variant_ids[i]] = result
+                all_normalization_results[unbatchable_variant_ids[i]] = result
         if self.cache:
             # cache the results if possible
-            self.cache.set_batch_normalization(unbatchable_norm_result_map)
+            self.__cache_normalizations(unbatchable_norm_result_map)
         return all_normalization_results
 
+    def __cache_normalizations(self, normalization_map: dict):
+        with get_metrics_sink(self.metrics).timer(NORMALIZATION_STAGE_SECONDS, stage='cache_write'), \
+                span('cache_write', variants=len(normalization_map)):
+            if self.cache_writer:
+                self.cache_writer.set_batch_normalization(normalization_map)
+            else:
+                self.cache.set_batch_normalization(normalization_map)
+
     # variant_curie: the id of the variant that needs normalizing
     def get_sequence_variant_normalization(self, variant_curie: str):
         normalizations = []
@@ -1,13 +1,29 @@
-from robokop_genetics.services.ensembl import EnsemblService
+from robokop_genetics.services.ensembl import EnsemblService, FLANKING_REGION_SIZE
 from robokop_genetics.services.hgnc import HGNCService
 from robokop_genetics.util import LoggingUtil
-from robokop_genetics.genetics_cache import GeneticsCache
+from robokop_genetics.cache_writer import WriteBehindCacheWriter
+from robokop_genetics.genetics_cache import GeneticsCache, LazyServiceResults, SERVICE_RESULTS_DECODED, \
+    SERVICE_RESULTS_LAZY
+from robokop_genetics.edge_batch import EdgeBatchResults
+from robokop_genetics.metrics import MetricsSink, NullMetricsSink
+from robokop_genetics.tracing import get_tracer, span, record_span
+from robokop_genetics.kgx_writer import KGXWriter
 from collections import defaultdict
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
+import multiprocessing
+import os
+import time
 
 
 ENSEMBL = "Ensembl"
 
+VARIANT_TO_GENE_BATCH_SIZE = 10000
+
+# the number of variants annotated at a time by write_variant_to_gene
+VARIANT_TO_GENE_WRITE_CHUNK_SIZE = 100_000
+
 
 class GeneticsServices(object):
 
@@ -15,31 +31,109 @@ class GeneticsServices(object):
                                       logging.INFO,
                                       log_file_path=LoggingUtil.get_logging_path())
 
-    def __init__(self, use_cache: bool = True):
+    def __init__(self,
+                 use_cache: bool = True,
+                 cache: GeneticsCache = None,
+                 cache_write_behind: bool = False,
+                 share_gene_nodes: bool = False,
+                 metrics: MetricsSink = None,
+                 tracing: bool = None):
 
-        if use_cache:
-            self.cache = GeneticsCache()
+        # a preconfigured cache can be provided instead of one using the default credentials
+        if cache is not None:
+            self.cache = cache
+            self.logger.info('Robokop Genetics Services initialized with provided cache activated.')
+        elif use_cache:
+            self.cache = GeneticsCache(metrics=metrics)
             self.logger.info('Robokop Genetics Services initialized with cache activated.')
         else:
             self.cache = None
             self.logger.info('Robokop Genetics Services initialized with no cache activated.')
 
-        self.hgnc = HGNCService()
-        self.ensembl = EnsemblService(temp_dir=LoggingUtil.get_logging_path())
+        # if cache_write_behind is True results are written to the cache in the background while the next batches are
+        # annotated, everything is flushed to the cache before get_variant_to_gene returns, the writer's thread runs until close is called
+        self.cache_writer = WriteBehindCacheWriter(self.cache) if self.cache and cache_write_behind else None
+
+        # if True get_variant_to_gene calls are traced and a summary of where the time went is logged, by default
+        # they're traced if the ROBO_GENETICS_TRACING environment variable is set (see tracing.Tracer)
+        self.tracer = get_tracer(tracing)
+
+        self.hgnc = HGNCService(temp_dir=LoggingUtil.get_logging_path())
+        # if share_gene_nodes is True variant to gene results, from the cache or not, share one read only
+        # FrozenSimpleNode per gene (see EnsemblService), by default every result gets its own mutable SimpleNode
+        # metrics for queries run by worker processes are recorded here, by this service
+        self.ensembl = EnsemblService(temp_dir=LoggingUtil.get_logging_path(),
+                                      share_gene_nodes=share_gene_nodes,
+                                      metrics=metrics)
 
-    def get_variant_to_gene(self, services: list, variant_nodes: list):
+    def close(self):
+        """
+        Write everything still pending to the cache and stop the background cache writer. Use the services as a
+        context manager to close it when it's done with.
+        """
+        if self.cache_writer:
+            self.cache_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    # lazy_cached_results: if True, results found in the cache are returned as LazyServiceResults, and new results
+    # as EdgeBatchResults, which only create edge and node objects when they are accessed, instead of lists of
+    # (SimpleEdge, SimpleNode)
+    #
+    # flanking_region_size, nearest_k and gene_biotypes control which genes are found (see sequence_variant_to_gene),
+    # results are cached separately for each combination of them
+    #
+    # num_workers: if more than 1, variants are annotated in that many processes (see iter_ensembl_variant_to_gene)
+    def get_variant_to_gene(self,
+                            services: list,
+                            variant_nodes: list,
+                            lazy_cached_results: bool = False,
+                            flanking_region_size: int = FLANKING_REGION_SIZE,
+                            nearest_k: int = None,
+                            gene_biotypes: list = None,
+                            num_workers: int = None):
+        with self.tracer.profile('get_variant_to_gene'), \
+                self.tracer.trace_run('get_variant_to_gene', variants=len(variant_nodes)):
+            return self.__get_variant_to_gene(services,
+                                              variant_nodes,
+                                              lazy_cached_results=lazy_cached_results,
+                                              flanking_region_size=flanking_region_size,
+                                              nearest_k=nearest_k,
+                                              gene_biotypes=gene_biotypes,
+                                              num_workers=num_workers)
+
+    def __get_variant_to_gene(self,
+                              services: list,
+                              variant_nodes: list,
+                              lazy_cached_results: bool,
+                              flanking_region_size: int,
+                              nearest_k: int,
+                              gene_biotypes: list,
+                              num_workers: int):
         self.logger.info(f'Get variant to gene called on {len(variant_nodes)} nodes.')
         all_results = defaultdict(list)
         for service in services:
             if self.cache:
-                cache_key = f'{service}_sequence_variant_to_gene'
-                cached_results = self.cache.get_service_results(cache_key, [node.id for node in variant_nodes])
+                cache_key = self.get_variant_to_gene_cache_key(service, flanking_region_size, nearest_k, gene_biotypes)
+                results_format = SERVICE_RESULTS_LAZY if lazy_cached_results else SERVICE_RESULTS_DECODED
+                cached_results = self.cache.get_service_results(cache_key,
+                                                                [node.id for node in variant_nodes],
+                                                                results_format=results_format,
+                                                                interner=self.ensembl.interner)
 
                 nodes_that_need_results = []
                 for i, node in enumerate(variant_nodes):
                     cached_result = cached_results[i]
                     if cached_result is not None:
-                        all_results[node.id].extend(cached_result)
+                        if lazy_cached_results and node.id not in all_results:
+                            all_results[node.id] = cached_result
+                        else:
+                            self.__add_results(all_results, node.id, cached_result)
                     else:
                         nodes_that_need_results.append(node)
                 self.logger.info(f'{service} variant to gene found results for {len(variant_nodes) - len(nodes_that_need_results)} nodes in the cache.')
@@ -47,24 +141,143 @@ class GeneticsServices(object):
                 nodes_that_need_results = variant_nodes
 
             if service == ENSEMBL:
-                new_ensembl_results = {}
-                counter = 0
-                for node in nodes_that_need_results:
-                    variant_id = node.id
-                    variant_syns = node.get_synonyms_by_prefix('ROBO_VARIANT')
-                    new_ensembl_results[variant_id] = self.ensembl.sequence_variant_to_gene(variant_id, variant_syns)
-                    all_results[variant_id].extend(new_ensembl_results[variant_id])
-                    counter += 1
-                    if counter == 10000 and self.cache:
+                # annotate the variants in batches, caching the results after each one
+                for new_ensembl_results in self.iter_ensembl_variant_to_gene(nodes_that_need_results,
+                                                                             num_workers=num_workers,
+                                                                             flanking_region_size=flanking_region_size,
+                                                                             nearest_k=nearest_k,
+                                                                             gene_biotypes=gene_biotypes):
+                    for variant_id, variant_results in new_ensembl_results.items():
+                        if lazy_cached_results and isinstance(variant_results, (LazyServiceResults, EdgeBatchResults)) \
+                                and variant_id not in all_results:
+                            all_results[variant_id] = variant_results
+                        else:
+                            self.__add_results(all_results, variant_id, variant_results)
+                    if self.cache_writer:
+                        self.cache_writer.set_service_results(cache_key, new_ensembl_results)
+                    elif self.cache:
                         self.cache.set_service_results(cache_key, new_ensembl_results)
-                        new_ensembl_results = {}
-                        counter = 0
-
-                if counter > 0 and self.cache:
-                    self.cache.set_service_results(cache_key, new_ensembl_results)
 
+        if self.cache_writer:
+            with span('cache_flush'):
+                self.cache_writer.flush()
         return all_results
 
+    def write_variant_to_gene(self,
+                              services: list,
+                              variant_nodes,
+                              kgx_writer: KGXWriter,
+                              chunk_size: int = VARIANT_TO_GENE_WRITE_CHUNK_SIZE,
+                              **query_parameters):
+        """
+        Annotate variants with nearby genes in chunks, writing the edges and gene nodes to a KGXWriter as each chunk is
+        done, so only one chunk of results is held in memory at a time. Cached results are written without decoding
+        them into edge and node objects first.
+
+        :param services: the services to query (from ALL_VARIANT_TO_GENE_SERVICES)
+        :param variant_nodes: an iterable of SimpleNode sequence variants
+        :param kgx_writer: where to write the edges and gene nodes
+        :param chunk_size: the number of variants to annotate at a time
+        :param query_parameters: optionally flanking_region_size, nearest_k, gene_biotypes and num_workers
+        (see get_variant_to_gene)
+        :return: the number of edges written
+        """
+        num_edges = 0
+        variant_nodes = iter(variant_nodes)
+        while True:
+            variant_node_chunk = list(islice(variant_nodes, chunk_size))
+            if not variant_node_chunk:
+                return num_edges
+            num_edges += kgx_writer.write_variant_to_gene_results(
+                self.get_variant_to_gene(services, variant_node_chunk, lazy_cached_results=True, **query_parameters))
+
+    def iter_ensembl_variant_to_gene(self, variant_nodes: list, num_workers: int = None, **query_parameters):
+        """
+        Annotate variants with nearby genes from Ensembl, yielding the results for each batch of variants as it's done.
+
+        With num_workers > 1 the variants are partitioned by chromosome, larger chromosomes are split into batches of
+        VARIANT_TO_GENE_BATCH_SIZE, and the batches are run by a pool of processes which each memory map the gene
+        index file read only. Batches are yielded in the order they finish, not the order of variant_nodes.
+
+        Results come back as EdgeBatches, so workers send back a few arrays and string tables per batch instead of
+        edge and node objects, and they're cached without creating any.
+
+        :param variant_nodes: a list of SimpleNode sequence variants
+        :param num_workers: the number of processes to use, defaults to running in this process
+        :param query_parameters: optionally flanking_region_size, nearest_k and gene_biotypes
+        :return: an iterator of mappings of variant_id -> results (an EdgeBatch, or a dictionary of empty lists for
+        variants without coordinates), each result a sequence of tuples (edge: SimpleEdge, gene_node: SimpleNode)
+        """
+        variants = [(node.id, node.get_synonyms_by_prefix('ROBO_VARIANT')) for node in variant_nodes]
+        if not num_workers or num_workers <= 1 or len(variants) <= VARIANT_TO_GENE_BATCH_SIZE:
+            for i in range(0, len(variants), VARIANT_TO_GENE_BATCH_SIZE):
+                yield self.ensembl.batch_sequence_variant_to_gene(variants[i:i + VARIANT_TO_GENE_BATCH_SIZE],
+                                                                  as_edge_batch=True,
+                                                                  **query_parameters)
+            return
+
+        variants_by_chromosome = defaultdict(list)
+        variants_without_coordinates = {}
+        for variant_id, variant_synonyms in variants:
+            robokop_coordinates = self.ensembl.get_robokop_variant_coordinates(variant_id, variant_synonyms)
+            if robokop_coordinates is None:
+                variants_without_coordinates[variant_id] = []
+            else:
+                variants_by_chromosome[robokop_coordinates[1]].append((variant_id, variant_synonyms))
+        if variants_without_coordinates:
+            yield variants_without_coordinates
+
+        variant_batches = []
+        for chromosome_variants in variants_by_chromosome.values():
+            for i in range(0, len(chromosome_variants), VARIANT_TO_GENE_BATCH_SIZE):
+                variant_batches.append(chromosome_variants[i:i + VARIANT_TO_GENE_BATCH_SIZE])
+        # start the biggest batches first so the last one to finish isn't a big one
+        variant_batches.sort(key=len, reverse=True)
+
+        # make sure the gene index file exists before the workers try to load it
+        self.ensembl.get_gene_index()
+        self.logger.info(f'Ensembl variant to gene running {len(variant_batches)} batches '
+                         f'in {num_workers} processes.')
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_variant_to_gene_worker,
+                                 initargs=(os.path.dirname(self.ensembl.gene_db_path),
+                                           self.ensembl.gene_index_path)) as executor:
+            variant_batch_futures = [executor.submit(_run_variant_to_gene_worker, variant_batch, query_parameters)
+                                     for variant_batch in variant_batches]
+            for variant_batch_future in as_completed(variant_batch_futures):
+                edge_batch, query_seconds = variant_batch_future.result()
+                self.ensembl.record_variant_to_gene_query('batch_sequence_variant_to_gene', query_seconds,
+                                                          len(edge_batch), edge_batch.num_edges)
+                record_span('ensembl_variant_to_gene_worker', query_seconds,
+                            variants=len(edge_batch), edges=edge_batch.num_edges)
+                # share gene nodes with the results created in this process
+                edge_batch.interner = self.ensembl.interner
+                yield edge_batch
+
+    @staticmethod
+    def get_variant_to_gene_cache_key(service: str,
+                                      flanking_region_size: int = FLANKING_REGION_SIZE,
+                                      nearest_k: int = None,
+                                      gene_biotypes: list = None):
+        # the default query keeps the original key so existing cache entries are still used
+        cache_key = f'{service}_sequence_variant_to_gene'
+        if flanking_region_size != FLANKING_REGION_SIZE:
+            cache_key += f'_window{flanking_region_size}'
+        if nearest_k is not None:
+            cache_key += f'_nearest{nearest_k}'
+        if gene_biotypes is not None:
+            cache_key += f'_biotypes{",".join(sorted(gene_biotypes))}'
+        return cache_key
+
+    @staticmethod
+    def __add_results(all_results: dict, node_id: str, results):
+        existing_results = all_results[node_id]
+        if not isinstance(existing_results, list):
+            # a read only LazyServiceResults from the cache, it needs to become a list to add more
+            existing_results = all_results[node_id] = list(existing_results)
+        existing_results.extend(results)
+
     # service: the service to query (from ALL_VARIANT_TO_GENE_SERVICES)
     # variant_id: plain curie string
     # variant_synonyms: a set of synonym curies
@@ -72,9 +285,10 @@ class GeneticsServices(object):
     # specify the service and provide variant information to find gene relationships
     # results will be in a list of tuples
     # (edge: SimpleEdge, gene_node: SimpleNode)
-    def query_variant_to_gene(self, service: str, variant_id: str, variant_synonyms: set):
+    # query_parameters: optionally flanking_region_size, nearest_k and gene_biotypes (see get_variant_to_gene)
+    def query_variant_to_gene(self, service: str, variant_id: str, variant_synonyms: set, **query_parameters):
         if service == ENSEMBL:
-            return self.ensembl.sequence_variant_to_gene(variant_id, variant_synonyms)
+            return self.ensembl.sequence_variant_to_gene(variant_id, variant_synonyms, **query_parameters)
         else:
             self.logger.warning(f'Service ({service}) not found! Variant to gene failed.')
 
@@ -82,3 +296,28 @@ class GeneticsServices(object):
     # eg. BRCA1 -> HGNC:1100
     def get_gene_id_from_symbol(self, gene_symbol: str):
         return self.hgnc.get_gene_id_from_symbol(gene_symbol)
+
+    # given a list of gene symbols (approved, previous or alias symbols, in any case) return a dictionary of
+    # gene symbol -> GeneSymbolMatch with the HGNC curie, or None for symbols that weren't found
+    # eg. [BRCA1, p53] -> {BRCA1: GeneSymbolMatch(hgnc_id='HGNC:1100', ...), p53: GeneSymbolMatch(hgnc_id='HGNC:11998', ...)}
+    def get_gene_ids_from_symbols(self, gene_symbols: list):
+        return self.hgnc.get_gene_ids_from_symbols(gene_symbols)
+
+
+# each variant to gene worker process loads the gene index file once and keeps it for every batch
+_worker_ensembl_service = None
+
+
+def _init_variant_to_gene_worker(temp_dir: str, gene_index_path: str):
+    global _worker_ensembl_service
+    # the parent process records the metrics for each batch
+    _worker_ensembl_service = EnsemblService(temp_dir=temp_dir, gene_index_path=gene_index_path,
+                                             metrics=NullMetricsSink())
+    _worker_ensembl_service.get_gene_index()
+
+
+def _run_variant_to_gene_worker(variants: list, query_parameters: dict):
+    start_time = time.perf_counter()
+    edge_batch = _worker_ensembl_service.batch_sequence_variant_to_gene(variants, as_edge_batch=True,
+                                                                        **query_parameters)
+    return edge_batch, time.perf_counter() - start_time
@@ -0,0 +1,221 @@
+import gzip
+import json
+import logging
+from collections.abc import Mapping
+
+from robokop_genetics.edge_batch import EdgeBatch, EdgeBatchResults
+from robokop_genetics.genetics_cache import LazyServiceResults
+from robokop_genetics.util import LoggingUtil
+
+# output is collected until a block this size (in characters) is ready, then written (and compressed) at once
+KGX_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# variant to gene edges are written with this predicate, the snpeff effect (eg. upstream_gene_variant) is kept as an
+# edge property
+VARIANT_TO_GENE_PREDICATE = 'biolink:is_nearby_variant_of'
+VARIANT_TO_GENE_KNOWLEDGE_SOURCE = 'infores:ensembl'
+
+
+class KGXJSONLFile(object):
+    """
+    A KGX JSONL file written in large blocks, gzip compressed if the path ends with .gz or compress is True.
+    """
+
+    def __init__(self, file_path: str, compress: bool = None, buffer_size: int = KGX_WRITE_BUFFER_SIZE,
+                 compresslevel: int = 6):
+        self.file_path = file_path
+        if compress is None:
+            compress = file_path.endswith('.gz')
+        if compress:
+            self.output_file = gzip.open(file_path, 'wb', compresslevel=compresslevel)
+        else:
+            self.output_file = open(file_path, 'wb')
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered_size = 0
+        self.num_lines = 0
+
+    def write_line(self, json_line: str):
+        self.buffer.append(json_line)
+        self.buffered_size += len(json_line) + 1
+        self.num_lines += 1
+        if self.buffered_size >= self.buffer_size:
+            self.flush()
+
+    def write(self, record: dict):
+        self.write_line(json.dumps(record))
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.append('')
+            self.output_file.write('\n'.join(self.buffer).encode('utf-8'))
+            self.buffer = []
+            self.buffered_size = 0
+
+    def close(self):
+        if self.output_file.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.output_file.close()
+
+
+class KGXWriter(object):
+    """
+    Streams normalized variant nodes, gene nodes and variant to gene edges to KGX JSONL node and edge files.
+
+    Write results as they're produced, eg. after each normalize_variants or get_variant_to_gene call, and nothing needs
+    to be kept around afterwards. Gene nodes are only written the first time each gene is seen, the set of gene ids
+    written is the only thing that grows, and it's bounded by the number of genes. Variant nodes are written for every
+    normalization result, so a variant normalized from more than one input curie is written more than once.
+
+    Use it as a context manager, or call close, to write out the last block.
+    """
+
+    logger = LoggingUtil.init_logging(__name__,
+                                      logging.INFO,
+                                      log_file_path=LoggingUtil.get_logging_path())
+
+    def __init__(self,
+                 nodes_file_path: str,
+                 edges_file_path: str,
+                 compress: bool = None,
+                 buffer_size: int = KGX_WRITE_BUFFER_SIZE,
+                 variant_to_gene_predicate: str = VARIANT_TO_GENE_PREDICATE,
+                 variant_to_gene_knowledge_source: str = VARIANT_TO_GENE_KNOWLEDGE_SOURCE):
+        """
+        :param nodes_file_path: where to write nodes, eg. nodes.jsonl or nodes.jsonl.gz
+        :param edges_file_path: where to write edges
+        :param compress: whether to gzip the files, by default they're compressed if their path ends with .gz
+        :param buffer_size: how much output to collect before writing it, in characters
+        """
+        self.nodes_file = KGXJSONLFile(nodes_file_path, compress=compress, buffer_size=buffer_size)
+        self.edges_file = KGXJSONLFile(edges_file_path, compress=compress, buffer_size=buffer_size)
+        self.variant_to_gene_predicate = variant_to_gene_predicate
+        self.variant_to_gene_knowledge_source = variant_to_gene_knowledge_source
+        self.written_gene_ids = set()
+        self.num_normalization_errors = 0
+
+    @property
+    def num_nodes(self):
+        return self.nodes_file.num_lines
+
+    @property
+    def num_edges(self):
+        return self.edges_file.num_lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        try:
+            self.nodes_file.close()
+        finally:
+            self.edges_file.close()
+        self.logger.info(f'KGX writer wrote {self.num_nodes} nodes and {self.num_edges} edges '
+                         f'({self.num_normalization_errors} normalization errors skipped).')
+
+    def write_normalized_variants(self, normalization_map: Mapping):
+        """
+        Write a node for each successful normalization, failed normalizations are skipped and counted.
+
+        :param normalization_map: the dictionary of variant curie -> list of normalization dicts from
+        GeneticsNormalizer.normalize_variants
+        :return: the number of nodes written
+        """
+        num_nodes = self.num_nodes
+        for normalizations in normalization_map.values():
+            for normalization in normalizations:
+                if 'id' not in normalization:
+                    self.num_normalization_errors += 1
+                    continue
+                self.nodes_file.write(self.create_variant_node(normalization))
+        return self.num_nodes - num_nodes
+
+    @staticmethod
+    def create_variant_node(normalization: dict):
+        equivalent_identifiers = [normalization['id']]
+        if normalization.get('robokop_variant_id'):
+            equivalent_identifiers.append(normalization['robokop_variant_id'])
+        equivalent_identifiers.extend(normalization.get('equivalent_identifiers') or [])
+        kgx_node = {'id': normalization['id'],
+                    'name': normalization.get('name'),
+                    'category': normalization.get('category'),
+                    'equivalent_identifiers': equivalent_identifiers}
+        if normalization.get('hgvs'):
+            kgx_node['hgvs'] = normalization['hgvs']
+        return kgx_node
+
+    def write_variant_to_gene_results(self, variant_to_gene_results: Mapping):
+        """
+        Write the edges, and any gene nodes not written yet, for variant to gene results.
+
+        Results from the cache (LazyServiceResults) and from EdgeBatches are written straight from the cached json
+        or the batch columns, without creating edge and node objects.
+
+        :param variant_to_gene_results: a mapping of variant_id -> (SimpleEdge, SimpleNode) results like
+        GeneticsServices.get_variant_to_gene returns, or an EdgeBatch
+        :return: the number of edges written
+        """
+        num_edges = self.num_edges
+        if isinstance(variant_to_gene_results, EdgeBatch):
+            # only the latest results for each source, in case a source was added more than once
+            for source_index in variant_to_gene_results.source_lookup.values():
+                self.__write_edge_batch_source(variant_to_gene_results, source_index)
+            return self.num_edges - num_edges
+
+        for variant_results in variant_to_gene_results.values():
+            if isinstance(variant_results, EdgeBatchResults):
+                self.__write_edge_batch_source(variant_results.edge_batch, variant_results.source_index)
+            elif isinstance(variant_results, LazyServiceResults):
+                for result_json in json.loads(variant_results.raw):
+                    edge_json = result_json['edge']
+                    node_json = result_json['node']
+                    if node_json['id'] not in self.written_gene_ids:
+                        self.write_gene_node(node_json['id'], node_json['name'], node_json['category'])
+                    self.edges_file.write(self.create_variant_to_gene_edge(edge_json['source_id'],
+                                                                           edge_json['target_id'],
+                                                                           edge_json['predicate_label'],
+                                                                           edge_json['properties']))
+            else:
+                for edge, node in variant_results:
+                    if node.id not in self.written_gene_ids:
+                        self.write_gene_node(node.id, node.name, node.type)
+                    self.edges_file.write(self.create_variant_to_gene_edge(edge.source_id,
+                                                                           edge.target_id,
+                                                                           edge.predicate_label,
+                                                                           edge.properties))
+        return self.num_edges - num_edges
+
+    def write_gene_node(self, gene_id: str, gene_name: str, gene_type: str):
+        self.written_gene_ids.add(gene_id)
+        self.nodes_file.write({'id': gene_id, 'name': gene_name, 'category': [gene_type]})
+
+    def create_variant_to_gene_edge(self, variant_id: str, gene_id: str, snpeff_effect: str, properties: dict):
+        kgx_edge = {'subject': variant_id,
+                    'predicate': self.variant_to_gene_predicate,
+                    'object': gene_id,
+                    'primary_knowledge_source': self.variant_to_gene_knowledge_source,
+                    'snpeff_effect': snpeff_effect}
+        kgx_edge.update(properties)
+        return kgx_edge
+
+    def __write_edge_batch_source(self, edge_batch: EdgeBatch, source_index: int):
+        source_id = edge_batch.source_ids[source_index]
+        target_ids = edge_batch.target_ids
+        predicates = edge_batch.predicates
+        for edge_index in edge_batch.get_source_edge_range(source_index):
+            target_index = edge_batch.edge_targets[edge_index]
+            target_id = target_ids[target_index]
+            if target_id not in self.written_gene_ids:
+                self.write_gene_node(target_id, edge_batch.target_names[target_index], edge_batch.target_type)
+            self.edges_file.write(
+                self.create_variant_to_gene_edge(source_id,
+                                                 target_id,
+                                                 predicates[edge_batch.edge_predicates[edge_index]][1],
+                                                 {'distance': edge_batch.edge_distances[edge_index]}))
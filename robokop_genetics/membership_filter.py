@@ -0,0 +1,100 @@
+import hashlib
+import math
+import struct
+import threading
+
+MEMBERSHIP_FILTER_FILE_HEADER = b'RGBF'
+MEMBERSHIP_FILTER_FILE_VERSION = 1
+
+
+def get_bit_positions(key: str, num_bits: int, num_hashes: int):
+    """The bits set for a key in a BloomFilter with these parameters, without needing the filter itself"""
+    # double hashing - derive every position from two independent 64 bit hashes of one digest
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    hash_1, hash_2 = struct.unpack('<QQ', digest)
+    return [(hash_1 + i * hash_2) % num_bits for i in range(num_hashes)]
+
+
+class BloomFilter(object):
+    """
+    A bloom filter over string keys.
+
+    It can answer "definitely not present" or "maybe present". The number of bits and hash functions are derived from
+    the expected number of keys (capacity) and the acceptable false positive rate at that capacity.
+
+    Bits are ordered the same way redis orders bits in a string (bit 0 is the most significant bit of byte 0),
+    so the bit array can be mirrored in redis with SETBIT and loaded back with GET.
+    """
+
+    def __init__(self, capacity: int = 10_000_000, error_rate: float = 0.01, num_bits: int = None,
+                 num_hashes: int = None, bit_array: bytearray = None):
+        if not 0 < error_rate < 1:
+            raise ValueError(f'BloomFilter error_rate must be between 0 and 1, not {error_rate}')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = num_bits if num_bits else \
+            max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = num_hashes if num_hashes else \
+            max(1, round(self.num_bits / capacity * math.log(2)))
+        num_bytes = math.ceil(self.num_bits / 8)
+        if bit_array is None:
+            self.bits = bytearray(num_bytes)
+        else:
+            # redis returns a string only as long as the highest bit set so far, pad it out to full size
+            self.bits = bytearray(bit_array[:num_bytes])
+            self.bits.extend(bytes(num_bytes - len(self.bits)))
+        self.lock = threading.Lock()
+
+    def get_bit_positions(self, key: str):
+        return get_bit_positions(key, self.num_bits, self.num_hashes)
+
+    def add(self, key: str):
+        positions = self.get_bit_positions(key)
+        bits = self.bits
+        with self.lock:
+            for position in positions:
+                bits[position >> 3] |= 0x80 >> (position & 7)
+        return positions
+
+    def __contains__(self, key: str):
+        bits = self.bits
+        for position in self.get_bit_positions(key):
+            if not bits[position >> 3] & (0x80 >> (position & 7)):
+                return False
+        return True
+
+    def get_parameters(self):
+        return {'capacity': self.capacity,
+                'error_rate': self.error_rate,
+                'num_bits': self.num_bits,
+                'num_hashes': self.num_hashes}
+
+    def get_memory_size(self):
+        return len(self.bits)
+
+    def save(self, file_path: str):
+        with open(file_path, 'wb') as filter_file:
+            filter_file.write(MEMBERSHIP_FILTER_FILE_HEADER)
+            filter_file.write(struct.pack('<IQdQI',
+                                          MEMBERSHIP_FILTER_FILE_VERSION,
+                                          self.capacity,
+                                          self.error_rate,
+                                          self.num_bits,
+                                          self.num_hashes))
+            filter_file.write(self.bits)
+
+    @classmethod
+    def load(cls, file_path: str):
+        with open(file_path, 'rb') as filter_file:
+            if filter_file.read(len(MEMBERSHIP_FILTER_FILE_HEADER)) != MEMBERSHIP_FILTER_FILE_HEADER:
+                raise ValueError(f'{file_path} is not a membership filter file.')
+            header_format = '<IQdQI'
+            version, capacity, error_rate, num_bits, num_hashes = \
+                struct.unpack(header_format, filter_file.read(struct.calcsize(header_format)))
+            if version != MEMBERSHIP_FILTER_FILE_VERSION:
+                raise ValueError(f'{file_path} has an unsupported membership filter version ({version}).')
+            return cls(capacity=capacity,
+                       error_rate=error_rate,
+                       num_bits=num_bits,
+                       num_hashes=num_hashes,
+                       bit_array=filter_file.read())
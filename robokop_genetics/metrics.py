@@ -0,0 +1,282 @@
+import os
+import math
+import time
+import threading
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+# upper bounds of the histogram buckets, an implicit +Inf bucket is always added
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+MetricDefinition = namedtuple('MetricDefinition', ['type', 'help', 'buckets'])
+
+CLINGEN_REQUESTS = 'robokop_genetics_clingen_requests_total'
+CLINGEN_REQUEST_SECONDS = 'robokop_genetics_clingen_request_seconds'
+CLINGEN_REQUEST_RETRIES = 'robokop_genetics_clingen_request_retries_total'
+CACHE_LOOKUPS = 'robokop_genetics_cache_lookups_total'
+CACHE_PIPELINE_COMMANDS = 'robokop_genetics_cache_pipeline_commands'
+CACHE_PIPELINE_SECONDS = 'robokop_genetics_cache_pipeline_seconds'
+NORMALIZATION_VARIANTS = 'robokop_genetics_normalization_variants_total'
+NORMALIZATION_STAGE_SECONDS = 'robokop_genetics_normalization_stage_seconds'
+ENSEMBL_QUERIES = 'robokop_genetics_ensembl_queries_total'
+ENSEMBL_QUERY_SECONDS = 'robokop_genetics_ensembl_query_seconds'
+ENSEMBL_QUERY_VARIANTS = 'robokop_genetics_ensembl_query_variants_total'
+ENSEMBL_QUERY_RESULTS = 'robokop_genetics_ensembl_query_results_total'
+ENSEMBL_GENE_ANNOTATIONS = 'robokop_genetics_ensembl_gene_annotations_total'
+SERVER_REQUESTS = 'robokop_genetics_server_requests_total'
+SERVER_REQUEST_SECONDS = 'robokop_genetics_server_request_seconds'
+SERVER_BATCH_REQUESTS = 'robokop_genetics_server_batch_requests'
+SERVER_BATCH_VARIANTS = 'robokop_genetics_server_batch_variants'
+WORK_QUEUE_CHUNKS = 'robokop_genetics_work_queue_chunks_total'
+
+# the metrics recorded by this package, metrics not listed here can still be recorded and are exported without help
+METRIC_DEFINITIONS = {
+    CLINGEN_REQUESTS: MetricDefinition(COUNTER, 'ClinGen requests by endpoint, status code and error type.', None),
+    CLINGEN_REQUEST_SECONDS: MetricDefinition(HISTOGRAM, 'ClinGen request latency by endpoint, for each attempt.',
+                                              LATENCY_BUCKETS),
+    CLINGEN_REQUEST_RETRIES: MetricDefinition(COUNTER, 'ClinGen requests retried after a request exception.', None),
+    CACHE_LOOKUPS: MetricDefinition(COUNTER, 'Genetics cache lookups by cache and result (hit, miss or filtered, '
+                                             'a miss found by the membership filter without asking redis).', None),
+    CACHE_PIPELINE_COMMANDS: MetricDefinition(HISTOGRAM, 'Commands in each genetics cache redis pipeline.',
+                                              SIZE_BUCKETS),
+    CACHE_PIPELINE_SECONDS: MetricDefinition(HISTOGRAM, 'Genetics cache redis pipeline durations.', LATENCY_BUCKETS),
+    NORMALIZATION_VARIANTS: MetricDefinition(COUNTER, 'Variants handled by each normalization stage.', None),
+    NORMALIZATION_STAGE_SECONDS: MetricDefinition(HISTOGRAM, 'Time spent in each normalization stage.',
+                                                  LATENCY_BUCKETS),
+    ENSEMBL_QUERIES: MetricDefinition(COUNTER, 'Ensembl variant to gene queries by method.', None),
+    ENSEMBL_QUERY_SECONDS: MetricDefinition(HISTOGRAM, 'Ensembl variant to gene query durations by method.',
+                                            LATENCY_BUCKETS),
+    ENSEMBL_QUERY_VARIANTS: MetricDefinition(COUNTER, 'Variants in Ensembl variant to gene queries.', None),
+    ENSEMBL_QUERY_RESULTS: MetricDefinition(COUNTER, 'Variant to gene results found by Ensembl queries.', None),
+    ENSEMBL_GENE_ANNOTATIONS: MetricDefinition(COUNTER, 'Ensembl gene annotation lookups by where they were found.',
+                                               None),
+    SERVER_REQUESTS: MetricDefinition(COUNTER, 'Server requests by endpoint, lane and status code.', None),
+    SERVER_REQUEST_SECONDS: MetricDefinition(HISTOGRAM, 'Server request latency by endpoint and lane, including the '
+                                                        'time spent waiting for a batch.', LATENCY_BUCKETS),
+    SERVER_BATCH_REQUESTS: MetricDefinition(HISTOGRAM, 'Requests merged into each server batch by endpoint and lane.',
+                                            SIZE_BUCKETS),
+    SERVER_BATCH_VARIANTS: MetricDefinition(HISTOGRAM, 'Distinct variants in each server batch by endpoint and lane.',
+                                            SIZE_BUCKETS),
+    WORK_QUEUE_CHUNKS: MetricDefinition(COUNTER, 'Work queue chunks by event (enqueued, claimed, reclaimed after a lease '
+                                                 'expired, renewed, acknowledged, released, lost to another worker or '
+                                                 'failed).',
+                                        None),
+}
+
+HistogramValue = namedtuple('HistogramValue', ['count', 'sum', 'buckets'])
+
+
+class MetricsSink(object):
+    """
+    Where instrumented code sends metrics. Subclass this to send them somewhere else, eg. a statsd client.
+
+    Labels are keyword arguments, their values are converted to strings.
+    """
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """Add to a counter."""
+        raise NotImplementedError
+
+    def observe(self, name: str, value: float, **labels):
+        """Record one value, eg. a duration in seconds, in a histogram."""
+        raise NotImplementedError
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe how many seconds the block took, even if it raised an exception."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+
+class NullMetricsSink(MetricsSink):
+    """Drops every metric, the default when no sink is configured."""
+
+    def increment(self, name: str, value: float = 1, **labels):
+        pass
+
+    def observe(self, name: str, value: float, **labels):
+        pass
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        yield
+
+
+class MetricsRegistry(MetricsSink):
+    """
+    Keeps metrics in memory, for reading back directly or exporting in the Prometheus text format.
+
+    Safe to share between threads. Metrics recorded in other processes (eg. variant to gene workers) aren't included.
+    """
+
+    def __init__(self, metric_definitions: dict = None):
+        """
+        :param metric_definitions: metric name -> MetricDefinition, for help text and histogram buckets, defaults to
+        METRIC_DEFINITIONS. Histograms without a definition use LATENCY_BUCKETS.
+        """
+        self.metric_definitions = metric_definitions if metric_definitions is not None else METRIC_DEFINITIONS
+        self.lock = threading.Lock()
+        # name -> label items tuple -> value
+        self.counters = {}
+        # name -> label items tuple -> [per bucket counts (the last one is +Inf), count, sum]
+        self.histograms = {}
+
+    @staticmethod
+    def __get_label_key(labels: dict):
+        return tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+
+    def get_buckets(self, name: str):
+        metric_definition = self.metric_definitions.get(name)
+        return metric_definition.buckets if metric_definition and metric_definition.buckets else LATENCY_BUCKETS
+
+    def increment(self, name: str, value: float = 1, **labels):
+        label_key = self.__get_label_key(labels)
+        with self.lock:
+            metric_values = self.counters.setdefault(name, {})
+            metric_values[label_key] = metric_values.get(label_key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        label_key = self.__get_label_key(labels)
+        buckets = self.get_buckets(name)
+        # the first bucket with an upper bound >= value, le is inclusive
+        bucket_index = bisect_left(buckets, value)
+        with self.lock:
+            metric_values = self.histograms.setdefault(name, {})
+            histogram = metric_values.get(label_key)
+            if histogram is None:
+                histogram = metric_values[label_key] = [[0] * (len(buckets) + 1), 0, 0]
+            histogram[0][bucket_index] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def get_counter(self, name: str, **labels):
+        """
+        :return: the counter value with exactly these labels, 0 if it was never incremented
+        """
+        with self.lock:
+            return self.counters.get(name, {}).get(self.__get_label_key(labels), 0)
+
+    def get_counter_total(self, name: str, **labels):
+        """
+        :return: the sum of the counter over every label set that includes these labels
+        """
+        label_items = set(self.__get_label_key(labels))
+        with self.lock:
+            return sum(value for label_key, value in self.counters.get(name, {}).items()
+                       if label_items.issubset(label_key))
+
+    def get_histogram(self, name: str, **labels):
+        """
+        :return: a HistogramValue with the count, sum and cumulative bucket counts (upper bound -> count, the last
+        bound is math.inf), or None if nothing was observed with exactly these labels
+        """
+        with self.lock:
+            histogram = self.histograms.get(name, {}).get(self.__get_label_key(labels))
+            if histogram is None:
+                return None
+            bucket_counts, count, total = list(histogram[0]), histogram[1], histogram[2]
+        cumulative_counts = []
+        cumulative_count = 0
+        for bucket_count in bucket_counts:
+            cumulative_count += bucket_count
+            cumulative_counts.append(cumulative_count)
+        return HistogramValue(count, total, dict(zip(self.get_buckets(name) + (math.inf,), cumulative_counts)))
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_prometheus_text(self):
+        """
+        :return: every metric in the Prometheus text exposition format (version 0.0.4)
+        """
+        with self.lock:
+            counters = {name: dict(metric_values) for name, metric_values in self.counters.items()}
+            histograms = {name: {label_key: (list(histogram[0]), histogram[1], histogram[2])
+                                 for label_key, histogram in metric_values.items()}
+                          for name, metric_values in self.histograms.items()}
+
+        lines = []
+        for name in sorted(counters):
+            self.__add_metadata_lines(lines, name, COUNTER)
+            for label_key, value in sorted(counters[name].items()):
+                lines.append(f'{name}{format_prometheus_labels(label_key)} {format_prometheus_value(value)}')
+        for name in sorted(histograms):
+            self.__add_metadata_lines(lines, name, HISTOGRAM)
+            buckets = self.get_buckets(name)
+            for label_key, (bucket_counts, count, total) in sorted(histograms[name].items()):
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(buckets + (math.inf,), bucket_counts):
+                    cumulative_count += bucket_count
+                    bucket_labels = format_prometheus_labels(label_key + (('le', format_prometheus_value(upper_bound)),))
+                    lines.append(f'{name}_bucket{bucket_labels} {cumulative_count}')
+                lines.append(f'{name}_sum{format_prometheus_labels(label_key)} {format_prometheus_value(total)}')
+                lines.append(f'{name}_count{format_prometheus_labels(label_key)} {count}')
+        return ''.join(f'{line}\n' for line in lines)
+
+    def __add_metadata_lines(self, lines: list, name: str, metric_type: str):
+        metric_definition = self.metric_definitions.get(name)
+        if metric_definition is not None:
+            escaped_help = metric_definition.help.replace('\\', '\\\\').replace('\n', '\\n')
+            lines.append(f'# HELP {name} {escaped_help}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+    def write_prometheus_textfile(self, file_path: str):
+        """
+        Write the metrics to a file for the node exporter textfile collector, or anything else that reads them.
+        The file is replaced atomically so a reader never sees half of it.
+        """
+        temp_file_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(temp_file_path, 'w') as metrics_file:
+            metrics_file.write(self.to_prometheus_text())
+        os.replace(temp_file_path, file_path)
+
+
+def format_prometheus_labels(label_key: tuple):
+    if not label_key:
+        return ''
+    formatted_labels = ','.join(f'{label}="{format_prometheus_label_value(label_value)}"'
+                                for label, label_value in label_key)
+    return f'{{{formatted_labels}}}'
+
+
+def format_prometheus_label_value(label_value: str):
+    return label_value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_prometheus_value(value: float):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+_default_metrics_sink = NullMetricsSink()
+
+
+def set_metrics_sink(metrics_sink: MetricsSink):
+    """
+    Set the sink used by everything in this process that wasn't given its own, None goes back to dropping metrics.
+    """
+    global _default_metrics_sink
+    _default_metrics_sink = metrics_sink if metrics_sink is not None else NullMetricsSink()
+
+
+def get_metrics_sink(metrics_sink: MetricsSink = None):
+    """
+    Every class that records metrics takes an optional sink, and records to it through this, so metrics go to the sink
+    it was given or, if it wasn't given one, to the process wide sink (see set_metrics_sink).
+
+    :return: the provided sink, or the process wide one if it's None
+    """
+    return metrics_sink if metrics_sink is not None else _default_metrics_sink
@@ -0,0 +1,76 @@
+import threading
+
+
+class InFlightLookup(object):
+
+    __slots__ = ('finished', 'found', 'result', 'error')
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.found = False
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent lookups of the same keys within one process.
+
+    A caller claims the keys it needs. Keys nobody else is looking up are returned for the caller to look up itself,
+    keys already being looked up by another caller are returned as InFlightLookups to wait on instead. Whoever claimed
+    a key must call resolve (or fail) for it when they're done, which wakes up everyone waiting on it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def claim(self, keys: list):
+        """
+        :param keys: the keys the caller needs
+        :return: a list of keys claimed by the caller, and a dictionary of keys to InFlightLookups for the rest
+        """
+        claimed_keys = []
+        in_flight_lookups = {}
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                in_flight_lookup = self.in_flight.get(key)
+                if in_flight_lookup is None:
+                    self.in_flight[key] = InFlightLookup()
+                    claimed_keys.append(key)
+                else:
+                    in_flight_lookups[key] = in_flight_lookup
+        return claimed_keys, in_flight_lookups
+
+    def resolve(self, claimed_keys: list, results: dict):
+        with self.lock:
+            finished_lookups = [(key, self.in_flight.pop(key)) for key in claimed_keys]
+        for key, in_flight_lookup in finished_lookups:
+            if key in results:
+                in_flight_lookup.found = True
+                in_flight_lookup.result = results[key]
+            in_flight_lookup.finished.set()
+
+    def fail(self, claimed_keys: list, error: BaseException):
+        with self.lock:
+            finished_lookups = [self.in_flight.pop(key) for key in claimed_keys if key in self.in_flight]
+        for in_flight_lookup in finished_lookups:
+            in_flight_lookup.error = error
+            in_flight_lookup.finished.set()
+
+    @staticmethod
+    def wait(in_flight_lookups: dict):
+        """
+        Wait for lookups claimed by other callers.
+
+        :param in_flight_lookups: the dictionary of InFlightLookups returned by claim
+        :return: a dictionary of keys to results, keys which the other caller didn't find are left out
+        """
+        results = {}
+        for key, in_flight_lookup in in_flight_lookups.items():
+            in_flight_lookup.finished.wait()
+            if in_flight_lookup.error is not None:
+                raise in_flight_lookup.error
+            if in_flight_lookup.found:
+                results[key] = in_flight_lookup.result
+        return results
@@ -0,0 +1,482 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import robokop_genetics.node_types as node_types
+from robokop_genetics.genetics_cache import encode_service_results
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+from robokop_genetics.genetics_services import GeneticsServices
+from robokop_genetics.metrics import MetricsSink, MetricsRegistry, get_metrics_sink, SERVER_REQUESTS, \
+    SERVER_REQUEST_SECONDS, SERVER_BATCH_REQUESTS, SERVER_BATCH_VARIANTS
+from robokop_genetics.services.clingen import CLINGEN_URL
+from robokop_genetics.services.ensembl import FLANKING_REGION_SIZE
+from robokop_genetics.simple_graph_components import SimpleNode
+from robokop_genetics.util import LoggingUtil
+
+# requests are collected for this many seconds after the first one arrives, then processed together
+DEFAULT_BATCH_WINDOW = 0.02
+# small requests go to a separate lane with a shorter window, so interactive callers aren't held up by bulk ones
+DEFAULT_PRIORITY_BATCH_WINDOW = 0.002
+DEFAULT_PRIORITY_MAX_VARIANTS = 10
+# a batch is processed early once this many variants are waiting
+DEFAULT_MAX_BATCH_SIZE = 50_000
+# batches processed at the same time by each lane, while they're busy new requests keep collecting into the next batch
+DEFAULT_MAX_CONCURRENT_BATCHES = 2
+
+MAX_REQUEST_BYTES = 256 * 1024 * 1024
+
+PRIORITY_LANE = 'priority'
+BULK_LANE = 'bulk'
+
+NORMALIZE_ENDPOINT = 'normalize'
+VARIANT_TO_GENE_ENDPOINT = 'variant_to_gene'
+
+
+class BatchRequest(object):
+
+    __slots__ = ('items', 'batch_key', 'finished', 'results', 'error')
+
+    def __init__(self, items: dict, batch_key):
+        self.items = items
+        self.batch_key = batch_key
+        self.finished = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Merges requests submitted by many threads into batches.
+
+    The first pending request opens a window of batch_window seconds, or until max_batch_size items are pending.
+    When it closes, the pending requests with the same batch key are processed together, with one call to
+    process_batch(batch_key, items) on all of their distinct items, and each caller gets back the results for its own
+    items. If process_batch raises, every caller in the batch gets the error.
+
+    Up to max_concurrent_batches batches are processed at once. While they're all busy, new requests keep collecting,
+    so batches get bigger as the load goes up.
+    """
+
+    logger = LoggingUtil.init_logging(__name__,
+                                      logging.INFO,
+                                      log_file_path=LoggingUtil.get_logging_path())
+
+    def __init__(self,
+                 process_batch,
+                 batch_window: float = DEFAULT_BATCH_WINDOW,
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_concurrent_batches: int = DEFAULT_MAX_CONCURRENT_BATCHES,
+                 name: str = 'batcher',
+                 metrics: MetricsSink = None,
+                 metric_labels: dict = None):
+        """
+        :param process_batch: called with a batch key and a dictionary of items, returns a dictionary of results
+        keyed the same way, items without a result are left out of each caller's results
+        :param batch_window: how long to collect requests for, in seconds
+        :param max_batch_size: the number of pending items which closes the window early
+        :param max_concurrent_batches: how many batches can be processed at the same time
+        :param name: used to name the threads
+        :param metrics: batch sizes are recorded here, labeled with metric_labels
+        """
+        self.process_batch = process_batch
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics
+        self.metric_labels = metric_labels or {}
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.num_pending_items = 0
+        # the window starts when the first pending request arrives, even if every batch slot was busy then
+        self.first_pending_time = None
+        self.closed = False
+
+        self.batch_slots = threading.BoundedSemaphore(max_concurrent_batches)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix=name)
+        self.thread = threading.Thread(target=self.__dispatch, name=f'{name}-dispatcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, items: dict, batch_key=None):
+        """
+        Add items to the next batch and wait for their results.
+
+        :param items: a dictionary of item key -> item, eg. variant ids to variant nodes
+        :param batch_key: only items with the same batch key are processed together, eg. for the same query parameters
+        :return: a dictionary of item key -> result
+        """
+        batch_request = BatchRequest(items, batch_key)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('Micro batcher was already closed.')
+            if not self.pending:
+                self.first_pending_time = time.monotonic()
+            self.pending.append(batch_request)
+            self.num_pending_items += len(items)
+            self.condition.notify()
+        batch_request.finished.wait()
+        if batch_request.error is not None:
+            raise batch_request.error
+        return batch_request.results
+
+    def close(self):
+        """
+        Process whatever is pending and stop.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def __dispatch(self):
+        while True:
+            # wait for a free slot first, so requests arriving while every slot is busy join the next batch
+            self.batch_slots.acquire()
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    self.batch_slots.release()
+                    return
+                deadline = self.first_pending_time + self.batch_window
+                while self.num_pending_items < self.max_batch_size and not self.closed:
+                    remaining_time = deadline - time.monotonic()
+                    if remaining_time <= 0:
+                        break
+                    self.condition.wait(remaining_time)
+                batch_requests = self.__take_pending()
+            try:
+                self.__submit_batches(batch_requests)
+            except Exception as e:
+                # nothing was submitted yet (see __submit_batches), so these requests fail instead of the dispatcher
+                self.logger.error(f'Batching {len(batch_requests)} requests failed: {e}')
+                for batch_request in batch_requests:
+                    batch_request.error = e
+                    batch_request.finished.set()
+                self.batch_slots.release()
+
+    def __take_pending(self):
+        # take requests up to max_batch_size items (at least one request, even a bigger one), the rest wait
+        num_items = 0
+        num_requests = 0
+        for batch_request in self.pending:
+            if num_requests and num_items + len(batch_request.items) > self.max_batch_size:
+                break
+            num_items += len(batch_request.items)
+            num_requests += 1
+        batch_requests = self.pending[:num_requests]
+        self.pending = self.pending[num_requests:]
+        self.num_pending_items -= num_items
+        self.first_pending_time = time.monotonic()
+        return batch_requests
+
+    def __submit_batches(self, batch_requests: list):
+        # the requests are all grouped before any batch is submitted, so a bad batch key can't leave some requests
+        # submitted and the others waiting
+        requests_by_batch_key = {}
+        for batch_request in batch_requests:
+            requests_by_batch_key.setdefault(batch_request.batch_key, []).append(batch_request)
+        for i, (batch_key, key_batch_requests) in enumerate(requests_by_batch_key.items()):
+            # the dispatcher already holds a slot for the first batch
+            if i:
+                self.batch_slots.acquire()
+            self.executor.submit(self.__process, batch_key, key_batch_requests)
+
+    def __process(self, batch_key, batch_requests: list):
+        try:
+            batch_items = {}
+            for batch_request in batch_requests:
+                for item_key, item in batch_request.items.items():
+                    batch_items.setdefault(item_key, item)
+            metrics = get_metrics_sink(self.metrics)
+            metrics.observe(SERVER_BATCH_REQUESTS, len(batch_requests), **self.metric_labels)
+            metrics.observe(SERVER_BATCH_VARIANTS, len(batch_items), **self.metric_labels)
+            try:
+                batch_results = self.process_batch(batch_key, batch_items)
+            except Exception as e:
+                self.logger.error(f'Batch of {len(batch_items)} items for {len(batch_requests)} requests failed: {e}')
+                for batch_request in batch_requests:
+                    batch_request.error = e
+            else:
+                for batch_request in batch_requests:
+                    batch_request.results = {item_key: batch_results[item_key] for item_key in batch_request.items
+                                             if item_key in batch_results}
+        finally:
+            for batch_request in batch_requests:
+                batch_request.finished.set()
+            self.batch_slots.release()
+
+
+def is_list_of_strings(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def is_optional_count(value):
+    # bools are ints in python, but not in JSON
+    return value is None or (isinstance(value, int) and not isinstance(value, bool) and value >= 0)
+
+
+class RequestError(Exception):
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GeneticsServer(ThreadingHTTPServer):
+    """
+    An HTTP server for normalize_variants and get_variant_to_gene, which merges concurrent requests into batches.
+
+    Concurrent requests are collected by a MicroBatcher for each endpoint, so a burst of small requests becomes one
+    cache lookup and one ClinGen batch per curie prefix, instead of one for each request. Requests with at most
+    priority_max_variants variants go to a priority lane with a shorter window and their own batch threads.
+
+        POST /normalize {"curies": ["CAID:CA123", ...]}
+        POST /variant_to_gene {"variants": [{"id": "CAID:CA123", "synonyms": ["ROBO_VARIANT:HG38|..."]}, ...],
+                               "services": ["Ensembl"], "flanking_region_size": 500000, "nearest_k": 3}
+        GET /health
+        GET /metrics
+
+    Both POST endpoints answer with {"results": {variant id: results}}, normalizations as from normalize_variants and
+    variant to gene results in their cached JSON form. /metrics is the Prometheus text for the metrics registry, if
+    there is one.
+    """
+
+    daemon_threads = True
+
+    logger = LoggingUtil.init_logging(__name__,
+                                      logging.INFO,
+                                      log_file_path=LoggingUtil.get_logging_path())
+
+    def __init__(self,
+                 server_address: tuple,
+                 normalizer: GeneticsNormalizer,
+                 genetics_services: GeneticsServices = None,
+                 batching: bool = True,
+                 batch_window: float = DEFAULT_BATCH_WINDOW,
+                 priority_batch_window: float = DEFAULT_PRIORITY_BATCH_WINDOW,
+                 priority_max_variants: int = DEFAULT_PRIORITY_MAX_VARIANTS,
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_concurrent_batches: int = DEFAULT_MAX_CONCURRENT_BATCHES,
+                 metrics: MetricsSink = None):
+        """
+        :param server_address: (host, port), port 0 picks a free port
+        :param normalizer: the GeneticsNormalizer used for /normalize
+        :param genetics_services: the GeneticsServices used for /variant_to_gene, which is off without it
+        :param batching: if False each request is processed on its own, as it arrives
+        :param metrics: request counts and latencies, and batch sizes, are recorded here
+        """
+        super().__init__(server_address, GeneticsRequestHandler)
+        self.normalizer = normalizer
+        self.genetics_services = genetics_services
+        self.batching = batching
+        self.priority_max_variants = priority_max_variants
+        self.metrics = metrics
+
+        self.batch_processors = {NORMALIZE_ENDPOINT: self.normalize_batch}
+        if genetics_services is not None:
+            self.batch_processors[VARIANT_TO_GENE_ENDPOINT] = self.variant_to_gene_batch
+        self.batchers = {}
+        if batching:
+            for endpoint, process_batch in self.batch_processors.items():
+                for lane, lane_batch_window in ((PRIORITY_LANE, priority_batch_window), (BULK_LANE, batch_window)):
+                    self.batchers[(endpoint, lane)] = MicroBatcher(process_batch,
+                                                                   batch_window=lane_batch_window,
+                                                                   max_batch_size=max_batch_size,
+                                                                   max_concurrent_batches=max_concurrent_batches,
+                                                                   name=f'{endpoint}-{lane}',
+                                                                   metrics=metrics,
+                                                                   metric_labels={'endpoint': endpoint, 'lane': lane})
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/'
+
+    def get_lane(self, items: dict):
+        return PRIORITY_LANE if len(items) <= self.priority_max_variants else BULK_LANE
+
+    def process(self, endpoint: str, lane: str, items: dict, batch_key=None):
+        if not self.batching:
+            return self.batch_processors[endpoint](batch_key, items)
+        return self.batchers[(endpoint, lane)].submit(items, batch_key)
+
+    def normalize_batch(self, batch_key, curies: dict):
+        return self.normalizer.normalize_variants(list(curies))
+
+    def variant_to_gene_batch(self, batch_key, variant_nodes: dict):
+        services, flanking_region_size, nearest_k, gene_biotypes = batch_key
+        variant_to_gene_results = self.genetics_services.get_variant_to_gene(
+            list(services),
+            list(variant_nodes.values()),
+            lazy_cached_results=True,
+            flanking_region_size=flanking_region_size,
+            nearest_k=nearest_k,
+            gene_biotypes=list(gene_biotypes) if gene_biotypes is not None else None)
+        # encoded here, on the batch thread, each request only joins the JSON for its own variants
+        return {variant_id: encode_service_results(variant_results)
+                for variant_id, variant_results in variant_to_gene_results.items()}
+
+    def server_close(self):
+        super().server_close()
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+class GeneticsRequestHandler(BaseHTTPRequestHandler):
+
+    # keep connections open between requests from the same client
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            metrics = get_metrics_sink(self.server.metrics)
+            if isinstance(metrics, MetricsRegistry):
+                self.send_body(200, metrics.to_prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4')
+            else:
+                self.send_json(404, {'error': 'Metrics are not being kept.'})
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}.'})
+
+    def do_POST(self):
+        start_time = time.perf_counter()
+        endpoint = self.path.strip('/')
+        lane = 'none'
+        try:
+            if endpoint not in self.server.batch_processors:
+                raise RequestError(404, f'Unknown path {self.path}.')
+            request_json = self.read_json()
+            if endpoint == NORMALIZE_ENDPOINT:
+                items, batch_key = self.parse_normalize_request(request_json)
+            else:
+                items, batch_key = self.parse_variant_to_gene_request(request_json)
+            lane = self.server.get_lane(items)
+            try:
+                results = self.server.process(endpoint, lane, items, batch_key)
+            except Exception as e:
+                raise RequestError(500, f'{type(e).__name__}: {e}')
+            if endpoint == NORMALIZE_ENDPOINT:
+                response_body = json.dumps({'results': results})
+            else:
+                # results are already encoded, variants without results get an empty list
+                response_body = '{"results": {' + ', '.join(f'{json.dumps(variant_id)}: {results.get(variant_id, "[]")}'
+                                                             for variant_id in items) + '}}'
+            status_code = 200
+        except RequestError as e:
+            status_code = e.status_code
+            response_body = json.dumps({'error': str(e)})
+        # recorded before the response is sent, so they're up to date once the caller has it
+        metrics = get_metrics_sink(self.server.metrics)
+        metrics.increment(SERVER_REQUESTS, endpoint=endpoint, lane=lane, status_code=str(status_code))
+        metrics.observe(SERVER_REQUEST_SECONDS, time.perf_counter() - start_time, endpoint=endpoint, lane=lane)
+        self.send_body(status_code, response_body.encode('utf-8'), 'application/json')
+
+    def read_json(self):
+        content_length = int(self.headers.get('Content-Length') or 0)
+        if content_length > MAX_REQUEST_BYTES:
+            raise RequestError(413, f'Requests are limited to {MAX_REQUEST_BYTES} bytes.')
+        try:
+            return json.loads(self.rfile.read(content_length))
+        except ValueError as e:
+            raise RequestError(400, f'Invalid JSON: {e}')
+
+    @staticmethod
+    def parse_normalize_request(request_json):
+        curies = request_json.get('curies') if isinstance(request_json, dict) else None
+        if not isinstance(curies, list) or not all(isinstance(curie, str) for curie in curies):
+            raise RequestError(400, 'Expected {"curies": [variant curies]}.')
+        return dict.fromkeys(curies), None
+
+    @staticmethod
+    def parse_variant_to_gene_request(request_json):
+        variants = request_json.get('variants') if isinstance(request_json, dict) else None
+        if not isinstance(variants, list):
+            raise RequestError(400, 'Expected {"variants": [{"id": variant id, "synonyms": [variant synonyms]}]}.')
+        variant_nodes = {}
+        for variant in variants:
+            if not isinstance(variant, dict) or not isinstance(variant.get('id'), str):
+                raise RequestError(400, 'Every variant needs an id.')
+            if not is_list_of_strings(variant.get('synonyms') or []) or not isinstance(variant.get('name', ''), str):
+                raise RequestError(400, 'Variant synonyms need to be a list of strings, and names a string.')
+            variant_nodes[variant['id']] = SimpleNode(variant['id'],
+                                                      node_types.SEQUENCE_VARIANT,
+                                                      variant.get('name', ''),
+                                                      synonyms=set(variant.get('synonyms') or []))
+        services = request_json.get('services') or ['Ensembl']
+        gene_biotypes = request_json.get('gene_biotypes')
+        flanking_region_size = request_json.get('flanking_region_size')
+        nearest_k = request_json.get('nearest_k')
+        if not is_list_of_strings(services) or (gene_biotypes is not None and not is_list_of_strings(gene_biotypes)):
+            raise RequestError(400, 'services and gene_biotypes need to be lists of strings.')
+        if not is_optional_count(flanking_region_size) or not is_optional_count(nearest_k):
+            raise RequestError(400, 'flanking_region_size and nearest_k need to be whole numbers, at least 0.')
+        # requests are only batched with others that have the same query parameters
+        batch_key = (tuple(services),
+                     flanking_region_size if flanking_region_size is not None else FLANKING_REGION_SIZE,
+                     nearest_k,
+                     tuple(gene_biotypes) if gene_biotypes is not None else None)
+        return variant_nodes, batch_key
+
+    def send_json(self, status_code: int, response_json):
+        self.send_body(status_code, json.dumps(response_json).encode('utf-8'), 'application/json')
+
+    def send_body(self, status_code: int, response_body: bytes, content_type: str):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, message_format: str, *args):
+        self.server.logger.debug(message_format % args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve variant normalization and variant to gene lookups over HTTP, '
+                                                 'merging concurrent requests into batches.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--use-cache', action='store_true', help='use the cache configured by the ROBO_GENETICS_CACHE '
+                                                                 'environment variables')
+    parser.add_argument('--clingen-url', default=CLINGEN_URL)
+    parser.add_argument('--variant-to-gene', action='store_true', help='also serve /variant_to_gene')
+    parser.add_argument('--no-batching', action='store_true', help='process each request on its own')
+    parser.add_argument('--batch-window', type=float, default=DEFAULT_BATCH_WINDOW)
+    parser.add_argument('--priority-batch-window', type=float, default=DEFAULT_PRIORITY_BATCH_WINDOW)
+    parser.add_argument('--priority-max-variants', type=int, default=DEFAULT_PRIORITY_MAX_VARIANTS)
+    parser.add_argument('--max-batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    args = parser.parse_args()
+
+    metrics_registry = MetricsRegistry()
+    genetics_normalizer = GeneticsNormalizer(use_cache=args.use_cache,
+                                             cache_write_behind=True,
+                                             metrics=metrics_registry,
+                                             clingen_url=args.clingen_url)
+    variant_to_gene_services = None
+    if args.variant_to_gene:
+        variant_to_gene_services = GeneticsServices(use_cache=args.use_cache, cache_write_behind=True,
+                                                    metrics=metrics_registry)
+    genetics_server = GeneticsServer((args.host, args.port),
+                                     genetics_normalizer,
+                                     genetics_services=variant_to_gene_services,
+                                     batching=not args.no_batching,
+                                     batch_window=args.batch_window,
+                                     priority_batch_window=args.priority_batch_window,
+                                     priority_max_variants=args.priority_max_variants,
+                                     max_batch_size=args.max_batch_size,
+                                     metrics=metrics_registry)
+    genetics_server.logger.info(f'Genetics server listening on {genetics_server.url}')
+    try:
+        genetics_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        genetics_server.server_close()
+        genetics_normalizer.close()
+        if variant_to_gene_services:
+            variant_to_gene_services.close()
@@ -1,9 +1,14 @@
 from robokop_genetics.util import Text, LoggingUtil
+from robokop_genetics.metrics import MetricsSink, get_metrics_sink, CLINGEN_REQUESTS, CLINGEN_REQUEST_SECONDS, \
+    CLINGEN_REQUEST_RETRIES
+from robokop_genetics.tracing import span, NULL_SPAN
+from robokop_genetics.variant_keys import RobokopVariant, format_robokop_variant_id
 from math import ceil
 from dataclasses import dataclass
 from json.decoder import JSONDecodeError
 
 import logging
+import time
 import requests
 
 # other classes should check this list before calling get_batch_of_synonyms
@@ -17,6 +22,8 @@ curie_to_post_param_lookup = {
 
 CLINGEN_BATCH_SIZE = 500_000
 
+CLINGEN_URL = 'https://reg.genome.network/'
+
 
 @dataclass
 class ClinGenQueryResponse:
@@ -32,6 +39,8 @@ class ClinGenSynonymizationResult:
     id: str = None
     name: str = None
     robokop_variant_id: str = None
+    # the fields of robokop_variant_id
+    robokop_variant: RobokopVariant = None
     hgvs: list = None
     equivalent_identifiers: list = None
     error_type: str = None
@@ -44,8 +53,10 @@ class ClinGenService(object):
                                       logging.INFO,
                                       log_file_path=LoggingUtil.get_logging_path())
 
-    def __init__(self):
-        self.url = 'https://reg.genome.network/'
+    # url: the ClinGen allele registry to use, eg. a mirror or a stand-in for testing
+    def __init__(self, metrics: MetricsSink = None, url: str = CLINGEN_URL):
+        self.url = url if url.endswith('/') else f'{url}/'
+        self.metrics = metrics
         self.synon_fields_param = 'fields=none+@id+' \
                                   'externalRecords.dbSNP.rs+' \
                                   'externalRecords.ClinVarVariations.variationId+' \
@@ -82,12 +93,15 @@ class ClinGenService(object):
             variant_subset = variant_id_list[i * CLINGEN_BATCH_SIZE:i * CLINGEN_BATCH_SIZE + CLINGEN_BATCH_SIZE]
             variant_pseudo_file = separator.join(variant_subset)
             query_url = f'{self.url}alleles?file={variant_format_param}&{self.synon_fields_param}'
-            query_response: ClinGenQueryResponse = self.query_service(query_url, data=variant_pseudo_file)
+            query_response: ClinGenQueryResponse = self.query_service(query_url,
+                                                                      data=variant_pseudo_file,
+                                                                      endpoint=f'batch_{variant_format_param}')
             if query_response.success:
-                for allele_json in query_response.response_json:
-                    parsed_result = self.parse_result(allele_json)
-                    if parsed_result is not None:
-                        normalization_results.append(parsed_result)
+                with span('parse_result', alleles=len(query_response.response_json)):
+                    for allele_json in query_response.response_json:
+                        parsed_result = self.parse_result(allele_json)
+                        if parsed_result is not None:
+                            normalization_results.append(parsed_result)
             else:
                 for j in range(len(variant_subset)):
                     normalization_results.append(ClinGenSynonymizationResult(success=False,
@@ -125,7 +139,7 @@ class ClinGenService(object):
     def get_synonyms_by_parameter_matching(self, url_param: str, url_param_value: str, allele_preference: str = None):
         synonymization_results: list[ClinGenSynonymizationResult] = []
         query_url = f'{self.url}alleles?{url_param}={url_param_value}&{self.synon_fields_param}'
-        query_response = self.query_service(query_url)
+        query_response = self.query_service(query_url, endpoint=url_param)
         if not query_response.success:
             synonymization_results.append(ClinGenSynonymizationResult(success=False,
                                                                       error_type=query_response.error_type,
@@ -136,10 +150,11 @@ class ClinGenService(object):
                                                                           error_type='NotFound',
                                                                           error_message='Clingen returned a 200 status but no results.'))
             else:
-                for response_item in query_response.response_json:
-                    parsed_result = self.parse_result(response_item)
-                    if parsed_result is not None:
-                        synonymization_results.append(parsed_result)
+                with span('parse_result', alleles=len(query_response.response_json)):
+                    for response_item in query_response.response_json:
+                        parsed_result = self.parse_result(response_item)
+                        if parsed_result is not None:
+                            synonymization_results.append(parsed_result)
                 # If there is an allele preference, use the generated robokop_variant_id to determine if clingen
                 # results match that specific allele. Filter the results and return only the matching ones, if they
                 # exist, otherwise return all results even if they don't match.
@@ -147,17 +162,15 @@ class ClinGenService(object):
                     filtered_syn_results = []
                     for syn_result in synonymization_results:
                         if syn_result.success:
-                            robokop_variant_id = syn_result.robokop_variant_id
-                            if robokop_variant_id:
-                                actual_allele = robokop_variant_id.split('|')[-1]
-                                if actual_allele == allele_preference:
-                                    filtered_syn_results.append(syn_result)
+                            robokop_variant = syn_result.robokop_variant
+                            if robokop_variant and robokop_variant.alternate_allele == allele_preference:
+                                filtered_syn_results.append(syn_result)
                     if filtered_syn_results:
                         return filtered_syn_results
         return synonymization_results
 
     def parse_result(self, allele_json: dict):
-        robokop_variant_id = None
+        robokop_variant = robokop_variant_id = None
         equivalent_identifiers = set()
         hgvs = set()
         if "errorType" in allele_json:
@@ -202,8 +215,9 @@ class ClinGenService(object):
                             chromosome = genomic_allele['chromosome']
                             start_position = genomic_allele['coordinates'][0]['start']
                             end_position = genomic_allele['coordinates'][0]['end']
-                            robokop_variant = f'HG38|{chromosome}|{start_position}|{end_position}|{reference}|{sequence}'
-                            robokop_variant_id = f'ROBO_VARIANT:{robokop_variant}'
+                            robokop_variant = RobokopVariant('HG38', chromosome, start_position, end_position,
+                                                             reference, sequence)
+                            robokop_variant_id = format_robokop_variant_id(robokop_variant)
 
             except KeyError as e:
                 error_message = f'parsing sequence variant synonym - genomicAlleles KeyError for {variant_caid}: {e}'
@@ -227,6 +241,7 @@ class ClinGenService(object):
                                                             id=variant_id,
                                                             name=variant_name,
                                                             robokop_variant_id=robokop_variant_id,
+                                                            robokop_variant=robokop_variant,
                                                             hgvs=list(hgvs),
                                                             equivalent_identifiers=list(equivalent_identifiers))
         return synonymization_result
@@ -258,37 +273,62 @@ class ClinGenService(object):
         return return_results
     """
 
-    def query_service(self, query_url, data=None, retries=1):
+    # endpoint: labels the request metrics, eg. batch_hgvs or dbSNP.rs, defaults to batch or lookup
+    def query_service(self, query_url, data=None, retries=1, endpoint: str = None):
+        if endpoint is None:
+            endpoint = 'batch' if data else 'lookup'
+        metrics = get_metrics_sink(self.metrics)
+        start_time = time.perf_counter()
+        with span('clingen_http', endpoint=endpoint, request_bytes=len(data) if data else 0) as http_span:
+            query_response = self.__query_service(query_url, data, http_span)
+        metrics.observe(CLINGEN_REQUEST_SECONDS, time.perf_counter() - start_time, endpoint=endpoint)
+        if isinstance(query_response, requests.exceptions.RequestException):
+            metrics.increment(CLINGEN_REQUESTS, endpoint=endpoint, status='none', error_type='RequestException')
+            self.logger.error(f'Clingen service caught a request exception ({query_response}) '
+                              f'on attempt number {retries}..')
+            if retries == 3:
+                return ClinGenQueryResponse(success=False, error_type='RequestException',
+                                            error_message=str(query_response))
+            else:
+                metrics.increment(CLINGEN_REQUEST_RETRIES, endpoint=endpoint)
+                return self.query_service(query_url, data, retries + 1, endpoint=endpoint)
+        status_code, query_response = query_response
+        metrics.increment(CLINGEN_REQUESTS,
+                          endpoint=endpoint,
+                          status=status_code,
+                          error_type=query_response.error_type if not query_response.success else '')
+        return query_response
+
+    # returns the response status code and a ClinGenQueryResponse, or the exception if the request failed
+    def __query_service(self, query_url, data=None, http_span=NULL_SPAN):
         try:
             if data:
                 query_response = requests.post(query_url, data=data)
             else:
                 query_response = requests.get(query_url)
-            response_status_code = query_response.status_code
-            try:
-                if response_status_code == 200:
-                    response_json = query_response.json()
-                    return ClinGenQueryResponse(success=True,
-                                                response_json=response_json)
-                else:
-                    error_json = query_response.json()
-                    cg_error_type = error_json["errorType"]
-                    cg_error_description = error_json["description"]
-                    cg_error_description += error_json["message"] if "message" in error_json else ""
-                    # error_message = f'ClinGen returned a non-200 response calling ({query_url}):'
-                    # error_message += f'{cg_error_type} - {cg_error_description} - {cg_error_message}'
-                    # self.logger.error(error_message)
-                    return ClinGenQueryResponse(success=False,
-                                                error_type=cg_error_type,
-                                                error_message=cg_error_description)
-            except JSONDecodeError:
-                return ClinGenQueryResponse(success=False,
-                                            error_type='JSONDecodeError',
-                                            error_message=f'Non-JSON result returned by Clingen. {query_response.text[:100]}')
-
         except requests.exceptions.RequestException as re:
-            self.logger.error(f'Clingen service caught a request exception ({re}) on attempt number {retries}..')
-            if retries == 3:
-                return ClinGenQueryResponse(success=False, error_type='RequestException', error_message=str(re))
+            return re
+        response_status_code = query_response.status_code
+        http_span.set(status=str(response_status_code), response_bytes=len(query_response.content))
+        try:
+            if response_status_code == 200:
+                with span('json_decode', bytes=len(query_response.content)):
+                    response_json = query_response.json()
+                return response_status_code, ClinGenQueryResponse(success=True,
+                                                                  response_json=response_json)
             else:
-                return self.query_service(query_url, data, retries + 1)
+                error_json = query_response.json()
+                cg_error_type = error_json["errorType"]
+                cg_error_description = error_json["description"]
+                cg_error_description += error_json["message"] if "message" in error_json else ""
+                # error_message = f'ClinGen returned a non-200 response calling ({query_url}):'
+                # error_message += f'{cg_error_type} - {cg_error_description} - {cg_error_message}'
+                # self.logger.error(error_message)
+                return response_status_code, ClinGenQueryResponse(success=False,
+                                                                  error_type=cg_error_type,
+                                                                  error_message=cg_error_description)
+        except JSONDecodeError:
+            return response_status_code, ClinGenQueryResponse(success=False,
+                                                              error_type='JSONDecodeError',
+                                                              error_message=f'Non-JSON result returned by Clingen. '
+                                                                            f'{query_response.text[:100]}')
@@ -1,9 +1,21 @@
 from robokop_genetics import node_types
-from robokop_genetics.simple_graph_components import SimpleNode, SimpleEdge
+from robokop_genetics.simple_graph_components import SimpleEdge, GraphInterner
+from robokop_genetics.edge_batch import EdgeBatch
+from robokop_genetics.services.gene_index import GeneIntervalIndex
 from robokop_genetics.util import Text, LoggingUtil
-from collections import namedtuple
+from robokop_genetics.tracing import span
+from robokop_genetics.variant_keys import parse_robokop_variant_id
+from robokop_genetics.metrics import MetricsSink, get_metrics_sink, ENSEMBL_QUERIES, ENSEMBL_QUERY_SECONDS, \
+    ENSEMBL_QUERY_VARIANTS, ENSEMBL_QUERY_RESULTS, ENSEMBL_GENE_ANNOTATIONS
+from array import array
+from datetime import datetime, timezone
+from collections import namedtuple, defaultdict, OrderedDict
+from itertools import islice
+from operator import itemgetter
 import logging
 import sqlite3
+import threading
+import time
 import os
 import requests
 
@@ -12,6 +24,19 @@ import requests
 # but it hasn't been used in a long time. It's been replaced by running SNPEFF in ORION.
 ###
 
+# the number of genes inserted per transaction when building the genes db
+GENES_DB_CHUNK_SIZE = 50_000
+# bytes read at a time when streaming biomart gene data
+BIOMART_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# the max number of ensembl ids in one gene annotation query, under the sqlite limit on query parameters
+GENE_ANNOTATION_QUERY_SIZE = 500
+
+# the number of base pairs on either side of a variant to look for genes
+FLANKING_REGION_SIZE = 500000
+
+VARIANT_TO_GENE_PROVIDED_BY = 'ensembl.sequence_variant_to_gene'
+
 EnsemblGene = namedtuple('EnsemblGene', ['ensembl_id', 'ensembl_name', 'chromosome', 'start_position', 'end_position', 'gene_biotype', 'description'])
 
 
@@ -21,7 +46,14 @@ class EnsemblService(object):
                                       logging.INFO,
                                       log_file_path=LoggingUtil.get_logging_path())
     
-    def __init__(self, temp_dir: str=None):
+    def __init__(self,
+                 temp_dir: str=None,
+                 use_gene_index: bool = True,
+                 gene_index_path: str = None,
+                 genes_source: str = None,
+                 gene_annotation_cache_size: int = 0,
+                 share_gene_nodes: bool = False,
+                 metrics: MetricsSink = None):
 
         self.upstream_gene_predicate_id = 'SNPEFF:upstream_gene_variant'
         self.upstream_gene_predicate_label = 'upstream_gene_variant'
@@ -29,6 +61,13 @@ class EnsemblService(object):
         self.downstream_gene_predicate_id = 'SNPEFF:downstream_gene_variant'
         self.downstream_gene_predicate_label = 'downstream_gene_variant'
 
+        # Results for nearby variants mostly refer to the same genes, so they share one copy of each gene's strings.
+        # If share_gene_nodes is True they also share one read only FrozenSimpleNode per gene, otherwise each result
+        # gets its own mutable SimpleNode.
+        self.interner = GraphInterner(share_nodes=share_gene_nodes)
+
+        self.metrics = metrics
+
         # This can cause issues if python doesn't have write access to the directory.
         # If so, an appropriate directory needs to be specified. See the README.
         temp_dir = temp_dir if temp_dir else '.'
@@ -36,8 +75,28 @@ class EnsemblService(object):
 
         self.gene_db_successfully_created = False
         self.persistent_conn = None
+        # the genes db and the gene index are built the first time any thread needs them, only by one of them
+        self.genes_build_lock = threading.RLock()
         self.all_gene_annotations = None
 
+        # gene annotations are looked up in the genes db by ensembl id, if gene_annotation_cache_size is set
+        # up to that many of the most recently used annotations are also kept in memory
+        self.gene_annotation_cache_size = gene_annotation_cache_size
+        self.gene_annotation_cache = OrderedDict()
+
+        # if use_gene_index is True gene range queries are answered by a GeneIntervalIndex instead of querying the db
+        # for every variant. The index is memory mapped from a prebuilt file at gene_index_path, which is built from
+        # the genes db the first time it's needed if it doesn't exist yet.
+        self.use_gene_index = use_gene_index
+        self.gene_index_path = gene_index_path if gene_index_path else os.path.join(temp_dir, 'genes.index')
+        self.gene_index = None
+
+        self.ensembl_release_url = 'https://rest.ensembl.org/info/data/?content-type=application/json'
+
+        # a local file or url with biomart gene data (see ensembl_genes_url) to build the genes db from,
+        # by default it's downloaded from ensembl biomart
+        self.genes_source = genes_source
+
         # we assume the order of attributes from this url -
         # if we change this we need to change the indexing in create_genes_db below
         self.ensembl_genes_url = """http://www.ensembl.org/biomart/martservice?query=<?xml version="1.0" encoding="UTF-8"?>
@@ -54,7 +113,17 @@ class EnsemblService(object):
                                         </Dataset>
                                     </Query>"""
 
-        self.check_if_already_done_sql = "SELECT name FROM sqlite_master WHERE type='table' AND name='genes';"
+        self.check_if_already_done_sql = "SELECT name FROM sqlite_master WHERE type='table' AND name='build_info';"
+
+        # one row written in the same transaction as the genes, so it only exists if the genes table is complete
+        self.build_info_table_sql = """CREATE TABLE build_info (
+        ensembl_release text,
+        num_genes INTEGER,
+        created_at text);"""
+        self.build_info_select_sql = "SELECT ensembl_release, num_genes FROM build_info;"
+        self.build_info_created_at_sql = "SELECT created_at FROM build_info;"
+        self.build_info_entry_sql = "INSERT INTO build_info (ensembl_release, num_genes, created_at) VALUES (?,?,?);"
+        self.genes_count_sql = "SELECT count(*) FROM genes;"
         
         self.genes_table_sql = """CREATE TABLE IF NOT EXISTS genes (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -73,69 +142,247 @@ class EnsemblService(object):
         (ensembl_id, gene_name, chromosome, start_pos, end_pos, gene_type, description) 
         VALUES (?,?,?,?,?,?,?);"""
         
-        self.gene_range_select_sql = """SELECT ensembl_id, gene_name, start_pos, end_pos
+        self.gene_range_select_sql = """SELECT ensembl_id, gene_name, start_pos, end_pos, gene_type
         FROM genes WHERE chromosome = ? AND ((? >= start_pos AND ? <= end_pos)
         OR (? >= start_pos AND ? <= end_pos) OR (? <= start_pos AND ? >= end_pos));"""
 
         self.gene_ensembl_id_select_sql = "SELECT * FROM genes WHERE ensembl_id = ?"
+        self.gene_annotations_select_sql = """SELECT ensembl_id, gene_name, chromosome, start_pos, end_pos, gene_type,
+        description FROM genes"""
 
     def create_or_connect_to_genes_db(self):
-        
-        if not self.gene_db_successfully_created:
-            self.create_genes_db()
-        
-        if not self.persistent_conn:
-            self.persistent_conn = sqlite3.connect(self.gene_db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-            self.persistent_conn.row_factory = sqlite3.Row
+        with self.genes_build_lock:
+            if not self.gene_db_successfully_created:
+                self.create_genes_db()
+
+            if not self.persistent_conn:
+                # shared by the threads using this service, sqlite serializes their queries
+                self.persistent_conn = sqlite3.connect(self.gene_db_path,
+                                                       detect_types=sqlite3.PARSE_DECLTYPES,
+                                                       check_same_thread=False)
+                self.persistent_conn.row_factory = sqlite3.Row
+
+            return self.persistent_conn
+
+    def get_gene_index(self):
+        gene_index = self.gene_index
+        if gene_index is not None:
+            return gene_index
+        with self.genes_build_lock:
+            if self.gene_index is not None:
+                return self.gene_index
+            if os.path.exists(self.gene_index_path):
+                try:
+                    gene_index = GeneIntervalIndex.load(self.gene_index_path)
+                except ValueError as e:
+                    self.logger.warning(f'Ensembl gene index file could not be used, rebuilding it: {e}')
+                else:
+                    # a prebuilt index is used without the genes db, but if there is one the index has to match it
+                    genes_db_version = self.get_existing_genes_db_version()
+                    if genes_db_version is not None and genes_db_version != gene_index.genes_db_version:
+                        self.logger.warning(f'Ensembl gene index file was built from a different genes db '
+                                            f'({gene_index.genes_db_version}, not {genes_db_version}), '
+                                            f'rebuilding it.')
+                        gene_index = None
+            if gene_index is None:
+                gene_index = self.build_gene_index_file()
+            self.logger.info(f'Ensembl loaded a gene index with {len(gene_index)} genes '
+                             f'(Ensembl release {gene_index.ensembl_release}).')
+            self.gene_index = gene_index
+            return gene_index
+
+    def build_gene_index_file(self):
+        """
+        Build the gene index file from the genes db, creating the db first if needed.
+
+        :return: the GeneIntervalIndex, memory mapped from the new file
+        """
+        with self.genes_build_lock:
+            db_conn = self.create_or_connect_to_genes_db()
+            gene_index = GeneIntervalIndex.from_genes_db(db_conn)
+            genes_db_version = self.get_genes_db_version(db_conn)
+            gene_index.write(self.gene_index_path,
+                             ensembl_release=genes_db_version[0],
+                             genes_db_version=genes_db_version)
+        self.logger.info(f'Ensembl wrote a gene index file with {len(gene_index)} genes to {self.gene_index_path}')
+        return GeneIntervalIndex.load(self.gene_index_path)
+
+    def get_genes_db_version(self, db_conn: sqlite3.Connection):
+        """
+        :return: [ensembl_release, num_genes, created_at] if the genes db was completely built, otherwise None,
+        a gene index file records this so it can tell when the genes db was rebuilt
+        """
+        build_info = self.get_genes_db_build_info(db_conn)
+        if build_info is None:
+            return None
+        created_at = db_conn.execute(self.build_info_created_at_sql).fetchone()[0]
+        return [*build_info, created_at]
+
+    def get_existing_genes_db_version(self):
+        """
+        :return: the version of the genes db (see get_genes_db_version) if there is a completely built one, without
+        creating it otherwise
+        """
+        if not os.path.exists(self.gene_db_path):
+            return None
+        db_conn = sqlite3.connect(self.gene_db_path)
+        try:
+            return self.get_genes_db_version(db_conn)
+        except sqlite3.Error as e:
+            self.logger.warning(f'Ensembl could not read the genes db build info: {e}')
+            return None
+        finally:
+            db_conn.close()
 
-        return self.persistent_conn
+    def get_genes_db_build_info(self, db_conn: sqlite3.Connection):
+        """
+        :return: a tuple of (ensembl_release, num_genes) if the genes db was completely built, otherwise None
+        """
+        db_cursor = db_conn.cursor()
+        db_cursor.execute(self.check_if_already_done_sql)
+        if db_cursor.fetchone() is None:
+            return None
+        db_cursor.execute(self.build_info_select_sql)
+        build_info = db_cursor.fetchone()
+        if build_info is None:
+            return None
+        ensembl_release, num_genes = build_info
+        db_cursor.execute(self.genes_count_sql)
+        if db_cursor.fetchone()[0] != num_genes:
+            return None
+        return ensembl_release, num_genes
 
     def create_genes_db(self):
         try:
             db_conn = sqlite3.connect(self.gene_db_path)
-            db_cursor = db_conn.cursor()
-
-            db_cursor.execute(self.check_if_already_done_sql)
-            if db_cursor.fetchone() is not None:
-                # TODO we assume this means it's complete - it could have been created but not filled out
+            if self.get_genes_db_build_info(db_conn) is not None:
+                db_conn.close()
                 self.gene_db_successfully_created = True
                 return True
+            db_conn.close()
 
+            # the release is only known when the genes come straight from ensembl
+            ensembl_release = self.get_ensembl_release() if self.genes_source is None else None
             # ensembl_genes are of type EnsemblGene namedtuple - that has to match the SQL parameters in gene_entry_sql
-            ensembl_genes = self.retrieve_all_genes()
-           
-            with db_conn:
-                db_conn.execute(self.genes_table_sql)
-                db_conn.executemany(self.gene_entry_sql, ensembl_genes)
-                db_conn.execute(self.genes_table_ensembl_id_index_sql)
-                db_conn.execute(self.genes_table_composite_index_sql)
+            ensembl_genes = self.iter_all_genes(self.genes_source)
+            if not self.write_genes_db(ensembl_genes, ensembl_release=ensembl_release):
+                return False
 
-            db_conn.close()
-            self.logger.info(f'Ensembl created a gene database with {len(ensembl_genes)} entries!')
             self.gene_db_successfully_created = True
             return True
 
         except sqlite3.Error as e:
             self.logger.error(f'Ensembl had a database error: {e}')
 
+    def write_genes_db(self, ensembl_genes, ensembl_release: str = None, chunk_size: int = GENES_DB_CHUNK_SIZE):
+        """
+        Write genes to a new genes db, replacing the existing one if there is one.
+
+        Genes are consumed and inserted in committed chunks as they arrive, so a streaming iterable never has to be
+        held in memory. The db is built in a temporary file with bulk load pragmas, indexed after all of the genes
+        are inserted, marked complete with a build_info row, and only then moved into place.
+
+        :param ensembl_genes: an iterable of EnsemblGene
+        :param ensembl_release: the Ensembl release the genes came from
+        :param chunk_size: the number of genes inserted per transaction
+        :return: the number of genes written, or 0 if there were none and the db was not replaced
+        """
+        temp_db_path = f'{self.gene_db_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        if os.path.exists(temp_db_path):
+            os.remove(temp_db_path)
+        db_conn = sqlite3.connect(temp_db_path)
+        try:
+            # nothing needs to survive a crash during the build, the temporary file is just thrown away
+            db_conn.execute('PRAGMA journal_mode = OFF;')
+            db_conn.execute('PRAGMA synchronous = OFF;')
+            db_conn.execute('PRAGMA cache_size = -262144;')
+            db_conn.execute(self.genes_table_sql)
+
+            num_genes = 0
+            ensembl_genes = iter(ensembl_genes)
+            while True:
+                gene_chunk = list(islice(ensembl_genes, chunk_size))
+                if not gene_chunk:
+                    break
+                with db_conn:
+                    db_conn.executemany(self.gene_entry_sql, gene_chunk)
+                num_genes += len(gene_chunk)
+                self.logger.debug(f'Ensembl inserted {num_genes} genes so far.')
+            if not num_genes:
+                self.logger.error(f'Ensembl had no genes to write, the genes db was not replaced.')
+                return 0
+
+            with db_conn:
+                db_conn.execute(self.genes_table_ensembl_id_index_sql)
+                db_conn.execute(self.genes_table_composite_index_sql)
+                db_conn.execute(self.build_info_table_sql)
+                db_conn.execute(self.build_info_entry_sql,
+                                (ensembl_release, num_genes, datetime.now(timezone.utc).isoformat()))
+            db_conn.close()
+
+            with self.genes_build_lock:
+                if self.persistent_conn:
+                    self.persistent_conn.close()
+                    self.persistent_conn = None
+                os.replace(temp_db_path, self.gene_db_path)
+                # the index was made from the old genes, it's rebuilt the next time it's needed
+                self.gene_index = None
+        finally:
+            db_conn.close()
+            if os.path.exists(temp_db_path):
+                os.remove(temp_db_path)
+        self.logger.info(f'Ensembl created a gene database with {num_genes} entries (Ensembl release {ensembl_release})!')
+        return num_genes
+
+    def get_ensembl_release(self):
+        try:
+            release_response = requests.get(self.ensembl_release_url, timeout=60)
+            if release_response.status_code == 200:
+                return str(release_response.json()['releases'][0])
+            self.logger.warning(f'Ensembl non-200 response from release info call: {release_response.status_code}')
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError) as e:
+            self.logger.warning(f'Ensembl release info call failed: {e}')
+        return None
+
     def retrieve_all_genes(self):
-        genes_response = requests.get(self.ensembl_genes_url)
-        if genes_response.status_code == 200:
-            genes_data = genes_response.text.splitlines()
-            if len(genes_data) > 1:
-                ensembl_genes = []
-                for gene_line in genes_data[1:]:
-                    # gene_info is a EnsemblGene 
-                    gene_info = self.parse_biomart_gene_data(gene_line)
-                    if gene_info:
-                        ensembl_genes.append(gene_info)
-                return ensembl_genes
-            else:
-                self.logger.error(f'Ensembl biomart genes call didnt find any matches! Thats not right!')
-                return False
-        else:
-            self.logger.error(f'Ensembl non-200 response from biomart genes call: {genes_response.status_code})')
-            return None
+        ensembl_genes = list(self.iter_all_genes(self.genes_source))
+        if not ensembl_genes:
+            self.logger.error(f'Ensembl biomart genes call didnt find any matches! Thats not right!')
+            return False
+        return ensembl_genes
+
+    def iter_all_genes(self, genes_source: str = None):
+        """
+        Stream and parse biomart gene data, yielding an EnsemblGene for each valid line as it arrives.
+
+        :param genes_source: a local file or a url with biomart gene data, defaults to ensembl biomart
+        """
+        gene_lines = self.iter_biomart_gene_lines(genes_source)
+        # skip the first line
+        next(gene_lines, None)
+        for gene_line in gene_lines:
+            if not gene_line:
+                continue
+            # gene_info is a EnsemblGene
+            gene_info = self.parse_biomart_gene_data(gene_line)
+            if gene_info:
+                yield gene_info
+
+    def iter_biomart_gene_lines(self, genes_source: str = None):
+        genes_source = genes_source if genes_source else self.ensembl_genes_url
+        if os.path.isfile(genes_source):
+            with open(genes_source, encoding='utf-8') as genes_file:
+                for gene_line in genes_file:
+                    yield gene_line.rstrip('\r\n')
+            return
+
+        with requests.get(genes_source, stream=True) as genes_response:
+            if genes_response.status_code != 200:
+                self.logger.error(f'Ensembl non-200 response from biomart genes call: {genes_response.status_code})')
+                return
+            genes_response.encoding = 'utf-8'
+            for gene_line in genes_response.iter_lines(chunk_size=BIOMART_DOWNLOAD_CHUNK_SIZE, decode_unicode=True):
+                yield gene_line
 
     def parse_biomart_gene_data(self, gene_line):
         gene_data = gene_line.split('\t')
@@ -155,106 +402,316 @@ class EnsemblService(object):
 
         return None
 
-    def sequence_variant_to_gene(self, variant_id: str, variant_synonyms: set):
-        
-        flanking_region_size = 500000
-        results = []
+    def get_robokop_variant_coordinates(self, variant_id: str, variant_synonyms: set):
+        """
+        Find the HG38 robokop variant key in a set of variant synonyms and parse it.
 
-        found_valid_robokop_key = False
+        :return: a tuple of (robokop_key, chromosome, start_position, end_position) or None if there isn't a valid key
+        """
         robokop_ids = Text.get_curies_by_prefix('ROBO_VARIANT', variant_synonyms)
         if not robokop_ids:
             self.logger.debug(f'ensembl: robokop variant key not found for variant: {variant_id}')
-            return results
-        else:
+            return None
+        robokop_key_used = robokop_variant = None
+        for robokop_key in robokop_ids:
+            # only HG38 keys are used, so keys for other genomes aren't parsed (or checked) at all
+            if Text.un_curie(robokop_key).split('|', 1)[0] != 'HG38':
+                continue
             try:
-                for robokop_key in robokop_ids:
-                    robokop_data = Text.un_curie(robokop_key).split('|')
-                    reference_genome = robokop_data[0]
-                    if reference_genome == 'HG38':
-                        found_valid_robokop_key = True
-                        robokop_key_used = robokop_key
-                    else:
-                        continue
-                    chromosome = robokop_data[1]
-                    start_position = int(robokop_data[2])
-                    end_position = int(robokop_data[3])
-            except IndexError as e:
-                self.logger.error(f'ensembl: robokop variant key not set properly for variant: {variant_id} - {robokop_ids[0]}')
-                return results
-
-        if not found_valid_robokop_key:
+                robokop_variant = parse_robokop_variant_id(robokop_key)
+                robokop_key_used = robokop_key
+            except ValueError:
+                self.logger.error(f'ensembl: robokop variant key not set properly for variant: {variant_id} - {robokop_key}')
+
+        if robokop_variant is None:
             self.logger.debug(f'ensembl: latest robokop variant key not found for variant: {variant_id}')
+            return None
+
+        return robokop_key_used, robokop_variant.chromosome, robokop_variant.start_position, robokop_variant.end_position
+
+    # flanking_region_size: the number of base pairs on either side of a variant to look for genes
+    # nearest_k: if provided, only the k genes closest to a variant in that region are returned
+    # gene_biotypes: if provided, only genes with one of these biotypes (gene_type), eg. protein_coding, are returned
+    def sequence_variant_to_gene(self,
+                                 variant_id: str,
+                                 variant_synonyms: set,
+                                 flanking_region_size: int = FLANKING_REGION_SIZE,
+                                 nearest_k: int = None,
+                                 gene_biotypes: list = None):
+
+        results = []
+        start_time = time.perf_counter()
+
+        robokop_coordinates = self.get_robokop_variant_coordinates(variant_id, variant_synonyms)
+        if robokop_coordinates is None:
+            self.record_variant_to_gene_query('sequence_variant_to_gene', time.perf_counter() - start_time, 1, 0)
             return results
+        robokop_key_used, chromosome, start_position, end_position = robokop_coordinates
 
         flanking_min = start_position - flanking_region_size
         if flanking_min < 0:
             flanking_min = 0
         flanking_max = end_position + flanking_region_size
 
-        db_conn = self.create_or_connect_to_genes_db()
-        db_cursor = db_conn.cursor()
-
         #logger.info(f'looking for genes overlapping {flanking_min}-{flanking_max}')
 
-        db_cursor.execute(self.gene_range_select_sql, (chromosome, flanking_min, flanking_min, flanking_max, flanking_max, flanking_min, flanking_max))
+        if self.use_gene_index:
+            gene_index = self.get_gene_index()
+            biotype_codes = gene_index.get_biotype_codes(gene_biotypes)
+            if nearest_k is not None:
+                gene_indexes = [gene for _, gene in gene_index.find_nearest(chromosome, start_position, end_position,
+                                                                            nearest_k, flanking_min, flanking_max,
+                                                                            biotype_codes)]
+            else:
+                gene_indexes = gene_index.filter_by_biotype(
+                    gene_index.find_overlapping(chromosome, flanking_min, flanking_max), biotype_codes)
+            genes_in_region = gene_index.get_genes(gene_indexes)
+        else:
+            genes_in_region = self.__query_genes_in_region(chromosome, start_position, end_position, flanking_min,
+                                                           flanking_max, nearest_k, gene_biotypes)
+        results = self.__create_variant_to_gene_results(variant_id, robokop_key_used, start_position, end_position,
+                                                        genes_in_region)
+
+        self.logger.debug(f'ensembl sequence_variant_to_gene found {len(results)} results for {variant_id}')
+        self.record_variant_to_gene_query('sequence_variant_to_gene', time.perf_counter() - start_time, 1, len(results))
+
+        return results
 
-        genes_in_region = db_cursor.fetchall()
+    def batch_sequence_variant_to_gene(self,
+                                       variants: list,
+                                       flanking_region_size: int = FLANKING_REGION_SIZE,
+                                       nearest_k: int = None,
+                                       gene_biotypes: list = None,
+                                       as_edge_batch: bool = False):
+        """
+        Find the genes near many variants at once, with the same results as calling sequence_variant_to_gene for each.
+
+        The HG38 coordinates of every variant are parsed up front and sorted, then each chromosome is joined against
+        the gene index in a single sweep, so the cost is linear in the number of variants and genes. With nearest_k
+        each variant walks outwards through the index instead, only visiting its closest genes. If use_gene_index is
+        False the genes db is queried for each variant instead, like sequence_variant_to_gene does.
+
+        :param variants: a list of (variant_id, variant_synonyms) tuples
+        :param as_edge_batch: if True return the results as an EdgeBatch, which stores them in columns and only
+        creates edge and node objects when they're accessed
+        :return: a dictionary of variant_id -> list of tuples (edge: SimpleEdge, gene_node: SimpleNode), or an
+        EdgeBatch that can be used the same way
+        """
+        with span('ensembl_variant_to_gene', variants=len(variants)) as ensembl_span:
+            edge_batch = self.__batch_sequence_variant_to_gene(variants, flanking_region_size, nearest_k, gene_biotypes)
+            ensembl_span.set(edges=edge_batch.num_edges)
+        if as_edge_batch:
+            return edge_batch
+        all_results = {variant_id: [] for variant_id, _ in variants}
+        all_results.update((variant_id, list(variant_results)) for variant_id, variant_results in edge_batch.items())
+        return all_results
+
+    def __batch_sequence_variant_to_gene(self,
+                                         variants: list,
+                                         flanking_region_size: int,
+                                         nearest_k: int,
+                                         gene_biotypes: list):
+        start_time = time.perf_counter()
+        edge_batch = EdgeBatch(provided_by=VARIANT_TO_GENE_PROVIDED_BY, target_type=node_types.GENE,
+                               interner=self.interner)
+        variants_by_chromosome = defaultdict(list)
+        for variant_id, variant_synonyms in variants:
+            robokop_coordinates = self.get_robokop_variant_coordinates(variant_id, variant_synonyms)
+            if robokop_coordinates is not None:
+                robokop_key, chromosome, start_position, end_position = robokop_coordinates
+                variants_by_chromosome[chromosome].append((start_position, end_position, variant_id, robokop_key))
+            else:
+                edge_batch.add_source(variant_id)
+
+        if self.use_gene_index:
+            gene_index = self.get_gene_index()
+            biotype_codes = gene_index.get_biotype_codes(gene_biotypes)
+        for chromosome, chromosome_variants in variants_by_chromosome.items():
+            chromosome_variants.sort(key=itemgetter(0))
+            flanking_mins = array('q', [max(start_position - flanking_region_size, 0)
+                                        for start_position, _, _, _ in chromosome_variants])
+            flanking_maxes = array('q', [end_position + flanking_region_size
+                                         for _, end_position, _, _ in chromosome_variants])
+            if not self.use_gene_index:
+                genes_by_variant = [self.__query_genes_in_region(chromosome, start_position, end_position,
+                                                                 flanking_min, flanking_max, nearest_k, gene_biotypes)
+                                    for (start_position, end_position, _, _), flanking_min, flanking_max in
+                                    zip(chromosome_variants, flanking_mins, flanking_maxes)]
+            elif nearest_k is not None:
+                overlapping_genes = [[gene for _, gene in gene_index.find_nearest(chromosome,
+                                                                                  start_position,
+                                                                                  end_position,
+                                                                                  nearest_k,
+                                                                                  flanking_min,
+                                                                                  flanking_max,
+                                                                                  biotype_codes)]
+                                     for (start_position, end_position, _, _), flanking_min, flanking_max in
+                                     zip(chromosome_variants, flanking_mins, flanking_maxes)]
+            else:
+                overlapping_genes = [gene_index.filter_by_biotype(gene_indexes, biotype_codes) for gene_indexes in
+                                     gene_index.find_overlapping_sorted(chromosome, flanking_mins, flanking_maxes)]
+            if self.use_gene_index:
+                genes_by_variant = [gene_index.get_genes(gene_indexes) for gene_indexes in overlapping_genes]
+            for (start_position, end_position, variant_id, robokop_key), genes_in_region in \
+                    zip(chromosome_variants, genes_by_variant):
+                edge_batch.add_source(variant_id, robokop_key)
+                for gene_id, gene_name, gene_start, gene_end in genes_in_region:
+                    edge_batch.add_edge(f'ENSEMBL:{gene_id}',
+                                        f'{gene_name}',
+                                        *self.__get_gene_predicate(start_position, gene_start),
+                                        self.get_gene_distance(start_position, end_position, gene_start, gene_end))
+
+        self.logger.debug(f'ensembl batch_sequence_variant_to_gene processed {len(variants)} variants')
+        self.record_variant_to_gene_query('batch_sequence_variant_to_gene', time.perf_counter() - start_time,
+                                          len(variants), edge_batch.num_edges)
+        return edge_batch
+
+    def __query_genes_in_region(self,
+                                chromosome: str,
+                                start_position: int,
+                                end_position: int,
+                                flanking_min: int,
+                                flanking_max: int,
+                                nearest_k: int,
+                                gene_biotypes: list):
+        """
+        Query the genes db for the genes in a variant's flanking region, used when use_gene_index is False.
+
+        :return: a list of (gene_id, gene_name, gene_start, gene_end) tuples, the nearest_k closest if it's not None
+        """
+        db_conn = self.create_or_connect_to_genes_db()
+        db_cursor = db_conn.cursor()
+        db_cursor.execute(self.gene_range_select_sql, (chromosome, flanking_min, flanking_min, flanking_max, flanking_max, flanking_min, flanking_max))
+        genes_in_region = [(gene_id, gene_name, gene_start, gene_end)
+                           for gene_id, gene_name, gene_start, gene_end, gene_type in db_cursor.fetchall()
+                           if gene_biotypes is None or gene_type in gene_biotypes]
+        if nearest_k is not None:
+            genes_in_region.sort(key=lambda gene: self.get_gene_distance(start_position, end_position,
+                                                                         gene[2], gene[3]))
+            genes_in_region = genes_in_region[:nearest_k]
+        return genes_in_region
+
+    def record_variant_to_gene_query(self, method: str, seconds: float, num_variants: int, num_results: int):
+        """
+        Record the metrics for one variant to gene query, also used for queries run by worker processes.
+        """
+        metrics = get_metrics_sink(self.metrics)
+        metrics.increment(ENSEMBL_QUERIES, method=method)
+        metrics.observe(ENSEMBL_QUERY_SECONDS, seconds, method=method)
+        metrics.increment(ENSEMBL_QUERY_VARIANTS, num_variants, method=method)
+        metrics.increment(ENSEMBL_QUERY_RESULTS, num_results, method=method)
+
+    @staticmethod
+    def get_gene_distance(start_position: int, end_position: int, gene_start: int, gene_end: int):
+        if start_position < gene_start:
+            return gene_start - start_position
+        elif end_position > gene_end:
+            return end_position - gene_end
+        return 0
+
+    def __get_gene_predicate(self, start_position: int, gene_start: int):
+        if start_position < gene_start:
+            return self.upstream_gene_predicate_id, self.upstream_gene_predicate_label
+        return self.downstream_gene_predicate_id, self.downstream_gene_predicate_label
+
+    def __create_variant_to_gene_results(self,
+                                         variant_id: str,
+                                         robokop_key_used: str,
+                                         start_position: int,
+                                         end_position: int,
+                                         genes_in_region: list):
+        results = []
         for gene_id_text, gene_name, gene_start, gene_end in genes_in_region:
             #cast this to make neo4j happy
             gene_id = str(gene_id_text)
             #logger.info(f'Found matching gene: {gene_id},{gene_start},{gene_end}')
-            gene_node = SimpleNode(id=f'ENSEMBL:{gene_id}', name=f'{gene_name}', type=node_types.GENE)
-            if start_position < gene_start:
-                distance = gene_start - start_position
-                predicate_id = self.upstream_gene_predicate_id
-                predicate_label = self.upstream_gene_predicate_label
-            elif end_position > gene_end:
-                distance = end_position - gene_end
-                predicate_id = self.downstream_gene_predicate_id
-                predicate_label = self.downstream_gene_predicate_label
-            else:
-                distance = 0
-                predicate_id = self.downstream_gene_predicate_id
-                predicate_label = self.downstream_gene_predicate_label
+            gene_node = self.interner.get_node(f'ENSEMBL:{gene_id}', node_types.GENE, f'{gene_name}')
+            distance = self.get_gene_distance(start_position, end_position, gene_start, gene_end)
+            predicate_id, predicate_label = self.__get_gene_predicate(start_position, gene_start)
 
             props = {'distance': distance}
             edge = SimpleEdge(source_id=variant_id,
                               target_id=gene_node.id,
-                              provided_by='ensembl.sequence_variant_to_gene',
+                              provided_by=VARIANT_TO_GENE_PROVIDED_BY,
                               input_id=robokop_key_used,
                               predicate_id=predicate_id,
                               predicate_label=predicate_label,
                               ctime=1,
                               properties=props)
             results.append((edge, gene_node))
-
-        self.logger.debug(f'ensembl sequence_variant_to_gene found {len(results)} results for {variant_id}')
-
         return results
 
     def get_all_ensembl_gene_annotations(self):
         if self.all_gene_annotations:
             return self.all_gene_annotations
         else:
-            ensembl_genes = self.retrieve_all_genes()
+            db_conn = self.create_or_connect_to_genes_db()
+            db_cursor = db_conn.cursor()
+            db_cursor.execute(f'{self.gene_annotations_select_sql};')
             all_gene_annotations = {}
-            for gene in ensembl_genes:
-                all_gene_annotations[gene.ensembl_id] = {
-                    'name': gene.ensembl_name,
-                    'chromosome': gene.chromosome,
-                    'start_position': gene.start_position,
-                    'end_position': gene.end_position,
-                    'gene_biotype': gene.gene_biotype,
-                    'description': gene.description
-                }
+            for gene_row in db_cursor:
+                all_gene_annotations[gene_row[0]] = self.__create_gene_annotation(gene_row)
             self.all_gene_annotations = all_gene_annotations
             return all_gene_annotations
 
     def get_ensembl_gene_annotations(self, ensembl_id):
-        if not self.all_gene_annotations:
-            self.get_all_ensembl_gene_annotations()
-
-        if ensembl_id in self.all_gene_annotations:
-            return self.all_gene_annotations[ensembl_id]
-        else:
-            return {'ensembl_error': f'{ensembl_id} not found.'}
+        return self.get_ensembl_gene_annotations_batch([ensembl_id])[ensembl_id]
+
+    def get_ensembl_gene_annotations_batch(self, ensembl_ids: list):
+        """
+        Look up the annotations of many genes at once from the genes db.
+
+        :param ensembl_ids: a list of ensembl gene ids (without a curie prefix)
+        :return: a dictionary of ensembl_id -> annotation, or -> {'ensembl_error': ...} for ids that weren't found
+        """
+        gene_annotations = {}
+        ids_to_look_up = []
+        num_cached = 0
+        for ensembl_id in dict.fromkeys(ensembl_ids):
+            if self.all_gene_annotations and ensembl_id in self.all_gene_annotations:
+                gene_annotations[ensembl_id] = self.all_gene_annotations[ensembl_id]
+            elif ensembl_id in self.gene_annotation_cache:
+                self.gene_annotation_cache.move_to_end(ensembl_id)
+                gene_annotations[ensembl_id] = self.gene_annotation_cache[ensembl_id]
+                num_cached += 1
+            else:
+                ids_to_look_up.append(ensembl_id)
+
+        metrics = get_metrics_sink(self.metrics)
+        metrics.increment(ENSEMBL_GENE_ANNOTATIONS, len(gene_annotations) - num_cached, source='memory')
+        metrics.increment(ENSEMBL_GENE_ANNOTATIONS, num_cached, source='cache')
+        if ids_to_look_up:
+            num_found_before = len(gene_annotations)
+            db_conn = self.create_or_connect_to_genes_db()
+            db_cursor = db_conn.cursor()
+            for i in range(0, len(ids_to_look_up), GENE_ANNOTATION_QUERY_SIZE):
+                ids_chunk = ids_to_look_up[i:i + GENE_ANNOTATION_QUERY_SIZE]
+                db_cursor.execute(f'{self.gene_annotations_select_sql} '
+                                  f'WHERE ensembl_id IN ({",".join("?" * len(ids_chunk))});', ids_chunk)
+                for gene_row in db_cursor:
+                    gene_annotation = self.__create_gene_annotation(gene_row)
+                    gene_annotations[gene_row[0]] = gene_annotation
+                    if self.gene_annotation_cache_size:
+                        self.gene_annotation_cache[gene_row[0]] = gene_annotation
+            while len(self.gene_annotation_cache) > self.gene_annotation_cache_size:
+                self.gene_annotation_cache.popitem(last=False)
+            num_found_in_db = len(gene_annotations) - num_found_before
+            metrics.increment(ENSEMBL_GENE_ANNOTATIONS, num_found_in_db, source='db')
+            metrics.increment(ENSEMBL_GENE_ANNOTATIONS, len(ids_to_look_up) - num_found_in_db, source='not_found')
+
+        for ensembl_id in ensembl_ids:
+            if ensembl_id not in gene_annotations:
+                gene_annotations[ensembl_id] = {'ensembl_error': f'{ensembl_id} not found.'}
+        return gene_annotations
+
+    @staticmethod
+    def __create_gene_annotation(gene_row):
+        ensembl_id, gene_name, chromosome, start_position, end_position, gene_biotype, description = gene_row
+        return {
+            'name': gene_name,
+            'chromosome': chromosome,
+            'start_position': start_position,
+            'end_position': end_position,
+            'gene_biotype': gene_biotype,
+            'description': description
+        }
@@ -1,9 +1,187 @@
+import codecs
 import json
 import logging
+import os
+import re
 import time
+from collections import namedtuple, Counter
+from datetime import datetime, timezone
+from itertools import islice
+
 import requests
 from robokop_genetics.util import LoggingUtil
 
+HGNC_COMPLETE_SET_URL = "https://storage.googleapis.com/public-download-files/hgnc/json/json/hgnc_complete_set.json"
+
+HGNC_SYMBOL_INDEX_FORMAT = 'robokop-genetics-hgnc-symbol-index'
+HGNC_SYMBOL_INDEX_VERSION = 2
+# by default the index is used for this long before checking whether the HGNC data changed
+HGNC_SYMBOL_INDEX_MAX_AGE = 24 * 60 * 60
+
+# the complete set is streamed and parsed in chunks of this many bytes
+HGNC_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# the only fields of each gene the symbol lookup needs
+HGNC_SYMBOL_FIELDS = ('hgnc_id', 'symbol', 'prev_symbol', 'alias_symbol')
+HGNC_DOCS_START = re.compile(r'"docs"\s*:\s*\[')
+HGNC_DOCS_SEPARATOR = re.compile(r'[\s,]*')
+
+# how a gene symbol matched, in order of precedence
+SYMBOL_MATCH_APPROVED = 'approved'
+SYMBOL_MATCH_PREVIOUS = 'previous'
+SYMBOL_MATCH_ALIAS = 'alias'
+SYMBOL_MATCH_PRECEDENCE = {SYMBOL_MATCH_APPROVED: 0, SYMBOL_MATCH_PREVIOUS: 1, SYMBOL_MATCH_ALIAS: 2}
+
+# hgnc_id is None if the symbol is ambiguous, hgnc_ids has every gene it matched
+GeneSymbolMatch = namedtuple('GeneSymbolMatch', ['hgnc_id', 'match_type', 'ambiguous', 'hgnc_ids'])
+
+
+class HGNCSymbolIndex(object):
+    """
+    Gene symbol lookups built from the HGNC complete set.
+
+    approved_symbols maps exact approved symbols to HGNC ids. normalized_symbols maps upper case approved, previous
+    and alias symbols to the best kind of match for them and every HGNC id with that kind of match - an approved
+    symbol always wins over a previous symbol, which wins over an alias. A symbol matching more than one gene that way
+    is ambiguous.
+
+    Normalized matches are kept as the same tab separated strings they're stored as in the index file
+    (match type, then comma separated HGNC ids), so loading the file doesn't have to parse every one of them.
+    """
+
+    def __init__(self, approved_symbols: dict = None, normalized_symbols: dict = None):
+        self.approved_symbols = approved_symbols if approved_symbols is not None else {}
+        self.normalized_symbols = normalized_symbols if normalized_symbols is not None else {}
+
+    def __len__(self):
+        return len(self.normalized_symbols)
+
+    def add(self, symbol: str, hgnc_id: str, match_type: str):
+        if match_type == SYMBOL_MATCH_APPROVED and symbol not in self.approved_symbols:
+            self.approved_symbols[symbol] = hgnc_id
+        normalized_symbol = symbol.upper()
+        existing_match = self.normalized_symbols.get(normalized_symbol)
+        if existing_match is None:
+            self.normalized_symbols[normalized_symbol] = f'{match_type}\t{hgnc_id}'
+            return
+        existing_match_type, existing_hgnc_ids = existing_match.split('\t')
+        if SYMBOL_MATCH_PRECEDENCE[match_type] < SYMBOL_MATCH_PRECEDENCE[existing_match_type]:
+            self.normalized_symbols[normalized_symbol] = f'{match_type}\t{hgnc_id}'
+        elif match_type == existing_match_type and hgnc_id not in existing_hgnc_ids.split(','):
+            self.normalized_symbols[normalized_symbol] = f'{existing_match},{hgnc_id}'
+
+    def add_hgnc_item(self, hgnc_item: dict):
+        hgnc_id = hgnc_item['hgnc_id']
+        self.add(hgnc_item['symbol'], hgnc_id, SYMBOL_MATCH_APPROVED)
+        for previous_symbol in hgnc_item.get('prev_symbol', ()):
+            self.add(previous_symbol, hgnc_id, SYMBOL_MATCH_PREVIOUS)
+        for alias_symbol in hgnc_item.get('alias_symbol', ()):
+            self.add(alias_symbol, hgnc_id, SYMBOL_MATCH_ALIAS)
+
+    def resolve(self, symbol: str):
+        """
+        :return: a GeneSymbolMatch, or None if the symbol isn't found
+        """
+        approved_hgnc_id = self.approved_symbols.get(symbol)
+        if approved_hgnc_id is not None:
+            return GeneSymbolMatch(approved_hgnc_id, SYMBOL_MATCH_APPROVED, False, (approved_hgnc_id,))
+        normalized_match = self.normalized_symbols.get(symbol.upper())
+        if normalized_match is None:
+            return None
+        match_type, hgnc_ids = normalized_match.split('\t')
+        hgnc_ids = tuple(hgnc_ids.split(','))
+        if len(hgnc_ids) > 1:
+            return GeneSymbolMatch(None, match_type, True, hgnc_ids)
+        return GeneSymbolMatch(hgnc_ids[0], match_type, False, hgnc_ids)
+
+    def write(self, index_path: str, etag: str = None, last_modified: str = None):
+        """
+        Write the index to a file - a JSON header line, one tab separated line per approved symbol, and then one per
+        normalized symbol.
+
+        The file is written to a temporary name and then moved into place, so a partially written file is never seen.
+        """
+        header = {'format': HGNC_SYMBOL_INDEX_FORMAT,
+                  'version': HGNC_SYMBOL_INDEX_VERSION,
+                  'num_approved_symbols': len(self.approved_symbols),
+                  'num_normalized_symbols': len(self.normalized_symbols),
+                  'etag': etag,
+                  'last_modified': last_modified,
+                  'created': datetime.now(timezone.utc).isoformat()}
+        temp_index_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(temp_index_path, 'w', encoding='utf-8') as index_file:
+            index_file.write(json.dumps(header) + '\n')
+            index_file.write(''.join(f'{symbol}\t{hgnc_id}\n' for symbol, hgnc_id in self.approved_symbols.items()))
+            index_file.write(''.join(f'{normalized_symbol}\t{normalized_match}\n'
+                                     for normalized_symbol, normalized_match in self.normalized_symbols.items()))
+        os.replace(temp_index_path, index_path)
+
+    @classmethod
+    def load(cls, index_path: str):
+        """
+        :return: a tuple of the index file header and the HGNCSymbolIndex
+        :raises ValueError: if the file isn't a valid, complete symbol index
+        """
+        with open(index_path, encoding='utf-8') as index_file:
+            try:
+                header = json.loads(index_file.readline())
+            except json.JSONDecodeError:
+                raise ValueError(f'{index_path} is not an HGNC symbol index.')
+            if header.get('format') != HGNC_SYMBOL_INDEX_FORMAT or header.get('version') != HGNC_SYMBOL_INDEX_VERSION:
+                raise ValueError(f'{index_path} is not a supported HGNC symbol index.')
+            approved_symbols = dict(line.rstrip('\n').split('\t')
+                                    for line in islice(index_file, header['num_approved_symbols']))
+            normalized_symbols = dict(line.rstrip('\n').split('\t', 1) for line in index_file)
+        if len(approved_symbols) != header['num_approved_symbols'] or \
+                len(normalized_symbols) != header['num_normalized_symbols']:
+            raise ValueError(f'{index_path} is incomplete.')
+        return header, cls(approved_symbols, normalized_symbols)
+
+
+def iter_hgnc_docs(hgnc_chunks):
+    """
+    Incrementally parse the HGNC complete set json, yielding each gene (with only HGNC_SYMBOL_FIELDS) as soon as
+    it has been read.
+
+    Only the unparsed end of the latest chunk and the gene being parsed are held in memory, instead of the whole
+    complete set and every field of every gene.
+
+    :param hgnc_chunks: an iterable of bytes chunks of the complete set json, eg. from a streamed download
+    :raises ValueError: if the json is malformed or ends before the list of genes does
+    """
+    json_decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    hgnc_chunks = iter(hgnc_chunks)
+    buffer = ''
+    position = 0
+    docs_started = False
+    while True:
+        if not docs_started:
+            docs_start = HGNC_DOCS_START.search(buffer)
+            if docs_start:
+                docs_started = True
+                position = docs_start.end()
+                continue
+        else:
+            position = HGNC_DOCS_SEPARATOR.match(buffer, position).end()
+            if position < len(buffer):
+                if buffer[position] == ']':
+                    return
+                try:
+                    hgnc_item, position = json_decoder.raw_decode(buffer, position)
+                    yield {field: hgnc_item[field] for field in HGNC_SYMBOL_FIELDS if field in hgnc_item}
+                    continue
+                except json.JSONDecodeError:
+                    # most likely the gene continues in the next chunk
+                    pass
+
+        hgnc_chunk = next(hgnc_chunks, None)
+        if hgnc_chunk is None:
+            raise ValueError('HGNC complete set json ended before the list of genes did.')
+        # everything before position was already parsed
+        buffer = buffer[position:] + utf8_decoder.decode(hgnc_chunk) if docs_started else \
+            buffer + utf8_decoder.decode(hgnc_chunk)
+        position = 0
+
 
 class HGNCService(object):
 
@@ -11,42 +189,150 @@ class HGNCService(object):
                                       logging.INFO,
                                       log_file_path=LoggingUtil.get_logging_path())
 
-    def __init__(self):
-        self.hgnc_symbol_to_curie = None
+    def __init__(self,
+                 temp_dir: str = None,
+                 symbol_index_path: str = None,
+                 symbol_index_max_age: float = HGNC_SYMBOL_INDEX_MAX_AGE,
+                 offline: bool = False,
+                 hgnc_url: str = HGNC_COMPLETE_SET_URL):
+        """
+        :param temp_dir: the directory for the symbol index file, defaults to the current directory
+        :param symbol_index_path: the symbol index file, defaults to hgnc_symbols.index in temp_dir
+        :param symbol_index_max_age: seconds an index is used before asking HGNC whether the data changed,
+        0 asks every time the index is loaded, None never asks
+        :param offline: if True HGNC is never contacted, the symbol index file has to exist already
+        :param hgnc_url: where to download the HGNC complete set
+        """
+        self.hgnc_symbol_index = None
+
+        # The symbol lookup is persisted to a local index file along with the validator headers (ETag and
+        # Last-Modified) HGNC sent with the data, so later starts load the file and only download again when
+        # a conditional request says the data changed.
+        temp_dir = temp_dir if temp_dir else '.'
+        self.symbol_index_path = symbol_index_path if symbol_index_path else os.path.join(temp_dir, 'hgnc_symbols.index')
+        self.symbol_index_max_age = symbol_index_max_age
+        self.offline = offline
+        self.hgnc_url = hgnc_url
 
     def get_gene_id_from_symbol(self, gene_symbol: str):
-        if self.hgnc_symbol_to_curie is None:
+        if self.hgnc_symbol_index is None:
             self.init_symbol_lookup()
-        if gene_symbol in self.hgnc_symbol_to_curie:
-            return self.hgnc_symbol_to_curie[gene_symbol]
-        else:
-            self.logger.info(f'HGNCService could not find ID for gene symbol: {gene_symbol}')
-            return None
+        hgnc_id = self.hgnc_symbol_index.approved_symbols.get(gene_symbol)
+        if hgnc_id is None:
+            self.logger.debug(f'HGNCService could not find ID for gene symbol: {gene_symbol}')
+        return hgnc_id
+
+    def get_gene_ids_from_symbols(self, gene_symbols: list):
+        """
+        Resolve many gene symbols at once, matching approved, previous and alias symbols regardless of case.
+
+        An exact approved symbol always matches first, then the best kind of case insensitive match. A symbol that
+        matches more than one gene equally well (eg. an alias used for two genes) is returned as ambiguous.
+
+        :param gene_symbols: a list of gene symbols
+        :return: a dictionary of gene symbol -> GeneSymbolMatch, or -> None for symbols that weren't found
+        """
+        if self.hgnc_symbol_index is None:
+            self.init_symbol_lookup()
+        resolve_symbol = self.hgnc_symbol_index.resolve
+        symbol_matches = {gene_symbol: resolve_symbol(gene_symbol) for gene_symbol in gene_symbols}
+
+        match_counts = Counter('ambiguous' if symbol_match.ambiguous else symbol_match.match_type
+                               for symbol_match in symbol_matches.values() if symbol_match is not None)
+        misses = [gene_symbol for gene_symbol, symbol_match in symbol_matches.items() if symbol_match is None]
+        self.logger.info(f'HGNCService resolved {len(symbol_matches) - len(misses)}/{len(symbol_matches)} gene symbols '
+                         f'({match_counts[SYMBOL_MATCH_APPROVED]} approved, {match_counts[SYMBOL_MATCH_PREVIOUS]} '
+                         f'previous, {match_counts[SYMBOL_MATCH_ALIAS]} alias, {match_counts["ambiguous"]} ambiguous), '
+                         f'{len(misses)} not found.')
+        if misses:
+            self.logger.debug(f'HGNCService could not find IDs for gene symbols: {", ".join(misses[:100])}'
+                              f'{" ..." if len(misses) > 100 else ""}')
+        return symbol_matches
 
     def init_symbol_lookup(self):
         self.logger.debug(f'Preparing HGNC Symbol look up.')
-        self.hgnc_symbol_to_curie = {}
+        self.hgnc_symbol_index = HGNCSymbolIndex()
 
-        hgnc_json = None
-        num_tries = 0
-        while num_tries < 5 and hgnc_json is None:
+        symbol_index_header = None
+        if os.path.exists(self.symbol_index_path):
             try:
-                self.logger.debug(f'Pulling HGNC data.')
-                hgnc_response = requests.get("https://storage.googleapis.com/public-download-files/hgnc/json/json/hgnc_complete_set.json")
-                try:
-                    hgnc_json = hgnc_response.json()
-                except json.JSONDecodeError:
-                    self.logger.error(f'HGNC download json parsing error.')
-            except requests.exceptions.RequestException:
-                num_tries += 1
-                time.sleep(2)
-                self.logger.warning(f'HGNC download attempt failed. Trying again ({num_tries} times).')
-        if hgnc_json is None:
-            self.logger.error(f'HGNC Symbol look up failed.!')
+                symbol_index_header, self.hgnc_symbol_index = HGNCSymbolIndex.load(self.symbol_index_path)
+            except ValueError as e:
+                self.logger.warning(f'HGNC symbol index could not be used, it will be downloaded again: {e}')
+
+        if self.offline:
+            if symbol_index_header is None:
+                self.logger.error(f'HGNC Symbol look up failed, offline mode needs a symbol index at '
+                                  f'{self.symbol_index_path}.')
             return
 
-        for hgnc_item in hgnc_json['response']['docs']:
-            hgnc_symbol = hgnc_item['symbol']
-            if hgnc_symbol not in self.hgnc_symbol_to_curie:
-                self.hgnc_symbol_to_curie[hgnc_symbol] = hgnc_item['hgnc_id']
+        if symbol_index_header is not None:
+            index_age = time.time() - os.path.getmtime(self.symbol_index_path)
+            if self.symbol_index_max_age is None or index_age < self.symbol_index_max_age:
+                self.logger.debug(f'HGNC Symbol look up loaded from {self.symbol_index_path}.')
+                return
+
+        hgnc_response = self.download_hgnc_data(symbol_index_header)
+        if hgnc_response is None:
+            if symbol_index_header is None:
+                self.logger.error(f'HGNC Symbol look up failed.!')
+            else:
+                self.logger.warning(f'HGNC could not be reached, using the existing symbol index.')
+            return
+        if hgnc_response.status_code == 304:
+            hgnc_response.close()
+            # the data hasn't changed, restart the max age
+            os.utime(self.symbol_index_path)
+            self.logger.debug(f'HGNC data unchanged, using the existing symbol index.')
+            return
+
+        # the genes are parsed as the download streams in, so the whole complete set is never held in memory
+        hgnc_symbol_index = HGNCSymbolIndex()
+        with hgnc_response:
+            try:
+                for hgnc_item in iter_hgnc_docs(hgnc_response.iter_content(chunk_size=HGNC_DOWNLOAD_CHUNK_SIZE)):
+                    hgnc_symbol_index.add_hgnc_item(hgnc_item)
+            except ValueError as e:
+                self.logger.error(f'HGNC download json parsing error: {e}')
+                return
+            except requests.exceptions.RequestException as e:
+                self.logger.error(f'HGNC download failed while streaming: {e}')
+                return
+        self.hgnc_symbol_index = hgnc_symbol_index
+        try:
+            hgnc_symbol_index.write(self.symbol_index_path,
+                                    etag=hgnc_response.headers.get('ETag'),
+                                    last_modified=hgnc_response.headers.get('Last-Modified'))
+        except OSError as e:
+            self.logger.warning(f'HGNC symbol index could not be written to {self.symbol_index_path}: {e}')
         self.logger.debug(f'HGNC Symbol look up ready.!')
+
+    def download_hgnc_data(self, symbol_index_header: dict = None):
+        """
+        Download the HGNC complete set, conditionally if there's an existing symbol index.
+
+        :param symbol_index_header: the header of the existing symbol index, if there is one
+        :return: the streamed response (status code 304 if the data hasn't changed), or None if the download failed
+        """
+        request_headers = {}
+        if symbol_index_header is not None:
+            if symbol_index_header.get('etag'):
+                request_headers['If-None-Match'] = symbol_index_header['etag']
+            if symbol_index_header.get('last_modified'):
+                request_headers['If-Modified-Since'] = symbol_index_header['last_modified']
+
+        num_tries = 0
+        while num_tries < 5:
+            try:
+                self.logger.debug(f'Pulling HGNC data.')
+                hgnc_response = requests.get(self.hgnc_url, headers=request_headers, stream=True)
+                if hgnc_response.status_code in (200, 304):
+                    return hgnc_response
+                hgnc_response.close()
+                self.logger.warning(f'HGNC download had a non-200 response: {hgnc_response.status_code}')
+            except requests.exceptions.RequestException:
+                pass
+            num_tries += 1
+            time.sleep(2)
+            self.logger.warning(f'HGNC download attempt failed. Trying again ({num_tries} times).')
+        return None
@@ -1,5 +1,25 @@
-from dataclasses import dataclass, field
-from robokop_genetics.util import Text
+from dataclasses import dataclass, field, fields
+
+
+def get_synonym_prefix(synonym: str):
+    """The same prefix as Text.get_curie"""
+    prefix, separator, _ = synonym.partition(':')
+    return prefix.upper() if separator else None
+
+
+def add_slots(cls, extra_slots: tuple = ()):
+    """
+    Recreate a dataclass with __slots__ for its fields, like dataclass(slots=True) does from python 3.10, plus any
+    extra_slots for attributes that aren't fields.
+    """
+    field_names = tuple(dataclass_field.name for dataclass_field in fields(cls))
+    class_dict = dict(cls.__dict__)
+    class_dict['__slots__'] = field_names + extra_slots
+    for field_name in field_names:
+        class_dict.pop(field_name, None)
+    class_dict.pop('__dict__', None)
+    class_dict.pop('__weakref__', None)
+    return type(cls)(cls.__name__, cls.__bases__, class_dict)
 
 
 @dataclass
@@ -16,11 +36,117 @@ class SimpleNode:
 
     def get_synonyms_by_prefix(self, prefix: str):
         """Returns curies for any synonym with the input prefix"""
-        return set(filter(lambda x: Text.get_curie(x) == prefix, self.synonyms))
+        # synonyms is a plain set that callers change in place, so it's scanned every time rather than indexed
+        if prefix is None or ':' in prefix:
+            return {synonym for synonym in self.synonyms if get_synonym_prefix(synonym) == prefix}
+        curie_start = f'{prefix}:'
+        curie_start_length = len(curie_start)
+        return {synonym for synonym in self.synonyms if synonym[:curie_start_length].upper() == curie_start}
 
     def add_synonyms(self, new_synonym_set: set):
         self.synonyms.update(new_synonym_set)
 
+    def __getstate__(self):
+        return self.id, self.type, self.name, self.properties, self.synonyms
+
+    def __setstate__(self, state):
+        self.id, self.type, self.name, self.properties, self.synonyms = state
+
+
+# Nodes are created by the millions, so they use slots instead of a __dict__.
+SimpleNode = add_slots(SimpleNode)
+
+
+class FrozenProperties(dict):
+    """The empty properties of a FrozenSimpleNode, which can't be changed"""
+
+    def __read_only(self, *args, **kwargs):
+        raise TypeError('The properties of a FrozenSimpleNode are read only, use mutable_copy() to change them.')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = __read_only
+
+
+class FrozenSimpleNode(SimpleNode):
+    """
+    A read only SimpleNode with no properties and only its id as a synonym, so one node can be shared by every result
+    that refers to it (see GraphInterner). Use mutable_copy for a SimpleNode that can be changed.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, id: str, type: str, name: str, properties: dict = None, synonyms: set = None):
+        # properties and synonyms are only accepted so dataclasses.replace works, they can't be anything else
+        if properties or (synonyms and set(synonyms) != {id}):
+            raise ValueError(f'{self.__class__.__name__} {id} can only have its id as a synonym and no properties.')
+        for attribute, value in (('id', id), ('type', type), ('name', name), ('properties', FrozenProperties()),
+                                 ('synonyms', frozenset((id,)))):
+            object.__setattr__(self, attribute, value)
+
+    def __setattr__(self, attribute, value):
+        raise AttributeError(f'{self.__class__.__name__} {self.id} is read only, use mutable_copy() to change it.')
+
+    def __delattr__(self, attribute):
+        raise AttributeError(f'{self.__class__.__name__} {self.id} is read only, use mutable_copy() to change it.')
+
+    def get_synonyms_by_prefix(self, prefix: str):
+        return {self.id} if get_synonym_prefix(self.id) == prefix else set()
+
+    def add_synonyms(self, new_synonym_set: set):
+        raise AttributeError(f'{self.__class__.__name__} {self.id} is read only, use mutable_copy() to change it.')
+
+    def __eq__(self, other):
+        # equal to a SimpleNode with the same fields, like the SimpleNode a mutable copy would be
+        if not isinstance(other, SimpleNode):
+            return NotImplemented
+        return (self.id, self.type, self.name, self.properties, self.synonyms) == \
+            (other.id, other.type, other.name, other.properties, other.synonyms)
+
+    def __hash__(self):
+        return hash((self.id, self.type, self.name))
+
+    def __reduce__(self):
+        return self.__class__, (self.id, self.type, self.name)
+
+    def mutable_copy(self):
+        return SimpleNode(id=self.id, type=self.type, name=self.name)
+
+
+class GraphInterner(object):
+    """
+    Shares one copy of repeated strings, and one read only FrozenSimpleNode per node id, between service results.
+
+    Variant to gene results refer to the same genes and predicates over and over again, so without sharing every result
+    carries its own copies of them. An interner keeps everything it has seen until it's cleared or dropped, so it should
+    be scoped to something with a bounded set of nodes, like a service or a run.
+    """
+
+    def __init__(self, share_nodes: bool = True):
+        """
+        :param share_nodes: if False get_node creates a new mutable SimpleNode every time, only sharing its strings
+        """
+        self.share_nodes = share_nodes
+        self.strings = {}
+        self.nodes = {}
+
+    def intern(self, string: str):
+        return self.strings.setdefault(string, string)
+
+    def get_node(self, node_id: str, node_type: str, name: str):
+        """
+        :return: the shared FrozenSimpleNode for the node id, or a new SimpleNode if share_nodes is False
+        """
+        if not self.share_nodes:
+            return SimpleNode(id=self.intern(node_id), type=self.intern(node_type), name=self.intern(name))
+        node = self.nodes.get(node_id)
+        if node is None or node.type != node_type or node.name != name:
+            node = FrozenSimpleNode(id=self.intern(node_id), type=self.intern(node_type), name=self.intern(name))
+            self.nodes[node.id] = node
+        return node
+
+    def clear(self):
+        self.strings.clear()
+        self.nodes.clear()
+
 
 @dataclass
 class SimpleEdge:
@@ -32,3 +158,6 @@ class SimpleEdge:
     predicate_label: str
     ctime: int
     properties: dict = field(default_factory=dict)
+
+
+SimpleEdge = add_slots(SimpleEdge)
@@ -0,0 +1,347 @@
+import os
+import time
+import random
+import logging
+import threading
+import cProfile
+import pstats
+import io
+from robokop_genetics.util import LoggingUtil
+
+# set to 1 (or true/yes) to trace every run that doesn't turn tracing on or off itself
+TRACING_ENV_VARIABLE = 'ROBO_GENETICS_TRACING'
+# the fraction of runs to profile with cProfile, eg. 0.01, defaults to none
+PROFILE_SAMPLE_RATE_ENV_VARIABLE = 'ROBO_GENETICS_PROFILE_SAMPLE_RATE'
+
+# spans taking longer than this many seconds are logged as slow calls, by span name
+DEFAULT_SLOW_THRESHOLDS = {
+    'clingen_http': 10.0,
+    'redis_pipeline': 1.0,
+    'json_decode': 1.0,
+    'parse_result': 5.0,
+    'biolink_load': 5.0,
+}
+
+# after this many spans in one run only the summary is kept, not the individual spans
+DEFAULT_MAX_SPANS_PER_RUN = 10_000
+
+_active = threading.local()
+_profile_lock = threading.Lock()
+
+
+class Span(object):
+    """
+    A timed part of a traced run, with attributes like sizes and counts, and the spans started inside it.
+
+    Numeric attributes are summed per span path in the run summary.
+    """
+
+    __slots__ = ('name', 'attributes', 'path', 'start_time', 'duration', 'children', 'run')
+
+    def __init__(self, name: str, attributes: dict, run):
+        self.name = name
+        self.attributes = attributes
+        self.run = run
+        self.path = name
+        self.start_time = None
+        self.duration = None
+        self.children = []
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.run.push(self)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.start_time
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.run.pop(self)
+        return False
+
+    def __repr__(self):
+        return f'Span({self.path!r}, duration={self.duration!r}, attributes={self.attributes!r})'
+
+
+class NullSpan(object):
+    """Returned instead of a Span when nothing is being traced, so instrumented code doesn't have to check."""
+
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class SpanSummary(object):
+
+    __slots__ = ('path', 'count', 'seconds', 'max_seconds', 'sizes')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.sizes = {}
+
+    def add(self, duration: float, attributes: dict):
+        self.count += 1
+        self.seconds += duration
+        self.max_seconds = max(self.max_seconds, duration)
+        for attribute, value in attributes.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.sizes[attribute] = self.sizes.get(attribute, 0) + value
+
+    def __repr__(self):
+        return f'SpanSummary({self.path!r}, count={self.count}, seconds={self.seconds:.6f}, sizes={self.sizes!r})'
+
+
+class TraceRun(object):
+    """
+    The spans of one traced run (eg. one normalize_variants call) on one thread.
+    """
+
+    def __init__(self, tracer, root_span_name: str, attributes: dict):
+        self.tracer = tracer
+        self.root_span = Span(root_span_name, attributes, self)
+        self.stack = []
+        self.num_spans = 0
+        # span path -> SpanSummary, in the order the paths were first seen
+        self.summaries = {}
+        self.slow_spans = []
+
+    def push(self, span: Span):
+        if self.stack:
+            parent = self.stack[-1]
+            span.path = f'{parent.path}/{span.name}'
+            self.num_spans += 1
+            if self.num_spans <= self.tracer.max_spans_per_run:
+                parent.children.append(span)
+        self.stack.append(span)
+
+    def pop(self, span: Span):
+        self.stack.pop()
+        self.record(span)
+
+    def record(self, span: Span):
+        summary = self.summaries.get(span.path)
+        if summary is None:
+            summary = self.summaries[span.path] = SpanSummary(span.path)
+        summary.add(span.duration, span.attributes)
+        slow_threshold = self.tracer.get_slow_threshold(span.name)
+        if slow_threshold is not None and span.duration >= slow_threshold:
+            self.slow_spans.append(span)
+            self.tracer.logger.warning(f'Slow call: {span.path} took {span.duration:.3f}s '
+                                       f'(threshold {slow_threshold}s) {span.attributes}')
+
+    def record_span(self, name: str, duration: float, attributes: dict):
+        span = Span(name, attributes, self)
+        span.duration = duration
+        self.push(span)
+        self.pop(span)
+
+    def get_summary(self):
+        """
+        :return: a list of SpanSummary, one per span path, with the run itself first
+        """
+        return list(self.summaries.values())
+
+    def format_summary(self):
+        root_seconds = self.root_span.duration or 0
+        lines = [f'Trace summary for {self.root_span.name} ({root_seconds:.3f}s, {self.num_spans} spans, '
+                 f'{len(self.slow_spans)} slow):']
+        for summary in sorted(self.summaries.values(), key=lambda span_summary: span_summary.path):
+            percent = 100 * summary.seconds / root_seconds if root_seconds else 0
+            sizes = ' '.join(f'{attribute}={value:,}' for attribute, value in summary.sizes.items())
+            lines.append(f'  {summary.path}: {summary.count} calls, {summary.seconds:.3f}s ({percent:.0f}%), '
+                         f'max {summary.max_seconds:.3f}s {sizes}'.rstrip())
+        return '\n'.join(lines)
+
+
+class TraceRunContext(object):
+    """Activates a TraceRun on the current thread for the duration of a with block."""
+
+    __slots__ = ('trace_run',)
+
+    def __init__(self, trace_run: TraceRun):
+        self.trace_run = trace_run
+
+    def __enter__(self):
+        _active.run = self.trace_run
+        return self.trace_run.root_span.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.trace_run.root_span.__exit__(exc_type, exc_value, traceback)
+        finally:
+            _active.run = None
+        self.trace_run.tracer.finish_run(self.trace_run)
+        return False
+
+
+class ProfileContext(object):
+    """Profiles a with block with cProfile, saving and logging the stats afterwards."""
+
+    __slots__ = ('tracer', 'name', 'profiler')
+
+    def __init__(self, tracer, name: str):
+        self.tracer = tracer
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        # only one profiler can run at a time, other threads just aren't sampled
+        if _profile_lock.acquire(blocking=False):
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler is not None:
+            self.profiler.disable()
+            _profile_lock.release()
+            self.tracer.save_profile(self.name, self.profiler)
+        return False
+
+
+class Tracer(object):
+    """
+    Records nested spans for runs of normalize_variants and get_variant_to_gene, or anything started with trace_run,
+    then logs a summary of where the time went. Spans over their slow threshold are logged as they finish.
+
+    Spans are tracked per thread, instrumented code finds the current run with the module level span function. When
+    tracing is off trace_run and span return NULL_SPAN, which does nothing. Work done on other threads (eg. the write
+    behind cache writer) isn't included in a run.
+
+    Runs can also be sampled with cProfile, see profile.
+    """
+
+    logger = LoggingUtil.init_logging(__name__,
+                                      logging.INFO,
+                                      log_file_path=LoggingUtil.get_logging_path())
+
+    def __init__(self,
+                 enabled: bool = None,
+                 slow_thresholds: dict = None,
+                 default_slow_threshold: float = None,
+                 max_spans_per_run: int = DEFAULT_MAX_SPANS_PER_RUN,
+                 profile_sample_rate: float = None,
+                 profile_dir: str = None):
+        """
+        :param enabled: whether runs are traced, defaults to the ROBO_GENETICS_TRACING environment variable
+        :param slow_thresholds: span name -> seconds, added to (or replacing) DEFAULT_SLOW_THRESHOLDS
+        :param default_slow_threshold: seconds for spans without a threshold, by default they're never slow
+        :param max_spans_per_run: how many individual spans to keep per run, the summary includes every span
+        :param profile_sample_rate: the fraction of profiled runs to capture, defaults to the
+        ROBO_GENETICS_PROFILE_SAMPLE_RATE environment variable or 0
+        :param profile_dir: where profiles are saved, defaults to the logging directory
+        """
+        if enabled is None:
+            enabled = os.environ.get(TRACING_ENV_VARIABLE, '').lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        self.slow_thresholds = dict(DEFAULT_SLOW_THRESHOLDS)
+        if slow_thresholds:
+            self.slow_thresholds.update(slow_thresholds)
+        self.default_slow_threshold = default_slow_threshold
+        self.max_spans_per_run = max_spans_per_run
+        if profile_sample_rate is None:
+            profile_sample_rate = float(os.environ.get(PROFILE_SAMPLE_RATE_ENV_VARIABLE, 0) or 0)
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_dir = profile_dir
+        self.last_run = None
+        self.last_profile_path = None
+
+    def get_slow_threshold(self, span_name: str):
+        return self.slow_thresholds.get(span_name, self.default_slow_threshold)
+
+    def trace_run(self, name: str, **attributes):
+        """
+        Trace a run, use it as a context manager: with tracer.trace_run('normalize_variants', variants=10) as span:
+
+        Inside a run that's already being traced this is just a span of that run.
+        """
+        active_run = getattr(_active, 'run', None)
+        if active_run is not None:
+            return Span(name, attributes, active_run)
+        if not self.enabled:
+            return NULL_SPAN
+        return TraceRunContext(TraceRun(self, name, attributes))
+
+    def finish_run(self, trace_run: TraceRun):
+        self.last_run = trace_run
+        self.logger.info(trace_run.format_summary())
+
+    def profile(self, name: str):
+        """
+        Profile a sample of runs, use it as a context manager. The stats for each sampled run are saved to a file
+        (see last_profile_path) that can be read with pstats or snakeviz, and the top functions are logged.
+        """
+        if not self.profile_sample_rate or random.random() >= self.profile_sample_rate:
+            return NULL_SPAN
+        return ProfileContext(self, name)
+
+    def save_profile(self, name: str, profiler: cProfile.Profile):
+        profile_dir = self.profile_dir if self.profile_dir else LoggingUtil.get_logging_path()
+        profile_path = os.path.join(profile_dir, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-'
+                                                 f'{threading.get_ident()}.prof')
+        try:
+            profiler.dump_stats(profile_path)
+            self.last_profile_path = profile_path
+        except OSError as e:
+            self.logger.error(f'Could not save the {name} profile to {profile_path}: {e}')
+            profile_path = None
+        stats_output = io.StringIO()
+        pstats.Stats(profiler, stream=stats_output).sort_stats('cumulative').print_stats(15)
+        self.logger.info(f'Profiled {name} (saved to {profile_path}):\n{stats_output.getvalue()}')
+
+
+def span(name: str, **attributes):
+    """
+    A span of the run being traced on this thread, use it as a context manager: with span('redis_pipeline') as s:
+
+    :return: a Span, or NULL_SPAN if nothing is being traced
+    """
+    active_run = getattr(_active, 'run', None)
+    if active_run is None:
+        return NULL_SPAN
+    return Span(name, attributes, active_run)
+
+
+def record_span(name: str, duration: float, **attributes):
+    """Add a span for work that was timed elsewhere, eg. in a worker process, to the run being traced on this thread"""
+    active_run = getattr(_active, 'run', None)
+    if active_run is not None:
+        active_run.record_span(name, duration, attributes)
+
+
+_default_tracer = None
+
+
+def get_tracer(tracing: bool = None):
+    """
+    :param tracing: True or False for a new tracer that is on or off, or None for the process wide tracer
+    (configured by environment variables, see Tracer)
+    """
+    global _default_tracer
+    if tracing is not None:
+        return Tracer(enabled=tracing)
+    if _default_tracer is None:
+        _default_tracer = Tracer()
+    return _default_tracer
+
+
+def set_tracer(tracer: Tracer):
+    """Set the process wide tracer, None goes back to one configured by environment variables."""
+    global _default_tracer
+    _default_tracer = tracer
@@ -0,0 +1,27 @@
+from collections import namedtuple
+
+ROBO_VARIANT_PREFIX = 'ROBO_VARIANT'
+
+# the fields of a robokop variant key, eg. ROBO_VARIANT:HG38|17|58206171|58206172|A|G
+RobokopVariant = namedtuple('RobokopVariant', ['reference_genome', 'chromosome', 'start_position', 'end_position',
+                                               'reference_allele', 'alternate_allele'])
+
+
+def parse_robokop_variant_id(robokop_variant_id: str):
+    """
+    :param robokop_variant_id: a ROBO_VARIANT curie, or the part after the prefix
+    :return: a RobokopVariant
+    :raises ValueError: if it isn't a valid key
+    """
+    if ':' in robokop_variant_id:
+        robokop_variant_id = robokop_variant_id.split(':', 1)[1]
+    fields = robokop_variant_id.split('|')
+    if len(fields) != 6:
+        raise ValueError(f'Robokop variant keys have 6 fields: {robokop_variant_id}')
+    reference_genome, chromosome, start_position, end_position, reference_allele, alternate_allele = fields
+    return RobokopVariant(reference_genome, chromosome, int(start_position), int(end_position), reference_allele,
+                          alternate_allele)
+
+
+def format_robokop_variant_id(robokop_variant: RobokopVariant):
+    return f'{ROBO_VARIANT_PREFIX}:{"|".join(map(str, robokop_variant))}'
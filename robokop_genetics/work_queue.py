@@ -0,0 +1,391 @@
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from itertools import islice
+
+import redis
+
+from robokop_genetics.genetics_cache import GeneticsCache
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+from robokop_genetics.metrics import MetricsSink, get_metrics_sink, WORK_QUEUE_CHUNKS
+from robokop_genetics.services.clingen import CLINGEN_URL
+from robokop_genetics.util import LoggingUtil
+
+DEFAULT_WORK_CHUNK_SIZE = 50_000
+DEFAULT_WORK_LEASE_SECONDS = 300
+# a chunk that was claimed this many times without being acknowledged is set aside as failed
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_INTERVAL = 5.0
+
+
+@dataclass
+class WorkChunk:
+    chunk_id: str
+    variant_ids: list
+    attempt: int
+    # identifies this claim of the chunk, only its holder can renew, acknowledge or release it
+    lease_token: str = None
+
+
+@dataclass
+class WorkQueueProgress:
+    num_chunks: int
+    num_variants: int
+    chunks_done: int
+    variants_done: int
+    normalization_errors: int
+    chunks_failed: int
+    chunks_leased: int
+    chunks_available: int
+    enqueue_finished: bool
+    seconds: float
+
+    @property
+    def finished(self):
+        return self.enqueue_finished and not self.chunks_leased and not self.chunks_available
+
+    def __str__(self):
+        variants_per_second = self.variants_done / self.seconds if self.seconds > 0 else 0
+        return (f'{self.chunks_done}/{self.num_chunks} chunks done ({self.variants_done}/{self.num_variants} '
+                f'variants, {self.normalization_errors} normalization errors), {self.chunks_leased} leased, '
+                f'{self.chunks_available} waiting, {self.chunks_failed} failed, '
+                f'{variants_per_second:.1f} variants/s')
+
+
+class NormalizationWorkQueue(object):
+    """
+    A queue of variant chunks to normalize, kept in the redis of a GeneticsCache, shared by a coordinator which
+    enqueues the variants and any number of workers on any number of machines.
+
+    Every chunk waiting or being worked on is in one sorted set, scored by when its lease runs out (0 for chunks never
+    claimed). A worker claims a chunk with a score in the past, which covers new chunks and chunks whose worker died
+    or stalled, and sets its score to the end of its lease. Claims, renewals and acknowledgements are redis
+    transactions that WATCH the chunk's owner key, so when two workers go for the same chunk only one of them gets it,
+    and a worker whose lease was taken over can't acknowledge or renew the chunk anymore.
+
+    Workers write the normalizations to the cache (through their GeneticsNormalizer) before acknowledging a chunk,
+    so the results outlive the queue. Progress is counted in redis and available to everyone with get_progress.
+    """
+
+    logger = LoggingUtil.init_logging(__name__,
+                                      logging.INFO,
+                                      log_file_path=LoggingUtil.get_logging_path())
+
+    def __init__(self,
+                 cache: GeneticsCache,
+                 job_id: str,
+                 lease_seconds: float = DEFAULT_WORK_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 metrics: MetricsSink = None):
+        """
+        :param cache: the cache whose redis holds the queue, and where workers write their results
+        :param job_id: identifies one run, the coordinator and the workers need to use the same one
+        :param lease_seconds: how long a worker has to finish (or renew) a chunk before others can claim it
+        :param max_attempts: how many times a chunk can be claimed before it's set aside as failed
+        """
+        self.cache = cache
+        self.redis = cache.redis
+        self.job_id = job_id
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.metrics = metrics
+
+        key_prefix = f'{cache.prefix}work-{job_id}-'
+        self.QUEUE_KEY = f'{key_prefix}queue'
+        self.CHUNKS_KEY = f'{key_prefix}chunks'
+        self.ATTEMPTS_KEY = f'{key_prefix}attempts'
+        self.PROGRESS_KEY = f'{key_prefix}progress'
+        self.FAILED_KEY = f'{key_prefix}failed'
+        self.LEASE_KEY_PREFIX = f'{key_prefix}lease-'
+
+    def enqueue(self, variant_ids, chunk_size: int = DEFAULT_WORK_CHUNK_SIZE):
+        """
+        Split variants into chunks and queue them. Workers can start on the first chunks while the rest are enqueued.
+
+        :param variant_ids: an iterable of variant curies, eg. a generator reading them from a file
+        :param chunk_size: the number of variants in each chunk
+        :return: the number of chunks enqueued
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.hsetnx(self.PROGRESS_KEY, 'started_at', self.__get_redis_time())
+        pipeline.hset(self.PROGRESS_KEY, 'enqueue_finished', 0)
+        pipeline.execute()
+        num_chunks = 0
+        variant_ids = iter(variant_ids)
+        while True:
+            variant_id_chunk = list(islice(variant_ids, chunk_size))
+            if not variant_id_chunk:
+                break
+            # zero padded so chunks are claimed in the order they were enqueued
+            chunk_id = f'{self.redis.hincrby(self.PROGRESS_KEY, "num_chunks", 1) - 1:010d}'
+            pipeline = self.redis.pipeline()
+            pipeline.hset(self.CHUNKS_KEY, chunk_id, '\n'.join(variant_id_chunk))
+            pipeline.zadd(self.QUEUE_KEY, {chunk_id: 0})
+            pipeline.hincrby(self.PROGRESS_KEY, 'num_variants', len(variant_id_chunk))
+            pipeline.execute()
+            num_chunks += 1
+        self.redis.hset(self.PROGRESS_KEY, 'enqueue_finished', 1)
+        get_metrics_sink(self.metrics).increment(WORK_QUEUE_CHUNKS, num_chunks, event='enqueued')
+        self.logger.info(f'Work queue {self.job_id} enqueued {num_chunks} chunks.')
+        return num_chunks
+
+    def claim_chunk(self):
+        """
+        Lease the next chunk that is waiting, or whose lease ran out.
+
+        :return: a WorkChunk, or None if there's nothing to claim right now (chunks may still be leased by others)
+        """
+        metrics = get_metrics_sink(self.metrics)
+        while True:
+            now = self.__get_redis_time()
+            candidate_chunk_ids = self.redis.zrangebyscore(self.QUEUE_KEY, '-inf', now, start=0, num=10)
+            if not candidate_chunk_ids:
+                return None
+            for chunk_id in candidate_chunk_ids:
+                chunk_id = chunk_id.decode('utf-8')
+                lease_key = f'{self.LEASE_KEY_PREFIX}{chunk_id}'
+                # every claim gets its own token, so workers sharing a queue or a cache can't touch each other's chunks
+                lease_token = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}'
+                with self.redis.pipeline() as pipeline:
+                    try:
+                        # every claim writes the lease key, so if another worker claims the chunk first this fails
+                        pipeline.watch(lease_key)
+                        lease_end = pipeline.zscore(self.QUEUE_KEY, chunk_id)
+                        if lease_end is None or lease_end > now:
+                            continue
+                        attempt = int(pipeline.hget(self.ATTEMPTS_KEY, chunk_id) or 0) + 1
+                        pipeline.multi()
+                        if attempt > self.max_attempts:
+                            pipeline.zrem(self.QUEUE_KEY, chunk_id)
+                            pipeline.delete(lease_key)
+                            pipeline.sadd(self.FAILED_KEY, chunk_id)
+                            pipeline.hincrby(self.PROGRESS_KEY, 'chunks_failed', 1)
+                            pipeline.execute()
+                            self.logger.error(f'Work queue {self.job_id} chunk {chunk_id} failed after '
+                                              f'{self.max_attempts} attempts.')
+                            metrics.increment(WORK_QUEUE_CHUNKS, event='failed')
+                            continue
+                        pipeline.zadd(self.QUEUE_KEY, {chunk_id: now + self.lease_seconds})
+                        pipeline.set(lease_key, lease_token)
+                        pipeline.hset(self.ATTEMPTS_KEY, chunk_id, attempt)
+                        pipeline.hget(self.CHUNKS_KEY, chunk_id)
+                        chunk_variants = pipeline.execute()[-1]
+                    except redis.WatchError:
+                        continue
+                if attempt > 1:
+                    self.logger.info(f'Work queue {self.job_id} reclaimed chunk {chunk_id} (attempt {attempt}).')
+                metrics.increment(WORK_QUEUE_CHUNKS, event='reclaimed' if attempt > 1 else 'claimed')
+                return WorkChunk(chunk_id, chunk_variants.decode('utf-8').split('\n'), attempt, lease_token)
+
+    def renew_lease(self, work_chunk: WorkChunk):
+        """
+        Extend the lease on a chunk that is taking a while.
+
+        :return: False if the lease was already taken over by another worker
+        """
+        lease_end = self.__get_redis_time() + self.lease_seconds
+
+        def renew(pipeline, lease_key: str):
+            pipeline.zadd(self.QUEUE_KEY, {work_chunk.chunk_id: lease_end}, xx=True)
+        return self.__update_leased_chunk(work_chunk, renew, 'renewed')
+
+    def acknowledge(self, work_chunk: WorkChunk, num_normalization_errors: int = 0):
+        """
+        Mark a chunk as done, once its results are in the cache.
+
+        :return: False if the lease was taken over by another worker, who will acknowledge the chunk instead
+        """
+        def acknowledge(pipeline, lease_key: str):
+            pipeline.zrem(self.QUEUE_KEY, work_chunk.chunk_id)
+            pipeline.delete(lease_key)
+            pipeline.hdel(self.CHUNKS_KEY, work_chunk.chunk_id)
+            pipeline.hdel(self.ATTEMPTS_KEY, work_chunk.chunk_id)
+            pipeline.hincrby(self.PROGRESS_KEY, 'chunks_done', 1)
+            pipeline.hincrby(self.PROGRESS_KEY, 'variants_done', len(work_chunk.variant_ids))
+            pipeline.hincrby(self.PROGRESS_KEY, 'normalization_errors', num_normalization_errors)
+        return self.__update_leased_chunk(work_chunk, acknowledge, 'acknowledged')
+
+    def release(self, work_chunk: WorkChunk):
+        """
+        Give a chunk back without finishing it, so another worker can claim it right away.
+        """
+        def release(pipeline, lease_key: str):
+            pipeline.zadd(self.QUEUE_KEY, {work_chunk.chunk_id: 0})
+            pipeline.delete(lease_key)
+        return self.__update_leased_chunk(work_chunk, release, 'released')
+
+    def __update_leased_chunk(self, work_chunk: WorkChunk, add_commands, event: str):
+        lease_key = f'{self.LEASE_KEY_PREFIX}{work_chunk.chunk_id}'
+        with self.redis.pipeline() as pipeline:
+            try:
+                pipeline.watch(lease_key)
+                lease_token = pipeline.get(lease_key)
+                if lease_token is None or lease_token.decode('utf-8') != work_chunk.lease_token:
+                    raise redis.WatchError()
+                pipeline.multi()
+                add_commands(pipeline, lease_key)
+                pipeline.execute()
+            except redis.WatchError:
+                self.logger.warning(f'Work queue {self.job_id} chunk {work_chunk.chunk_id} was taken over by another '
+                                    f'worker.')
+                get_metrics_sink(self.metrics).increment(WORK_QUEUE_CHUNKS, event='lost')
+                return False
+        get_metrics_sink(self.metrics).increment(WORK_QUEUE_CHUNKS, event=event)
+        return True
+
+    def get_progress(self):
+        now = self.__get_redis_time()
+        pipeline = self.redis.pipeline()
+        pipeline.hgetall(self.PROGRESS_KEY)
+        pipeline.zcount(self.QUEUE_KEY, '-inf', now)
+        pipeline.zcount(self.QUEUE_KEY, f'({now}', '+inf')
+        progress, chunks_available, chunks_leased = pipeline.execute()
+        progress = {field.decode('utf-8'): float(value) for field, value in progress.items()}
+        return WorkQueueProgress(num_chunks=int(progress.get('num_chunks', 0)),
+                                 num_variants=int(progress.get('num_variants', 0)),
+                                 chunks_done=int(progress.get('chunks_done', 0)),
+                                 variants_done=int(progress.get('variants_done', 0)),
+                                 normalization_errors=int(progress.get('normalization_errors', 0)),
+                                 chunks_failed=int(progress.get('chunks_failed', 0)),
+                                 chunks_leased=chunks_leased,
+                                 chunks_available=chunks_available,
+                                 enqueue_finished=bool(progress.get('enqueue_finished')),
+                                 seconds=now - progress['started_at'] if 'started_at' in progress else 0)
+
+    def wait_until_finished(self, poll_interval: float = DEFAULT_POLL_INTERVAL, timeout: float = None):
+        """
+        Log the progress of every worker together until all the chunks are done or failed.
+
+        :return: the final WorkQueueProgress
+        """
+        start_time = time.monotonic()
+        while True:
+            progress = self.get_progress()
+            self.logger.info(f'Work queue {self.job_id}: {progress}')
+            if progress.finished:
+                return progress
+            if timeout is not None and time.monotonic() - start_time > timeout:
+                raise TimeoutError(f'Work queue {self.job_id} did not finish in {timeout} seconds.')
+            time.sleep(poll_interval)
+
+    def get_failed_variant_ids(self):
+        failed_chunk_ids = sorted(self.redis.smembers(self.FAILED_KEY))
+        if not failed_chunk_ids:
+            return []
+        failed_chunks = self.redis.hmget(self.CHUNKS_KEY, failed_chunk_ids)
+        return [variant_id for chunk in failed_chunks if chunk for variant_id in chunk.decode('utf-8').split('\n')]
+
+    def delete(self):
+        lease_keys = list(self.cache.scan_keys_with_prefix(self.LEASE_KEY_PREFIX))
+        self.redis.delete(self.QUEUE_KEY, self.CHUNKS_KEY, self.ATTEMPTS_KEY, self.PROGRESS_KEY, self.FAILED_KEY,
+                          *lease_keys)
+
+    def __get_redis_time(self):
+        # every worker uses the redis clock for leases, so their own clocks don't need to agree
+        seconds, microseconds = self.redis.time()
+        return seconds + microseconds / 1_000_000
+
+
+class NormalizationWorker(object):
+    """
+    Claims chunks from a NormalizationWorkQueue and normalizes them with a GeneticsNormalizer, which writes the
+    results to the cache, then acknowledges them. The lease on a chunk is renewed in the background while it's
+    normalized. A chunk that fails is released for another attempt.
+    """
+
+    logger = LoggingUtil.init_logging(__name__,
+                                      logging.INFO,
+                                      log_file_path=LoggingUtil.get_logging_path())
+
+    def __init__(self, work_queue: NormalizationWorkQueue, normalizer: GeneticsNormalizer):
+        if normalizer.cache is None:
+            raise ValueError('Normalization workers need a normalizer with a cache, that is where results go.')
+        self.work_queue = work_queue
+        self.normalizer = normalizer
+
+    def run(self, max_chunks: int = None, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        """
+        Work until the queue is finished (or max_chunks are done). While the only chunks left are leased by other
+        workers, check back every poll_interval seconds in case their leases run out.
+
+        :return: the number of chunks this worker acknowledged
+        """
+        num_chunks = 0
+        while max_chunks is None or num_chunks < max_chunks:
+            work_chunk = self.work_queue.claim_chunk()
+            if work_chunk is None:
+                if self.work_queue.get_progress().finished:
+                    break
+                time.sleep(poll_interval)
+                continue
+            if self.process_chunk(work_chunk):
+                num_chunks += 1
+        self.logger.info(f'Normalization worker finished {num_chunks} chunks from work queue '
+                         f'{self.work_queue.job_id}.')
+        return num_chunks
+
+    def process_chunk(self, work_chunk: WorkChunk):
+        stop_renewing = threading.Event()
+        lease_renewer = threading.Thread(target=self.__renew_lease, args=(work_chunk, stop_renewing), daemon=True)
+        lease_renewer.start()
+        try:
+            normalization_map = self.normalizer.normalize_variants(work_chunk.variant_ids)
+        except Exception as e:
+            self.logger.error(f'Normalization worker failed on chunk {work_chunk.chunk_id}: {e}')
+            stop_renewing.set()
+            lease_renewer.join()
+            self.work_queue.release(work_chunk)
+            return False
+        stop_renewing.set()
+        lease_renewer.join()
+        num_normalization_errors = sum(1 for normalizations in normalization_map.values()
+                                       for normalization in normalizations if 'error_type' in normalization)
+        return self.work_queue.acknowledge(work_chunk, num_normalization_errors)
+
+    def __renew_lease(self, work_chunk: WorkChunk, stop_renewing: threading.Event):
+        while not stop_renewing.wait(self.work_queue.lease_seconds / 3):
+            if not self.work_queue.renew_lease(work_chunk):
+                return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Normalize a large list of variants on many machines. The coordinator '
+                                                 'enqueues the variants and reports progress, workers normalize them '
+                                                 'into the cache. The cache and queue are located using the '
+                                                 'ROBO_GENETICS_CACHE environment variables.')
+    parser.add_argument('job_id')
+    parser.add_argument('--cache-prefix', default='', help='the prefix the GeneticsCache was created with')
+    parser.add_argument('--lease-seconds', type=float, default=DEFAULT_WORK_LEASE_SECONDS)
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    coordinator_parser = subparsers.add_parser('coordinate', help='enqueue variants and wait for the workers')
+    coordinator_parser.add_argument('variants_path', help='a file with one variant curie per line')
+    coordinator_parser.add_argument('--chunk-size', type=int, default=DEFAULT_WORK_CHUNK_SIZE)
+    coordinator_parser.add_argument('--poll-interval', type=float, default=30)
+
+    worker_parser = subparsers.add_parser('work', help='normalize chunks until the queue is finished')
+    worker_parser.add_argument('--clingen-url', default=CLINGEN_URL)
+
+    subparsers.add_parser('progress', help='print the progress of the job')
+
+    args = parser.parse_args()
+    genetics_cache = GeneticsCache(prefix=args.cache_prefix)
+    normalization_work_queue = NormalizationWorkQueue(genetics_cache, args.job_id, lease_seconds=args.lease_seconds,
+                                                      max_attempts=args.max_attempts)
+    if args.command == 'coordinate':
+        with open(args.variants_path) as variants_file:
+            normalization_work_queue.enqueue((line.strip() for line in variants_file if line.strip()),
+                                             chunk_size=args.chunk_size)
+        normalization_work_queue.wait_until_finished(poll_interval=args.poll_interval)
+    elif args.command == 'work':
+        with GeneticsNormalizer(cache=genetics_cache, cache_write_behind=True,
+                                clingen_url=args.clingen_url) as genetics_normalizer:
+            NormalizationWorker(normalization_work_queue, genetics_normalizer).run()
+    else:
+        print(normalization_work_queue.get_progress())
@@ -0,0 +1,67 @@
+import json
+import os
+import socket
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+
+def make_allele_json(caid: str, rsid: int):
+    return {'@id': f'http://reg.genome.network/allele/{caid}',
+            'externalRecords': {'dbSNP': [{'rs': rsid}]}}
+
+
+class ClinGenStandIn(BaseHTTPRequestHandler):
+    """Answers batch CAID queries with one allele per id, and dbSNP lookups with an allele or a ClinGen error."""
+
+    def do_POST(self):
+        caids = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8').split('\n')
+        self.send_json(200, [make_allele_json(caid, i) for i, caid in enumerate(caids)])
+
+    def do_GET(self):
+        if 'dbSNP.rs=rs1&' in self.path:
+            self.send_json(200, [make_allele_json('CA1', 1)])
+        else:
+            self.send_json(400, {'errorType': 'IncorrectRequest', 'description': 'bad rs id'})
+
+    def send_json(self, status_code: int, response_json):
+        response_body = json.dumps(response_json).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def clingen_url():
+    server = HTTPServer(('127.0.0.1', 0), ClinGenStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def redis_stand_in():
+    """Connection info for a redis to test against - the cache from the environment, or a local stand-in."""
+    if 'ROBO_GENETICS_CACHE_HOST' in os.environ:
+        yield {'redis_host': os.environ['ROBO_GENETICS_CACHE_HOST'],
+               'redis_port': int(os.environ['ROBO_GENETICS_CACHE_PORT']),
+               'redis_db': int(os.environ['ROBO_GENETICS_CACHE_DB']),
+               'redis_password': os.environ['ROBO_GENETICS_CACHE_PASSWORD']}
+        return
+    fakeredis = pytest.importorskip('fakeredis')
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+    server = fakeredis.TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield {'redis_host': '127.0.0.1', 'redis_port': port, 'redis_db': 0, 'redis_password': ''}
+    server.shutdown()
+    server.server_close()
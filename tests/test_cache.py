@@ -1,6 +1,7 @@
 import pytest
 import os
 from robokop_genetics.genetics_cache import GeneticsCache
+from robokop_genetics.simple_graph_components import SimpleEdge, SimpleNode
 from robokop_genetics.genetics_services import *
 
 
@@ -134,3 +135,123 @@ def test_service_results_cache(genetics_cache, genetics_services):
     assert 'HGNC:9366' in identifiers
     predicates = [edge.predicate_id for edge, node in results]
     assert 'SNPEFF:intron_variant' in predicates
+
+
+def test_cache_snapshot(genetics_cache, mock_normalizations, tmp_path):
+    from robokop_genetics.cache_snapshot import export_cache_snapshot, import_cache_snapshot
+
+    genetics_cache.set_batch_normalization(mock_normalizations)
+    snapshot_path = str(tmp_path / 'cache_snapshot.jsonl.gz')
+    key_prefixes = [genetics_cache.NORMALIZATION_KEY_PREFIX]
+    num_exported = export_cache_snapshot(genetics_cache, snapshot_path, key_prefixes=key_prefixes, chunk_size=3)
+    assert num_exported == len(mock_normalizations)
+
+    genetics_cache.delete_all_keys_with_prefix(genetics_cache.prefix)
+    assert not genetics_cache.get_batch_normalization(list(mock_normalizations.keys()))
+
+    num_imported = import_cache_snapshot(genetics_cache, snapshot_path, num_loaders=2)
+    assert num_imported == len(mock_normalizations)
+    cached_normalizations = genetics_cache.get_batch_normalization(list(mock_normalizations.keys()))
+    for node_id, normalization in mock_normalizations.items():
+        assert cached_normalizations[node_id] == list(normalization)
+
+
+def test_membership_filter_cache(genetics_cache, mock_normalizations):
+    from robokop_genetics.genetics_cache import MEMBERSHIP_FILTER_REDIS
+
+    filtered_cache = GeneticsCache(prefix=genetics_cache.prefix,
+                                   membership_filter=MEMBERSHIP_FILTER_REDIS,
+                                   membership_filter_capacity=1000)
+    filtered_cache.set_batch_normalization(mock_normalizations)
+    node_ids = list(mock_normalizations.keys()) + ['TESTINGCURIE:NOTCACHED']
+    cached_normalizations = filtered_cache.get_batch_normalization(node_ids)
+    assert set(cached_normalizations.keys()) == set(mock_normalizations.keys())
+
+    # a second client sharing the filter through redis sees the same keys
+    other_cache = GeneticsCache(prefix=genetics_cache.prefix, membership_filter=MEMBERSHIP_FILTER_REDIS)
+    assert other_cache.membership_filter.get_parameters() == filtered_cache.membership_filter.get_parameters()
+    assert set(other_cache.get_batch_normalization(node_ids).keys()) == set(mock_normalizations.keys())
+
+
+def test_membership_filter_writers_without_filter(genetics_cache, mock_normalizations, tmp_path):
+    from robokop_genetics.genetics_cache import MEMBERSHIP_FILTER_REDIS
+    from robokop_genetics.cache_snapshot import export_cache_snapshot, import_cache_snapshot
+
+    # genetics_cache has no filter of its own and was created before the filter, its keys are still added to it
+    filtered_cache = GeneticsCache(prefix=genetics_cache.prefix,
+                                   membership_filter=MEMBERSHIP_FILTER_REDIS,
+                                   membership_filter_capacity=1000)
+    genetics_cache.set_batch_normalization(mock_normalizations)
+    node_ids = list(mock_normalizations.keys())
+    filtered_cache.refresh_membership_filter()
+    assert set(filtered_cache.get_batch_normalization(node_ids).keys()) == set(node_ids)
+
+    # so are keys imported from a snapshot by a client without a filter, like the snapshot command line does
+    snapshot_path = str(tmp_path / 'cache_snapshot.jsonl.gz')
+    export_cache_snapshot(genetics_cache, snapshot_path, key_prefixes=[genetics_cache.NORMALIZATION_KEY_PREFIX])
+    genetics_cache.delete_all_keys_with_prefix(genetics_cache.prefix)
+    filtered_cache = GeneticsCache(prefix=genetics_cache.prefix,
+                                   membership_filter=MEMBERSHIP_FILTER_REDIS,
+                                   membership_filter_capacity=1000)
+    assert not filtered_cache.get_batch_normalization(node_ids)
+    assert import_cache_snapshot(GeneticsCache(prefix=genetics_cache.prefix), snapshot_path) == len(node_ids)
+    filtered_cache.refresh_membership_filter()
+    assert set(filtered_cache.get_batch_normalization(node_ids).keys()) == set(node_ids)
+    genetics_cache.delete_all_keys_with_prefix(genetics_cache.prefix)
+
+
+def test_lazy_service_results():
+    import json
+    from robokop_genetics.genetics_cache import LazyServiceResults
+
+    cached_payload = json.dumps([{"edge": {"source_id": 'CAID:CA279509',
+                                           "target_id": f'ENSEMBL:ENSG0000010838{i}',
+                                           "provided_by": 'ensembl.sequence_variant_to_gene',
+                                           "input_id": 'ROBO_VARIANT:HG38|17|58206171|58206172|T|A',
+                                           "predicate_id": 'SNPEFF:upstream_gene_variant',
+                                           "predicate_label": 'upstream_gene_variant',
+                                           "ctime": 1,
+                                           "properties": {'distance': i}},
+                                  "node": {"id": f'ENSEMBL:ENSG0000010838{i}',
+                                           "category": 'biolink:Gene',
+                                           "name": f'GENE{i}'}} for i in range(3)]).encode()
+    lazy_results = LazyServiceResults(cached_payload)
+    assert lazy_results.raw == cached_payload
+    assert lazy_results._results is None
+
+    edge, node = lazy_results[1]
+    assert node.id == 'ENSEMBL:ENSG00000108381'
+    assert edge.properties['distance'] == 1
+    # only the accessed item was created, and it's reused after that
+    assert lazy_results._results[0] is None and lazy_results._results[2] is None
+    assert lazy_results[1] is lazy_results[1]
+
+    assert len(lazy_results) == 3
+    assert [node.name for edge, node in lazy_results] == ['GENE0', 'GENE1', 'GENE2']
+    assert len(lazy_results[1:]) == 2
+
+
+def test_service_results_formats(genetics_cache):
+    from robokop_genetics.genetics_cache import LazyServiceResults, SERVICE_RESULTS_LAZY, SERVICE_RESULTS_RAW
+
+    edge = SimpleEdge(source_id='CAID:CA279509',
+                      target_id='ENSEMBL:ENSG00000108384',
+                      provided_by='ensembl.sequence_variant_to_gene',
+                      input_id='ROBO_VARIANT:HG38|17|58206171|58206172|T|A',
+                      predicate_id='SNPEFF:upstream_gene_variant',
+                      predicate_label='upstream_gene_variant',
+                      ctime=1,
+                      properties={'distance': 486402})
+    node = SimpleNode(id='ENSEMBL:ENSG00000108384', type='biolink:Gene', name='RAD51C')
+    service_key = f'{genetics_cache.prefix}{ENSEMBL}_variant_to_gene'
+    genetics_cache.set_service_results(service_key, {'CAID:CA279509': [(edge, node)]})
+
+    node_ids = ['CAID:CA279509', 'MADEUP:1000']
+    lazy_results = genetics_cache.get_service_results(service_key, node_ids, results_format=SERVICE_RESULTS_LAZY)
+    assert isinstance(lazy_results[0], LazyServiceResults)
+    assert lazy_results[0][0] == (edge, node)
+    assert lazy_results[1] is None
+
+    raw_results = genetics_cache.get_service_results(service_key, node_ids, results_format=SERVICE_RESULTS_RAW)
+    assert raw_results[0] == lazy_results[0].raw
+    assert raw_results[1] is None
@@ -0,0 +1,150 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from robokop_genetics.cache_writer import WriteBehindCacheWriter
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+
+
+class RecordingCache(object):
+    """Records the batches written to it, like a GeneticsCache that only accepts writes."""
+
+    def __init__(self, write_delay: float = 0):
+        self.write_delay = write_delay
+        self.normalization_batches = []
+        self.service_result_batches = []
+        self.fail_writes = False
+
+    def set_batch_normalization(self, normalization_map: dict):
+        time.sleep(self.write_delay)
+        if self.fail_writes:
+            raise ConnectionError('redis is down')
+        self.normalization_batches.append(dict(normalization_map))
+
+    def set_service_results(self, service_key: str, results_dict: dict):
+        time.sleep(self.write_delay)
+        self.service_result_batches.append((service_key, dict(results_dict)))
+
+    def get_normalizations(self):
+        normalizations = {}
+        for normalization_batch in self.normalization_batches:
+            normalizations.update(normalization_batch)
+        return normalizations
+
+
+def test_writes_are_coalesced_and_flushed():
+    cache = RecordingCache()
+    cache_writer = WriteBehindCacheWriter(cache, batch_size=1000, flush_interval=60)
+    cache_writer.set_batch_normalization({'CAID:CA1': 'first', 'CAID:CA2': 'first'})
+    cache_writer.set_batch_normalization({'CAID:CA1': 'second'})
+    cache_writer.set_service_results('Ensembl_sequence_variant_to_gene', {'CAID:CA1': []})
+    # not enough writes for a batch and not enough time has passed
+    time.sleep(0.1)
+    assert not cache.normalization_batches
+
+    cache_writer.flush()
+    assert cache.normalization_batches == [{'CAID:CA1': 'second', 'CAID:CA2': 'first'}]
+    assert cache.service_result_batches == [('Ensembl_sequence_variant_to_gene', {'CAID:CA1': []})]
+    cache_writer.close()
+
+
+def test_writes_by_size_and_time():
+    cache = RecordingCache()
+    cache_writer = WriteBehindCacheWriter(cache, batch_size=100, flush_interval=0.2)
+    cache_writer.set_batch_normalization({f'CAID:CA{i}': i for i in range(100)})
+    time.sleep(0.1)
+    assert len(cache.normalization_batches) == 1
+
+    cache_writer.set_batch_normalization({'CAID:CA100': 100})
+    time.sleep(0.5)
+    assert len(cache.normalization_batches) == 2
+    cache_writer.close()
+
+
+def test_back_pressure():
+    cache = RecordingCache(write_delay=0.2)
+    cache_writer = WriteBehindCacheWriter(cache, max_pending_writes=10, batch_size=10, flush_interval=60)
+
+    def write_normalizations():
+        for i in range(0, 50, 10):
+            cache_writer.set_batch_normalization({f'CAID:CA{j}': j for j in range(i, i + 10)})
+
+    start_time = time.perf_counter()
+    writer_thread = threading.Thread(target=write_normalizations)
+    writer_thread.start()
+    writer_thread.join()
+    # the caller had to wait for earlier batches to be written before adding more
+    assert time.perf_counter() - start_time > 0.5
+    cache_writer.close()
+    assert cache.get_normalizations() == {f'CAID:CA{i}': i for i in range(50)}
+
+
+def test_write_errors_are_raised_by_flush():
+    cache = RecordingCache()
+    cache.fail_writes = True
+    cache_writer = WriteBehindCacheWriter(cache, flush_interval=60)
+    cache_writer.set_batch_normalization({'CAID:CA1': 'retried'})
+    with pytest.raises(ConnectionError):
+        cache_writer.flush()
+    # a flush doesn't succeed until the failed writes are written
+    with pytest.raises(ConnectionError):
+        cache_writer.flush()
+
+    # failed writes are kept, and written with the next batch
+    cache.fail_writes = False
+    cache_writer.set_batch_normalization({'CAID:CA2': 'written'})
+    cache_writer.flush()
+    assert cache.get_normalizations() == {'CAID:CA1': 'retried', 'CAID:CA2': 'written'}
+    cache_writer.close()
+    assert not cache_writer.thread.is_alive()
+    with pytest.raises(RuntimeError):
+        cache_writer.set_batch_normalization({'CAID:CA3': 'too late'})
+
+
+def test_write_errors_with_concurrent_flushes():
+    cache = RecordingCache(write_delay=0.2)
+    cache.fail_writes = True
+    cache_writer = WriteBehindCacheWriter(cache, flush_interval=60)
+    cache_writer.set_batch_normalization({'CAID:CA1': 'first'})
+    cache_writer.set_batch_normalization({'CAID:CA2': 'second'})
+    # both callers find out their writes failed, not only the first one to flush
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        flushes = [executor.submit(cache_writer.flush) for _ in range(2)]
+        for flush in flushes:
+            with pytest.raises(ConnectionError):
+                flush.result()
+
+    # closing writes what it can, and drops what still fails
+    with pytest.raises(ConnectionError):
+        cache_writer.close()
+    assert not cache_writer.thread.is_alive()
+    with pytest.raises(ConnectionError):
+        cache_writer.flush()
+    assert not cache.normalization_batches
+
+
+def test_back_pressure_with_failing_writes():
+    cache = RecordingCache()
+    cache.fail_writes = True
+    cache_writer = WriteBehindCacheWriter(cache, max_pending_writes=10, batch_size=10, flush_interval=0.1)
+    cache_writer.set_batch_normalization({f'CAID:CA{i}': i for i in range(10)})
+    time.sleep(0.3)
+    # callers aren't blocked forever when the writes can't get through
+    with pytest.raises(ConnectionError):
+        cache_writer.set_batch_normalization({'CAID:CA10': 10})
+    cache.fail_writes = False
+    cache_writer.close()
+    assert cache.get_normalizations() == {f'CAID:CA{i}': i for i in range(10)}
+
+
+def test_write_behind_is_opt_in():
+    # normalizers created the way they always were don't leave a writer thread behind
+    for _ in range(5):
+        GeneticsNormalizer(cache=RecordingCache())
+    assert not [thread for thread in threading.enumerate() if thread.name == 'genetics-cache-writer']
+
+    with GeneticsNormalizer(cache=RecordingCache(), cache_write_behind=True) as normalizer:
+        assert normalizer.cache_writer.thread.is_alive()
+    assert not normalizer.cache_writer.thread.is_alive()
@@ -0,0 +1,72 @@
+import io
+import json
+import pickle
+
+from robokop_genetics.edge_batch import EdgeBatch
+from robokop_genetics.genetics_cache import encode_service_results, LazyServiceResults
+from robokop_genetics.simple_graph_components import SimpleEdge, SimpleNode
+
+UPSTREAM = ('SNPEFF:upstream_gene_variant', 'upstream_gene_variant')
+DOWNSTREAM = ('SNPEFF:downstream_gene_variant', 'downstream_gene_variant')
+
+
+def make_edge_batch():
+    edge_batch = EdgeBatch(provided_by='ensembl.sequence_variant_to_gene', target_type='biolink:Gene')
+    edge_batch.add_source('CAID:CA1', 'ROBO_VARIANT:HG38|1|100|101|A|G')
+    edge_batch.add_edge('ENSEMBL:ENSG1', 'GENE1', *UPSTREAM, 50)
+    edge_batch.add_edge('ENSEMBL:ENSG2', 'a "quoted" gene \\ with ünicode', *DOWNSTREAM, 0)
+    edge_batch.add_source('CAID:CA2')
+    edge_batch.add_source('CAID:CA3', 'ROBO_VARIANT:HG38|1|200|201|A|G')
+    edge_batch.add_edge('ENSEMBL:ENSG2', 'a "quoted" gene \\ with ünicode', *UPSTREAM, 25)
+    return edge_batch
+
+
+def make_expected_result(source_id, input_id, target_id, target_name, predicate, distance):
+    return (SimpleEdge(source_id=source_id, target_id=target_id, provided_by='ensembl.sequence_variant_to_gene',
+                       input_id=input_id, predicate_id=predicate[0], predicate_label=predicate[1], ctime=1,
+                       properties={'distance': distance}),
+            SimpleNode(id=target_id, type='biolink:Gene', name=target_name))
+
+
+def test_edge_batch_results():
+    edge_batch = make_edge_batch()
+    assert list(edge_batch) == ['CAID:CA1', 'CAID:CA2', 'CAID:CA3']
+    assert edge_batch.num_edges == 3
+    # the second gene is only stored once
+    assert edge_batch.target_ids == ['ENSEMBL:ENSG1', 'ENSEMBL:ENSG2']
+
+    expected_results = [make_expected_result('CAID:CA1', 'ROBO_VARIANT:HG38|1|100|101|A|G', 'ENSEMBL:ENSG1', 'GENE1',
+                                             UPSTREAM, 50),
+                        make_expected_result('CAID:CA1', 'ROBO_VARIANT:HG38|1|100|101|A|G', 'ENSEMBL:ENSG2',
+                                             'a "quoted" gene \\ with ünicode', DOWNSTREAM, 0)]
+    assert edge_batch['CAID:CA1'] == expected_results
+    assert edge_batch['CAID:CA1'][1] == expected_results[1]
+    assert edge_batch['CAID:CA1'][-1:] == expected_results[1:]
+    assert len(edge_batch['CAID:CA2']) == 0 and edge_batch['CAID:CA2'] == []
+    assert len(edge_batch['CAID:CA3']) == 1
+
+    # adding a source again replaces its results
+    edge_batch.add_source('CAID:CA2', 'ROBO_VARIANT:HG38|1|300|301|A|G')
+    edge_batch.add_edge('ENSEMBL:ENSG3', 'GENE3', *DOWNSTREAM, 7)
+    assert len(edge_batch) == 3
+    assert edge_batch['CAID:CA2'] == [make_expected_result('CAID:CA2', 'ROBO_VARIANT:HG38|1|300|301|A|G',
+                                                           'ENSEMBL:ENSG3', 'GENE3', DOWNSTREAM, 7)]
+
+    unpickled_edge_batch = pickle.loads(pickle.dumps(edge_batch))
+    assert dict(unpickled_edge_batch.items()) == dict(edge_batch.items())
+
+
+def test_edge_batch_encoding():
+    edge_batch = make_edge_batch()
+    for source_id, source_results in edge_batch.items():
+        # the same payload as encoding the objects, so cached batches read back the same as any other results
+        encoded_results = encode_service_results(source_results)
+        assert encoded_results == encode_service_results(list(source_results))
+        assert encoded_results == edge_batch.encode_source_results(source_id)
+        assert LazyServiceResults(encoded_results.encode('utf-8')) == source_results
+
+    output_file = io.StringIO()
+    assert edge_batch.write_jsonl(output_file) == 3
+    written_edges = [json.loads(line) for line in output_file.getvalue().splitlines()]
+    assert written_edges == [encoded_edge for source_results in edge_batch.values()
+                             for encoded_edge in json.loads(encode_service_results(list(source_results)))]
@@ -0,0 +1,512 @@
+import json
+import random
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from robokop_genetics.services.ensembl import EnsemblService, EnsemblGene
+from robokop_genetics.services.gene_index import GeneIntervalIndex
+
+
+"""Check Ensembl variant to gene lookups against a small synthetic genes database, without calling biomart
+"""
+
+CHROMOSOMES = ['1', '2', '17', 'X']
+BIOTYPES = ['protein_coding', 'lncRNA', 'processed_pseudogene']
+
+
+def make_random_genes(num_genes: int, seed: int = 42):
+    gene_randomizer = random.Random(seed)
+    genes = []
+    for i in range(num_genes):
+        start_position = gene_randomizer.randint(1, 20_000_000)
+        end_position = start_position + gene_randomizer.randint(0, 300_000)
+        genes.append(EnsemblGene(f'ENSG{i:011d}', f'GENE{i}', gene_randomizer.choice(CHROMOSOMES),
+                                 start_position, end_position, BIOTYPES[i % len(BIOTYPES)], f'test gene {i}'))
+    return genes
+
+
+@pytest.fixture()
+def random_genes():
+    return make_random_genes(2000)
+
+
+@pytest.fixture()
+def ensembl_service(tmp_path, random_genes):
+    ensembl_service = EnsemblService(temp_dir=str(tmp_path))
+    ensembl_service.write_genes_db(random_genes, ensembl_release='TEST')
+    return ensembl_service
+
+
+def test_gene_index_matches_brute_force(random_genes):
+    gene_index = GeneIntervalIndex.from_genes([(gene.ensembl_id, gene.ensembl_name, gene.chromosome,
+                                                gene.start_position, gene.end_position, gene.gene_biotype)
+                                               for gene in random_genes])
+    assert len(gene_index) == len(random_genes)
+    query_randomizer = random.Random(7)
+    for _ in range(500):
+        chromosome = query_randomizer.choice(CHROMOSOMES)
+        range_start = query_randomizer.randint(0, 21_000_000)
+        range_end = range_start + query_randomizer.randint(0, 1_000_000)
+        expected = {gene.ensembl_id for gene in random_genes if gene.chromosome == chromosome
+                    and gene.start_position <= range_end and gene.end_position >= range_start}
+        found = {gene[0] for gene in gene_index.get_genes_in_range(chromosome, range_start, range_end)}
+        assert found == expected
+    assert gene_index.get_genes_in_range('MT', 0, 100_000_000) == []
+
+
+def test_variant_to_gene_index_matches_db(ensembl_service, tmp_path):
+    sql_ensembl_service = EnsemblService(temp_dir=str(tmp_path), use_gene_index=False)
+    query_randomizer = random.Random(11)
+    for i in range(300):
+        chromosome = query_randomizer.choice(CHROMOSOMES)
+        start_position = query_randomizer.randint(0, 21_000_000)
+        variant_id = f'CAID:CA{i}'
+        variant_synonyms = {variant_id,
+                            f'ROBO_VARIANT:HG38|{chromosome}|{start_position}|{start_position + 1}|A|G'}
+        index_results = ensembl_service.sequence_variant_to_gene(variant_id, variant_synonyms)
+        sql_results = sql_ensembl_service.sequence_variant_to_gene(variant_id, variant_synonyms)
+        assert sorted(index_results, key=lambda result: result[1].id) == \
+               sorted(sql_results, key=lambda result: result[1].id)
+
+
+def test_batch_variant_to_gene_without_index(tmp_path, random_genes):
+    sql_ensembl_service = EnsemblService(temp_dir=str(tmp_path), use_gene_index=False)
+    sql_ensembl_service.write_genes_db(random_genes, ensembl_release='TEST')
+    query_randomizer = random.Random(17)
+    variants = []
+    for i in range(200):
+        chromosome = query_randomizer.choice(CHROMOSOMES)
+        start_position = query_randomizer.randint(0, 21_000_000)
+        variant_id = f'CAID:CA{i}'
+        variants.append((variant_id, {variant_id,
+                                      f'ROBO_VARIANT:HG38|{chromosome}|{start_position}|{start_position + 1}|A|G'}))
+    variants.append(('CAID:CA_NO_COORDINATES', {'CAID:CA_NO_COORDINATES'}))
+
+    sql_batch_results = sql_ensembl_service.batch_sequence_variant_to_gene(variants)
+    # the batch queries the genes db like sequence_variant_to_gene does, without building the gene index
+    assert sql_ensembl_service.gene_index is None
+    assert not os.path.exists(sql_ensembl_service.gene_index_path)
+    assert sql_batch_results['CAID:CA_NO_COORDINATES'] == []
+    for variant_id, variant_synonyms in variants:
+        sql_results = sql_ensembl_service.sequence_variant_to_gene(variant_id, variant_synonyms)
+        assert sorted(sql_batch_results[variant_id], key=lambda result: result[1].id) == \
+               sorted(sql_results, key=lambda result: result[1].id)
+
+    index_batch_results = EnsemblService(temp_dir=str(tmp_path)).batch_sequence_variant_to_gene(variants)
+    assert sum(len(results) for results in index_batch_results.values()) > 0
+    for variant_id, _ in variants:
+        assert sorted(sql_batch_results[variant_id], key=lambda result: result[1].id) == \
+               sorted(index_batch_results[variant_id], key=lambda result: result[1].id)
+
+
+def test_nearest_genes_and_biotypes(ensembl_service, tmp_path, random_genes):
+    sql_ensembl_service = EnsemblService(temp_dir=str(tmp_path), use_gene_index=False)
+    query_randomizer = random.Random(13)
+    for i in range(300):
+        chromosome = query_randomizer.choice(CHROMOSOMES)
+        start_position = query_randomizer.randint(0, 21_000_000)
+        end_position = start_position + query_randomizer.choice([1, 1, 50_000])
+        flanking_region_size = query_randomizer.choice([10_000, 200_000, 500_000])
+        nearest_k = query_randomizer.choice([None, 1, 3, 10])
+        gene_biotypes = query_randomizer.choice([None, ['protein_coding'], ['lncRNA', 'processed_pseudogene']])
+        variant_id = f'CAID:CA{i}'
+        variant_synonyms = {variant_id,
+                            f'ROBO_VARIANT:HG38|{chromosome}|{start_position}|{end_position}|A|G'}
+
+        expected_distances = sorted(
+            EnsemblService.get_gene_distance(start_position, end_position, gene.start_position, gene.end_position)
+            for gene in random_genes if gene.chromosome == chromosome
+            and gene.start_position <= end_position + flanking_region_size
+            and gene.end_position >= max(start_position - flanking_region_size, 0)
+            and (gene_biotypes is None or gene.gene_biotype in gene_biotypes))
+        if nearest_k is not None:
+            expected_distances = expected_distances[:nearest_k]
+
+        query_parameters = {'flanking_region_size': flanking_region_size,
+                            'nearest_k': nearest_k,
+                            'gene_biotypes': gene_biotypes}
+        index_results = ensembl_service.sequence_variant_to_gene(variant_id, variant_synonyms, **query_parameters)
+        sql_results = sql_ensembl_service.sequence_variant_to_gene(variant_id, variant_synonyms, **query_parameters)
+        batch_results = ensembl_service.batch_sequence_variant_to_gene([(variant_id, variant_synonyms)],
+                                                                       **query_parameters)[variant_id]
+        sql_batch_results = sql_ensembl_service.batch_sequence_variant_to_gene([(variant_id, variant_synonyms)],
+                                                                               **query_parameters)[variant_id]
+        for results in [index_results, sql_results, batch_results, sql_batch_results]:
+            assert sorted(edge.properties['distance'] for edge, _ in results) == expected_distances
+        if nearest_k is not None:
+            # nearest genes come closest first
+            assert [edge.properties['distance'] for edge, _ in index_results] == expected_distances
+
+
+def test_variant_to_gene_edges(tmp_path):
+    ensembl_service = EnsemblService(temp_dir=str(tmp_path))
+    ensembl_service.write_genes_db([
+        EnsemblGene('ENSG00000000001', 'UPSTREAM', '17', 1_000_000, 1_100_000, 'protein_coding', ''),
+        EnsemblGene('ENSG00000000002', 'DOWNSTREAM', '17', 500_000, 700_000, 'lncRNA', ''),
+        EnsemblGene('ENSG00000000003', 'OVERLAPPING', '17', 800_000, 900_000, 'protein_coding', ''),
+        EnsemblGene('ENSG00000000004', 'FAR_AWAY', '17', 5_000_000, 5_100_000, 'protein_coding', ''),
+        EnsemblGene('ENSG00000000005', 'OTHER_CHROMOSOME', '1', 800_000, 900_000, 'protein_coding', '')])
+    variant_synonyms = {'CAID:CA1', 'ROBO_VARIANT:HG38|17|850000|850001|A|G', 'ROBO_VARIANT:HG19|17|1|2|A|G'}
+    results = ensembl_service.sequence_variant_to_gene('CAID:CA1', variant_synonyms)
+    edges = {node.name: edge for edge, node in results}
+    assert set(edges.keys()) == {'UPSTREAM', 'DOWNSTREAM', 'OVERLAPPING'}
+    assert edges['UPSTREAM'].predicate_label == 'upstream_gene_variant'
+    assert edges['UPSTREAM'].properties['distance'] == 150_000
+    assert edges['DOWNSTREAM'].predicate_label == 'downstream_gene_variant'
+    assert edges['DOWNSTREAM'].properties['distance'] == 150_001
+    assert edges['OVERLAPPING'].properties['distance'] == 0
+    assert edges['OVERLAPPING'].input_id == 'ROBO_VARIANT:HG38|17|850000|850001|A|G'
+    assert edges['OVERLAPPING'].target_id == 'ENSEMBL:ENSG00000000003'
+
+    assert ensembl_service.sequence_variant_to_gene('CAID:CA2', {'CAID:CA2'}) == []
+
+    # malformed keys are skipped, an HG38 key next to them is still used
+    for malformed_key in ('ROBO_VARIANT:HG19|17|1', 'ROBO_VARIANT:HG19|17|start|2|A|G', 'ROBO_VARIANT:HG38|17|1'):
+        synonyms_with_malformed_key = {'CAID:CA1', 'ROBO_VARIANT:HG38|17|850000|850001|A|G', malformed_key}
+        assert ensembl_service.get_robokop_variant_coordinates('CAID:CA1', synonyms_with_malformed_key) == \
+               ('ROBO_VARIANT:HG38|17|850000|850001|A|G', '17', 850000, 850001)
+        assert ensembl_service.sequence_variant_to_gene('CAID:CA1', synonyms_with_malformed_key) == results
+        assert ensembl_service.batch_sequence_variant_to_gene([('CAID:CA1', synonyms_with_malformed_key)]) == \
+               {'CAID:CA1': results}
+    assert ensembl_service.get_robokop_variant_coordinates('CAID:CA1', {'ROBO_VARIANT:HG38|17|1'}) is None
+
+
+def test_batch_variant_to_gene_matches_single(ensembl_service):
+    query_randomizer = random.Random(3)
+    variants = []
+    for i in range(1000):
+        chromosome = query_randomizer.choice(CHROMOSOMES + ['Y'])
+        start_position = query_randomizer.randint(0, 21_000_000)
+        end_position = start_position + query_randomizer.choice([1, 1, 1, 50, 2_000_000])
+        variant_id = f'CAID:CA{i}'
+        variant_synonyms = {variant_id, f'ROBO_VARIANT:HG38|{chromosome}|{start_position}|{end_position}|A|G'}
+        variants.append((variant_id, variant_synonyms))
+    variants.append(('CAID:NOKEY', {'CAID:NOKEY'}))
+
+    batch_results = ensembl_service.batch_sequence_variant_to_gene(variants)
+    assert len(batch_results) == len(variants)
+    for variant_id, variant_synonyms in variants:
+        assert batch_results[variant_id] == ensembl_service.sequence_variant_to_gene(variant_id, variant_synonyms)
+
+
+def test_get_variant_to_gene(ensembl_service, tmp_path):
+    from robokop_genetics.genetics_services import GeneticsServices, ENSEMBL
+    from robokop_genetics.simple_graph_components import SimpleNode
+
+    genetics_services = GeneticsServices(use_cache=False)
+    genetics_services.ensembl = ensembl_service
+    variant_nodes = []
+    for i in range(50):
+        variant_node = SimpleNode(id=f'CAID:CA{i}', type='biolink:SequenceVariant', name='')
+        variant_node.add_synonyms({f'ROBO_VARIANT:HG38|{CHROMOSOMES[i % 4]}|{i * 300_000}|{i * 300_000 + 1}|A|G'})
+        variant_nodes.append(variant_node)
+
+    all_results = genetics_services.get_variant_to_gene([ENSEMBL], variant_nodes)
+    for variant_node in variant_nodes:
+        assert all_results[variant_node.id] == \
+               ensembl_service.sequence_variant_to_gene(variant_node.id, variant_node.synonyms)
+
+    nearest_results = genetics_services.get_variant_to_gene([ENSEMBL], variant_nodes, nearest_k=2,
+                                                            gene_biotypes=['protein_coding'])
+    for variant_node in variant_nodes:
+        assert nearest_results[variant_node.id] == \
+               ensembl_service.sequence_variant_to_gene(variant_node.id, variant_node.synonyms, nearest_k=2,
+                                                        gene_biotypes=['protein_coding'])
+
+    # streamed to KGX files in chunks, with each gene written once
+    from robokop_genetics.kgx_writer import KGXWriter
+    nodes_path, edges_path = str(tmp_path / 'nodes.jsonl'), str(tmp_path / 'edges.jsonl')
+    with KGXWriter(nodes_path, edges_path) as kgx_writer:
+        num_edges = genetics_services.write_variant_to_gene([ENSEMBL], iter(variant_nodes), kgx_writer, chunk_size=7)
+    assert num_edges == sum(len(variant_results) for variant_results in all_results.values())
+    with open(edges_path) as edges_file:
+        assert sorted((edge['subject'], edge['object']) for edge in map(json.loads, edges_file)) == \
+               sorted((edge.source_id, edge.target_id) for variant_results in all_results.values()
+                      for edge, _ in variant_results)
+    with open(nodes_path) as nodes_file:
+        gene_ids = [node['id'] for node in map(json.loads, nodes_file)]
+    assert sorted(gene_ids) == sorted({node.id for variant_results in all_results.values() for _, node in variant_results})
+
+    assert GeneticsServices.get_variant_to_gene_cache_key(ENSEMBL) == 'Ensembl_sequence_variant_to_gene'
+    assert GeneticsServices.get_variant_to_gene_cache_key(ENSEMBL, 100_000, 3, ['protein_coding', 'lncRNA']) == \
+           'Ensembl_sequence_variant_to_gene_window100000_nearest3_biotypeslncRNA,protein_coding'
+
+
+def test_parallel_variant_to_gene(ensembl_service, monkeypatch):
+    from robokop_genetics import genetics_services as genetics_services_module
+    from robokop_genetics.simple_graph_components import SimpleNode
+
+    # small batches so the variants are split across the workers
+    monkeypatch.setattr(genetics_services_module, 'VARIANT_TO_GENE_BATCH_SIZE', 100)
+    genetics_services = genetics_services_module.GeneticsServices(use_cache=False)
+    genetics_services.ensembl = ensembl_service
+    variant_nodes = []
+    for i in range(1000):
+        variant_node = SimpleNode(id=f'CAID:CA{i}', type='biolink:SequenceVariant', name='')
+        if i % 50:
+            position = i * 20_000
+            variant_node.add_synonyms({f'ROBO_VARIANT:HG38|{CHROMOSOMES[i % 4]}|{position}|{position + 1}|A|G'})
+        variant_nodes.append(variant_node)
+
+    parallel_results = genetics_services.get_variant_to_gene([genetics_services_module.ENSEMBL], variant_nodes,
+                                                             num_workers=3, nearest_k=5)
+    serial_results = genetics_services.get_variant_to_gene([genetics_services_module.ENSEMBL], variant_nodes,
+                                                           nearest_k=5)
+    assert len(parallel_results) == len(variant_nodes)
+    assert parallel_results == serial_results
+    lazy_results = genetics_services.get_variant_to_gene([genetics_services_module.ENSEMBL], variant_nodes,
+                                                         num_workers=3, nearest_k=5, lazy_cached_results=True)
+    assert {variant_id: list(variant_results) for variant_id, variant_results in lazy_results.items()} == serial_results
+    assert parallel_results['CAID:CA0'] == []
+
+
+def test_shared_gene_nodes(ensembl_service, tmp_path, random_genes):
+    from robokop_genetics.genetics_cache import LazyServiceResults, encode_service_results
+    from robokop_genetics.simple_graph_components import FrozenSimpleNode
+
+    variants = [(f'CAID:CA{i}', {f'ROBO_VARIANT:HG38|1|{1_000_000 + i}|{1_000_001 + i}|A|G'}) for i in range(20)]
+    shared_service = EnsemblService(temp_dir=str(tmp_path), share_gene_nodes=True)
+    single_results = [shared_service.sequence_variant_to_gene(variant_id, variant_synonyms)
+                      for variant_id, variant_synonyms in variants]
+    batch_results = shared_service.batch_sequence_variant_to_gene(variants)
+    gene_nodes = {}
+    for variant_results in single_results + list(batch_results.values()):
+        for edge, gene_node in variant_results:
+            assert isinstance(gene_node, FrozenSimpleNode)
+            assert gene_nodes.setdefault(gene_node.id, gene_node) is gene_node
+            assert edge.target_id is gene_node.id
+    assert len(gene_nodes) > 1
+
+    # results decoded from the cache share the same nodes
+    cached_results = LazyServiceResults(encode_service_results(single_results[0]).encode('utf-8'),
+                                        shared_service.interner)
+    assert list(cached_results) == single_results[0]
+    assert all(gene_node is gene_nodes[gene_node.id] for _, gene_node in cached_results)
+
+    # by default each result has its own node
+    unshared_results = [ensembl_service.sequence_variant_to_gene(variant_id, variant_synonyms)
+                        for variant_id, variant_synonyms in variants[:2]]
+    assert unshared_results == single_results[:2]
+    assert unshared_results[0][0][1] is not unshared_results[1][0][1]
+
+
+def test_default_gene_nodes_are_mutable(ensembl_service):
+    from robokop_genetics.genetics_services import GeneticsServices, ENSEMBL
+    from robokop_genetics.simple_graph_components import SimpleNode, FrozenSimpleNode
+
+    genetics_services = GeneticsServices(use_cache=False)
+    assert not genetics_services.ensembl.interner.share_nodes
+    genetics_services.ensembl = ensembl_service
+    variant_node = SimpleNode(id='CAID:CA1', type='biolink:SequenceVariant', name='',
+                              synonyms={'CAID:CA1', 'ROBO_VARIANT:HG38|1|1000000|1000001|A|G'})
+    variant_results = genetics_services.get_variant_to_gene([ENSEMBL], [variant_node], nearest_k=2)['CAID:CA1']
+    assert len(variant_results) == 2
+    (first_edge, first_gene_node), (_, second_gene_node) = variant_results
+
+    # gene nodes can be changed like any SimpleNode without affecting other results
+    assert not isinstance(first_gene_node, FrozenSimpleNode)
+    first_gene_node.add_synonyms({'HGNC:1'})
+    first_gene_node.properties['symbol'] = 'GENE'
+    first_gene_node.name = 'RENAMED'
+    assert first_gene_node.synonyms == {first_gene_node.id, 'HGNC:1'}
+    assert first_gene_node.get_synonyms_by_prefix('HGNC') == {'HGNC:1'}
+    assert second_gene_node.synonyms == {second_gene_node.id} and second_gene_node.properties == {}
+    again_gene_node = genetics_services.get_variant_to_gene([ENSEMBL], [variant_node], nearest_k=2)['CAID:CA1'][0][1]
+    assert again_gene_node.id == first_gene_node.id and again_gene_node.name != 'RENAMED'
+    first_edge.properties['score'] = 1
+
+
+def test_gene_index_file(ensembl_service, random_genes, tmp_path):
+    gene_index = ensembl_service.get_gene_index()
+    assert os.path.exists(ensembl_service.gene_index_path)
+    assert gene_index.ensembl_release == 'TEST'
+
+    # a new service loads the prebuilt file, and doesn't need the genes db at all
+    os.remove(ensembl_service.gene_db_path)
+    new_ensembl_service = EnsemblService(temp_dir=str(tmp_path))
+    loaded_index = new_ensembl_service.get_gene_index()
+    assert isinstance(loaded_index.starts, memoryview)
+    assert len(loaded_index) == len(gene_index)
+    assert loaded_index.chromosome_segments == gene_index.chromosome_segments
+    assert loaded_index.get_genes_in_range('17', 1_000_000, 3_000_000) == \
+           gene_index.get_genes_in_range('17', 1_000_000, 3_000_000)
+    assert not os.path.exists(ensembl_service.gene_db_path)
+
+    # once the genes db is rebuilt, an index file made from the old one isn't used anymore
+    new_genes = make_random_genes(500)
+    new_ensembl_service.write_genes_db(new_genes, ensembl_release='TEST')
+    assert len(new_ensembl_service.get_gene_index()) == len(new_genes)
+    newer_ensembl_service = EnsemblService(temp_dir=str(tmp_path))
+    newer_ensembl_service.write_genes_db(random_genes, ensembl_release='TEST')
+    rebuilt_index = EnsemblService(temp_dir=str(tmp_path)).get_gene_index()
+    assert len(rebuilt_index) == len(random_genes)
+    assert rebuilt_index.genes_db_version == newer_ensembl_service.get_existing_genes_db_version()
+
+    # incomplete or corrupted files are rejected
+    with open(ensembl_service.gene_index_path, 'rb') as index_file:
+        index_bytes = index_file.read()
+    truncated_index_path = str(tmp_path / 'truncated.index')
+    with open(truncated_index_path, 'wb') as index_file:
+        index_file.write(index_bytes[:-100])
+    with pytest.raises(ValueError):
+        GeneIntervalIndex.load(truncated_index_path)
+
+
+def test_incomplete_genes_db(ensembl_service):
+    db_conn = sqlite3.connect(ensembl_service.gene_db_path)
+    assert ensembl_service.get_genes_db_build_info(db_conn) == ('TEST', 2000)
+    with db_conn:
+        db_conn.execute('DELETE FROM genes WHERE ensembl_id = ?', ('ENSG00000000001',))
+    assert ensembl_service.get_genes_db_build_info(db_conn) is None
+    db_conn.close()
+
+
+def write_biomart_genes_file(genes: list, file_path: str):
+    with open(file_path, 'w') as genes_file:
+        # the first line is skipped like the header line biomart sends
+        genes_file.write('Gene stable ID\tGene type\tGene name\tStart\tEnd\tDescription\tChromosome\n')
+        for gene in genes:
+            genes_file.write(f'{gene.ensembl_id}\t{gene.gene_biotype}\t{gene.ensembl_name}\t{gene.start_position}\t'
+                             f'{gene.end_position}\t{gene.description}\t{gene.chromosome}\n')
+        genes_file.write('a broken line\n')
+
+
+def test_create_genes_db_from_file(tmp_path, random_genes):
+    genes_file_path = str(tmp_path / 'biomart_genes.tsv')
+    write_biomart_genes_file(random_genes, genes_file_path)
+    ensembl_service = EnsemblService(temp_dir=str(tmp_path), genes_source=genes_file_path)
+    assert list(ensembl_service.iter_all_genes(genes_file_path)) == random_genes
+
+    ensembl_service.write_genes_db(ensembl_service.iter_all_genes(genes_file_path), chunk_size=300)
+    db_conn = sqlite3.connect(ensembl_service.gene_db_path)
+    assert ensembl_service.get_genes_db_build_info(db_conn) == (None, len(random_genes))
+    db_conn.close()
+    assert not [file_name for file_name in os.listdir(tmp_path) if file_name.endswith('.tmp')]
+
+    # nothing to write leaves the existing db alone
+    assert not ensembl_service.write_genes_db(iter([]))
+    db_conn = sqlite3.connect(ensembl_service.gene_db_path)
+    assert ensembl_service.get_genes_db_build_info(db_conn) == (None, len(random_genes))
+    db_conn.close()
+
+
+def test_concurrent_cold_start(tmp_path, random_genes):
+    genes_file_path = str(tmp_path / 'biomart_genes.tsv')
+    write_biomart_genes_file(random_genes, genes_file_path)
+    ensembl_service = EnsemblService(temp_dir=str(tmp_path), genes_source=genes_file_path)
+    genes_db_builds = []
+    write_genes_db = ensembl_service.write_genes_db
+
+    def counting_write_genes_db(*args, **kwargs):
+        genes_db_builds.append(threading.get_ident())
+        return write_genes_db(*args, **kwargs)
+    ensembl_service.write_genes_db = counting_write_genes_db
+
+    # threads sharing a service on a cold start, like the server's batch threads, build the genes db and index once
+    variants = [(f'CAID:CA{i}', {f'ROBO_VARIANT:HG38|1|{i * 1000 + 1}|{i * 1000 + 2}|A|G'}) for i in range(50)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        all_results = list(executor.map(lambda _: ensembl_service.batch_sequence_variant_to_gene(variants), range(8)))
+    assert len(genes_db_builds) == 1
+    assert all(results == all_results[0] for results in all_results)
+    assert not [file_name for file_name in os.listdir(tmp_path) if file_name.endswith('.tmp')]
+
+
+def test_create_genes_db_from_url(tmp_path, random_genes):
+    genes_file_path = str(tmp_path / 'biomart_genes.tsv')
+    write_biomart_genes_file(random_genes, genes_file_path)
+    with open(genes_file_path, 'rb') as genes_file:
+        genes_data = genes_file.read()
+
+    class BiomartStandIn(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            # send it in pieces that split lines, like a real download
+            for i in range(0, len(genes_data), 1000):
+                self.wfile.write(genes_data[i:i + 1000])
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), BiomartStandIn)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        genes_url = f'http://127.0.0.1:{server.server_address[1]}/biomart'
+        ensembl_service = EnsemblService(temp_dir=str(tmp_path / 'db'), genes_source=genes_url)
+        os.makedirs(tmp_path / 'db')
+        assert ensembl_service.create_genes_db()
+        db_conn = sqlite3.connect(ensembl_service.gene_db_path)
+        assert ensembl_service.get_genes_db_build_info(db_conn) == (None, len(random_genes))
+        db_conn.close()
+        expected_genes = sorted(gene.ensembl_id for gene in random_genes if gene.chromosome == '1')
+        found_genes = ensembl_service.get_gene_index().get_genes_in_range('1', 0, 21_000_000)
+        assert sorted(gene[0] for gene in found_genes) == expected_genes
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_gene_annotations(ensembl_service, random_genes):
+    def no_downloads(*args, **kwargs):
+        raise AssertionError('gene annotations should come from the genes db')
+    ensembl_service.iter_biomart_gene_lines = no_downloads
+    ensembl_service.gene_annotation_cache_size = 10
+
+    gene = random_genes[5]
+    expected_annotation = {'name': gene.ensembl_name,
+                           'chromosome': gene.chromosome,
+                           'start_position': gene.start_position,
+                           'end_position': gene.end_position,
+                           'gene_biotype': gene.gene_biotype,
+                           'description': gene.description}
+    assert ensembl_service.get_ensembl_gene_annotations(gene.ensembl_id) == expected_annotation
+    assert ensembl_service.get_ensembl_gene_annotations('ENSG_FAKE') == {'ensembl_error': 'ENSG_FAKE not found.'}
+
+    gene_ids = [gene.ensembl_id for gene in random_genes[:1200]] + ['ENSG_FAKE']
+    gene_annotations = ensembl_service.get_ensembl_gene_annotations_batch(gene_ids)
+    assert len(gene_annotations) == len(gene_ids)
+    assert gene_annotations[gene.ensembl_id] == expected_annotation
+    assert 'ensembl_error' in gene_annotations['ENSG_FAKE']
+    assert len(ensembl_service.gene_annotation_cache) == 10
+    assert ensembl_service.all_gene_annotations is None
+
+    all_gene_annotations = ensembl_service.get_all_ensembl_gene_annotations()
+    assert len(all_gene_annotations) == len(random_genes)
+    assert all_gene_annotations[gene.ensembl_id] == expected_annotation
+
+
+def test_variant_to_gene_server(ensembl_service):
+    import urllib.request
+    from robokop_genetics.genetics_normalization import GeneticsNormalizer
+    from robokop_genetics.genetics_services import GeneticsServices, ENSEMBL
+    from robokop_genetics.server import GeneticsServer
+
+    genetics_services = GeneticsServices(use_cache=False)
+    genetics_services.ensembl = ensembl_service
+    server = GeneticsServer(('127.0.0.1', 0), GeneticsNormalizer(), genetics_services=genetics_services,
+                            batch_window=0.2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    variants = [{'id': f'CAID:CA{i}',
+                 'synonyms': [f'ROBO_VARIANT:HG38|{CHROMOSOMES[i % 4]}|{i * 300_000}|{i * 300_000 + 1}|A|G']}
+                for i in range(20)]
+    try:
+        request = urllib.request.Request(server.url + 'variant_to_gene', method='POST',
+                                         data=json.dumps({'variants': variants, 'nearest_k': 2}).encode('utf-8'))
+        with urllib.request.urlopen(request) as response:
+            results = json.loads(response.read())['results']
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert list(results) == [variant['id'] for variant in variants]
+    for variant in variants:
+        expected_results = ensembl_service.sequence_variant_to_gene(variant['id'], set(variant['synonyms']),
+                                                                    nearest_k=2)
+        assert [(result['edge']['source_id'], result['node']['id']) for result in results[variant['id']]] == \
+               [(edge.source_id, node.id) for edge, node in expected_results]
@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import time
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+from robokop_genetics.services.hgnc import HGNCService, GeneSymbolMatch, iter_hgnc_docs, HGNC_SYMBOL_FIELDS, \
+    SYMBOL_MATCH_APPROVED, SYMBOL_MATCH_PREVIOUS, SYMBOL_MATCH_ALIAS
+
+
+"""Check HGNC symbol lookups and the persisted symbol index against a small local copy of the HGNC complete set
+"""
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class HGNCStandIn(SimpleHTTPRequestHandler):
+    """Serves the fixtures directory, with Last-Modified and If-Modified-Since support, recording response codes."""
+
+    response_codes = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=FIXTURES_DIRECTORY, **kwargs)
+
+    def log_request(self, code='-', size='-'):
+        self.response_codes.append(int(code))
+
+
+@pytest.fixture()
+def hgnc_url():
+    HGNCStandIn.response_codes = []
+    server = HTTPServer(('127.0.0.1', 0), HGNCStandIn)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/hgnc_complete_set.json'
+    server.shutdown()
+    server.server_close()
+
+
+def test_symbol_lookup(hgnc_url, tmp_path):
+    hgnc_service = HGNCService(temp_dir=str(tmp_path), hgnc_url=hgnc_url)
+    assert hgnc_service.get_gene_id_from_symbol('ASS1') == 'HGNC:758'
+    assert hgnc_service.get_gene_id_from_symbol('DMD') == 'HGNC:2928'
+    assert hgnc_service.get_gene_id_from_symbol('BRCA1') == 'HGNC:1100'
+    assert hgnc_service.get_gene_id_from_symbol('THISISAFAKEGENE') is None
+    assert HGNCStandIn.response_codes == [200]
+    assert os.path.exists(hgnc_service.symbol_index_path)
+
+
+def test_symbol_index_refresh(hgnc_url, tmp_path):
+    HGNCService(temp_dir=str(tmp_path), hgnc_url=hgnc_url).init_symbol_lookup()
+    assert HGNCStandIn.response_codes == [200]
+
+    # a fresh index is used without contacting HGNC
+    hgnc_service = HGNCService(temp_dir=str(tmp_path), hgnc_url=hgnc_url)
+    assert hgnc_service.get_gene_id_from_symbol('BRCA1') == 'HGNC:1100'
+    assert HGNCStandIn.response_codes == [200]
+
+    # an old index is revalidated, and kept when HGNC says the data didn't change
+    old_time = time.time() - 2 * 24 * 60 * 60
+    os.utime(hgnc_service.symbol_index_path, (old_time, old_time))
+    hgnc_service = HGNCService(temp_dir=str(tmp_path), hgnc_url=hgnc_url)
+    assert hgnc_service.get_gene_id_from_symbol('BRCA1') == 'HGNC:1100'
+    assert HGNCStandIn.response_codes == [200, 304]
+    assert os.path.getmtime(hgnc_service.symbol_index_path) > old_time
+
+    # the index is downloaded again if it's unusable
+    with open(hgnc_service.symbol_index_path, 'a') as index_file:
+        index_file.write('EXTRA\tHGNC:0\n')
+    hgnc_service = HGNCService(temp_dir=str(tmp_path), hgnc_url=hgnc_url)
+    assert hgnc_service.get_gene_id_from_symbol('BRCA1') == 'HGNC:1100'
+    assert HGNCStandIn.response_codes == [200, 304, 200]
+
+
+def test_symbol_index_offline(hgnc_url, tmp_path):
+    hgnc_service = HGNCService(temp_dir=str(tmp_path), offline=True, hgnc_url=hgnc_url)
+    assert hgnc_service.get_gene_id_from_symbol('BRCA1') is None
+
+    HGNCService(temp_dir=str(tmp_path), hgnc_url=hgnc_url).init_symbol_lookup()
+    old_time = time.time() - 365 * 24 * 60 * 60
+    os.utime(hgnc_service.symbol_index_path, (old_time, old_time))
+    hgnc_service = HGNCService(temp_dir=str(tmp_path), offline=True, hgnc_url=hgnc_url)
+    assert hgnc_service.get_gene_id_from_symbol('BRCA1') == 'HGNC:1100'
+    assert HGNCStandIn.response_codes == [200]
+
+
+def test_bulk_symbol_resolution(hgnc_url, tmp_path):
+    hgnc_service = HGNCService(temp_dir=str(tmp_path), hgnc_url=hgnc_url)
+    symbol_matches = hgnc_service.get_gene_ids_from_symbols(['BRCA1', 'brca1', 'p53', 'P53', 'FANCD1', 'ASS',
+                                                             'H2', 'FLT2', 'THISISAFAKEGENE'])
+    assert symbol_matches['BRCA1'] == GeneSymbolMatch('HGNC:1100', SYMBOL_MATCH_APPROVED, False, ('HGNC:1100',))
+    assert symbol_matches['brca1'].hgnc_id == 'HGNC:1100'
+    assert symbol_matches['brca1'].match_type == SYMBOL_MATCH_APPROVED
+    assert symbol_matches['p53'] == GeneSymbolMatch('HGNC:11998', SYMBOL_MATCH_ALIAS, False, ('HGNC:11998',))
+    assert symbol_matches['P53'].hgnc_id == 'HGNC:11998'
+    assert symbol_matches['FANCD1'] == GeneSymbolMatch('HGNC:1101', SYMBOL_MATCH_PREVIOUS, False, ('HGNC:1101',))
+    assert symbol_matches['ASS'].hgnc_id == 'HGNC:758'
+    # an alias of two genes
+    assert symbol_matches['H2'] == GeneSymbolMatch(None, SYMBOL_MATCH_ALIAS, True, ('HGNC:3689', 'HGNC:4878'))
+    # a previous symbol wins over an alias
+    assert symbol_matches['FLT2'] == GeneSymbolMatch('HGNC:3689', SYMBOL_MATCH_PREVIOUS, False, ('HGNC:3689',))
+    assert symbol_matches['THISISAFAKEGENE'] is None
+
+    # exact single lookups still only use approved symbols
+    assert hgnc_service.get_gene_id_from_symbol('p53') is None
+
+    # the persisted index resolves the same way
+    loaded_hgnc_service = HGNCService(temp_dir=str(tmp_path), offline=True)
+    assert loaded_hgnc_service.get_gene_ids_from_symbols(list(symbol_matches)) == symbol_matches
+
+
+def test_streaming_parse():
+    hgnc_complete_set_path = os.path.join(FIXTURES_DIRECTORY, 'hgnc_complete_set.json')
+    with open(hgnc_complete_set_path, encoding='utf-8') as hgnc_file:
+        expected_docs = [{field: hgnc_item[field] for field in HGNC_SYMBOL_FIELDS if field in hgnc_item}
+                         for hgnc_item in json.load(hgnc_file)['response']['docs']]
+
+    # tiny chunks split genes, strings and the docs key across chunk boundaries
+    for chunk_size in (1, 7, 64, 1024 * 1024):
+        with open(hgnc_complete_set_path, 'rb') as hgnc_file:
+            assert list(iter_hgnc_docs(iter(partial(hgnc_file.read, chunk_size), b''))) == expected_docs
+
+    # multi-byte characters split across chunks
+    hgnc_bytes = json.dumps({'response': {'docs': [{'hgnc_id': 'HGNC:1', 'symbol': 'Ωβ'}]}},
+                            ensure_ascii=False).encode('utf-8')
+    hgnc_chunks = [hgnc_bytes[i:i + 1] for i in range(len(hgnc_bytes))]
+    assert list(iter_hgnc_docs(hgnc_chunks)) == [{'hgnc_id': 'HGNC:1', 'symbol': 'Ωβ'}]
+
+    with open(hgnc_complete_set_path, 'rb') as hgnc_file:
+        truncated_bytes = hgnc_file.read()[:-200]
+    with pytest.raises(ValueError):
+        list(iter_hgnc_docs([truncated_bytes]))
+    with pytest.raises(ValueError):
+        list(iter_hgnc_docs([b'{"response": {"docs": [{"symbol": "BRCA1"}, {not json}]}}']))
@@ -0,0 +1,97 @@
+import gzip
+import json
+
+import robokop_genetics.node_types as node_types
+from robokop_genetics.edge_batch import EdgeBatch
+from robokop_genetics.genetics_cache import encode_service_results, LazyServiceResults
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+from robokop_genetics.kgx_writer import KGXWriter, VARIANT_TO_GENE_PREDICATE
+
+
+"""Check the KGX nodes and edges written for normalization and variant to gene results
+"""
+
+
+def make_edge_batch():
+    edge_batch = EdgeBatch(provided_by='ensembl.sequence_variant_to_gene', target_type=node_types.GENE)
+    edge_batch.add_source('CAID:CA1', 'ROBO_VARIANT:HG38|1|100|101|A|G')
+    edge_batch.add_edge('ENSEMBL:ENSG1', 'GENE1', 'SNPEFF:upstream_gene_variant', 'upstream_gene_variant', 50)
+    edge_batch.add_edge('ENSEMBL:ENSG2', 'GENE2', 'SNPEFF:downstream_gene_variant', 'downstream_gene_variant', 0)
+    edge_batch.add_source('CAID:CA2')
+    edge_batch.add_source('CAID:CA3', 'ROBO_VARIANT:HG38|1|200|201|A|G')
+    edge_batch.add_edge('ENSEMBL:ENSG2', 'GENE2', 'SNPEFF:upstream_gene_variant', 'upstream_gene_variant', 25)
+    return edge_batch
+
+
+def read_jsonl(file_path: str):
+    open_file = gzip.open if file_path.endswith('.gz') else open
+    with open_file(file_path, 'rt', encoding='utf-8') as jsonl_file:
+        return [json.loads(line) for line in jsonl_file]
+
+
+def test_normalized_variant_nodes(tmp_path):
+    nodes_path, edges_path = str(tmp_path / 'nodes.jsonl.gz'), str(tmp_path / 'edges.jsonl.gz')
+    normalizations = {'CAID:CA1': [{'id': 'CAID:CA1',
+                                    'name': 'rs1',
+                                    'hgvs': ['HGVS:NC_000001.11:g.100A>G'],
+                                    'equivalent_identifiers': ['DBSNP:rs1'],
+                                    'robokop_variant_id': 'ROBO_VARIANT:HG38|1|100|101|A|G',
+                                    'category': [node_types.SEQUENCE_VARIANT, node_types.NAMED_THING]}],
+                      'DBSNP:rs2': [{'id': 'CAID:CA2', 'name': 'rs2', 'hgvs': [], 'equivalent_identifiers': [],
+                                     'robokop_variant_id': None, 'category': [node_types.SEQUENCE_VARIANT]},
+                                    {'error_type': 'NotFound', 'error_message': 'not found'}]}
+    # a tiny buffer so every line is its own block
+    with KGXWriter(nodes_path, edges_path, buffer_size=1) as kgx_writer:
+        assert kgx_writer.write_normalized_variants(normalizations) == 2
+    assert kgx_writer.num_normalization_errors == 1
+    assert read_jsonl(nodes_path) == [{'id': 'CAID:CA1',
+                                       'name': 'rs1',
+                                       'category': [node_types.SEQUENCE_VARIANT, node_types.NAMED_THING],
+                                       'equivalent_identifiers': ['CAID:CA1', 'ROBO_VARIANT:HG38|1|100|101|A|G',
+                                                                  'DBSNP:rs1'],
+                                       'hgvs': ['HGVS:NC_000001.11:g.100A>G']},
+                                      {'id': 'CAID:CA2',
+                                       'name': 'rs2',
+                                       'category': [node_types.SEQUENCE_VARIANT],
+                                       'equivalent_identifiers': ['CAID:CA2']}]
+    assert read_jsonl(edges_path) == []
+
+
+def test_variant_to_gene_edges(tmp_path):
+    edge_batch = make_edge_batch()
+    expected_edges = [{'subject': 'CAID:CA1', 'predicate': VARIANT_TO_GENE_PREDICATE, 'object': 'ENSEMBL:ENSG1',
+                       'primary_knowledge_source': 'infores:ensembl', 'snpeff_effect': 'upstream_gene_variant',
+                       'distance': 50},
+                      {'subject': 'CAID:CA1', 'predicate': VARIANT_TO_GENE_PREDICATE, 'object': 'ENSEMBL:ENSG2',
+                       'primary_knowledge_source': 'infores:ensembl', 'snpeff_effect': 'downstream_gene_variant',
+                       'distance': 0},
+                      {'subject': 'CAID:CA3', 'predicate': VARIANT_TO_GENE_PREDICATE, 'object': 'ENSEMBL:ENSG2',
+                       'primary_knowledge_source': 'infores:ensembl', 'snpeff_effect': 'upstream_gene_variant',
+                       'distance': 25}]
+    expected_gene_nodes = [{'id': 'ENSEMBL:ENSG1', 'name': 'GENE1', 'category': [node_types.GENE]},
+                           {'id': 'ENSEMBL:ENSG2', 'name': 'GENE2', 'category': [node_types.GENE]}]
+
+    # the same results as an EdgeBatch, as objects, from the cache and as EdgeBatchResults
+    results_in_every_form = [edge_batch,
+                             {variant_id: list(variant_results) for variant_id, variant_results in edge_batch.items()},
+                             {variant_id: LazyServiceResults(encode_service_results(variant_results).encode('utf-8'))
+                              for variant_id, variant_results in edge_batch.items()},
+                             dict(edge_batch.items())]
+    for i, variant_to_gene_results in enumerate(results_in_every_form):
+        nodes_path, edges_path = str(tmp_path / f'nodes_{i}.jsonl'), str(tmp_path / f'edges_{i}.jsonl')
+        with KGXWriter(nodes_path, edges_path) as kgx_writer:
+            assert kgx_writer.write_variant_to_gene_results(variant_to_gene_results) == 3
+            # genes already written aren't written again
+            assert kgx_writer.write_variant_to_gene_results(variant_to_gene_results) == 3
+        assert read_jsonl(nodes_path) == expected_gene_nodes
+        assert read_jsonl(edges_path) == expected_edges + expected_edges
+
+
+def test_write_normalized_variants_in_chunks(clingen_url, tmp_path):
+    genetics_normalizer = GeneticsNormalizer(clingen_url=clingen_url)
+    genetics_normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+    nodes_path, edges_path = str(tmp_path / 'nodes.jsonl'), str(tmp_path / 'edges.jsonl')
+    variant_ids = (f'CAID:CA{i}' for i in range(1, 6))
+    with KGXWriter(nodes_path, edges_path) as kgx_writer:
+        assert genetics_normalizer.write_normalized_variants(variant_ids, kgx_writer, chunk_size=2) == 5
+    assert [node['id'] for node in read_jsonl(nodes_path)] == [f'CAID:CA{i}' for i in range(1, 6)]
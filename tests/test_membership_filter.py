@@ -0,0 +1,39 @@
+import pytest
+
+from robokop_genetics.membership_filter import BloomFilter
+
+
+def test_bloom_filter_membership():
+    bloom_filter = BloomFilter(capacity=10000, error_rate=0.01)
+    added_keys = [f'normalize-CAID:CA{i}' for i in range(10000)]
+    for key in added_keys:
+        bloom_filter.add(key)
+
+    # there are never false negatives
+    assert all(key in bloom_filter for key in added_keys)
+
+    # false positives should stay close to the configured rate at capacity
+    false_positives = sum(f'normalize-DBSNP:rs{i}' in bloom_filter for i in range(10000))
+    assert false_positives < 200
+
+
+def test_bloom_filter_bit_order():
+    # bits are ordered like redis SETBIT offsets, bit 0 is the most significant bit of the first byte
+    bloom_filter = BloomFilter(capacity=100, error_rate=0.1)
+    for position in bloom_filter.add('HGVS:NC_000011.10:g.68032291C>G'):
+        assert bloom_filter.bits[position // 8] & (1 << (7 - position % 8))
+
+
+def test_bloom_filter_save_and_load(tmp_path):
+    bloom_filter = BloomFilter(capacity=1000, error_rate=0.05)
+    bloom_filter.add('CAID:CA128085')
+    filter_path = str(tmp_path / 'membership.filter')
+    bloom_filter.save(filter_path)
+
+    loaded_filter = BloomFilter.load(filter_path)
+    assert loaded_filter.get_parameters() == bloom_filter.get_parameters()
+    assert 'CAID:CA128085' in loaded_filter
+    assert loaded_filter.bits == bloom_filter.bits
+
+    with pytest.raises(ValueError):
+        BloomFilter(error_rate=1.5)
@@ -0,0 +1,145 @@
+import math
+import os
+import socket
+
+import pytest
+
+import robokop_genetics.node_types as node_types
+from robokop_genetics.genetics_cache import GeneticsCache
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+from robokop_genetics.services.clingen import ClinGenService
+from robokop_genetics.metrics import MetricsRegistry, NullMetricsSink, get_metrics_sink, \
+    set_metrics_sink, CLINGEN_REQUESTS, CLINGEN_REQUEST_SECONDS, CLINGEN_REQUEST_RETRIES, CACHE_LOOKUPS, \
+    CACHE_PIPELINE_COMMANDS, NORMALIZATION_VARIANTS, NORMALIZATION_STAGE_SECONDS, SIZE_BUCKETS
+
+
+"""Check the metrics registry and Prometheus export, and the metrics recorded by ClinGen lookups and normalization
+"""
+
+
+def test_registry_and_prometheus_text():
+    registry = MetricsRegistry()
+    registry.increment(CLINGEN_REQUESTS, endpoint='batch_id', status=200, error_type='')
+    registry.increment(CLINGEN_REQUESTS, 2, endpoint='batch_id', status=200, error_type='')
+    registry.increment(CLINGEN_REQUESTS, endpoint='dbSNP.rs', status=404, error_type='NotFound')
+    registry.increment('custom_events_total', kind='a "quoted"\nvalue')
+    for value in (0.0005, 0.001, 0.3, 100, 1000):
+        registry.observe(CLINGEN_REQUEST_SECONDS, value, endpoint='batch_id')
+    registry.observe(CACHE_PIPELINE_COMMANDS, 500, operation='get_normalization')
+
+    assert registry.get_counter(CLINGEN_REQUESTS, endpoint='batch_id', status='200', error_type='') == 3
+    assert registry.get_counter(CLINGEN_REQUESTS, endpoint='batch_id') == 0
+    assert registry.get_counter_total(CLINGEN_REQUESTS) == 4
+    assert registry.get_counter_total(CLINGEN_REQUESTS, status=404) == 1
+
+    latencies = registry.get_histogram(CLINGEN_REQUEST_SECONDS, endpoint='batch_id')
+    assert latencies.count == 5
+    assert latencies.sum == pytest.approx(1100.3015)
+    # bucket upper bounds are inclusive and the counts are cumulative
+    assert latencies.buckets[0.001] == 2
+    assert latencies.buckets[0.5] == 3
+    assert latencies.buckets[300] == 4
+    assert latencies.buckets[math.inf] == 5
+    assert registry.get_histogram(CLINGEN_REQUEST_SECONDS, endpoint='dbSNP.rs') is None
+    # size histograms use their own buckets
+    assert tuple(registry.get_histogram(CACHE_PIPELINE_COMMANDS, operation='get_normalization').buckets) == \
+        SIZE_BUCKETS + (math.inf,)
+
+    prometheus_lines = registry.to_prometheus_text().splitlines()
+    assert f'# TYPE {CLINGEN_REQUESTS} counter' in prometheus_lines
+    assert f'{CLINGEN_REQUESTS}{{endpoint="batch_id",error_type="",status="200"}} 3' in prometheus_lines
+    assert f'{CLINGEN_REQUESTS}{{endpoint="dbSNP.rs",error_type="NotFound",status="404"}} 1' in prometheus_lines
+    assert 'custom_events_total{kind="a \\"quoted\\"\\nvalue"} 1' in prometheus_lines
+    assert f'# TYPE {CLINGEN_REQUEST_SECONDS} histogram' in prometheus_lines
+    assert f'{CLINGEN_REQUEST_SECONDS}_bucket{{endpoint="batch_id",le="0.001"}} 2' in prometheus_lines
+    assert f'{CLINGEN_REQUEST_SECONDS}_bucket{{endpoint="batch_id",le="+Inf"}} 5' in prometheus_lines
+    assert f'{CLINGEN_REQUEST_SECONDS}_count{{endpoint="batch_id"}} 5' in prometheus_lines
+    assert f'{CACHE_PIPELINE_COMMANDS}_sum{{operation="get_normalization"}} 500' in prometheus_lines
+    assert any(line.startswith(f'# HELP {CLINGEN_REQUESTS} ') for line in prometheus_lines)
+
+    registry.reset()
+    assert registry.to_prometheus_text() == ''
+
+
+def test_default_sink():
+    assert isinstance(get_metrics_sink(), NullMetricsSink)
+    registry = MetricsRegistry()
+    set_metrics_sink(registry)
+    try:
+        assert get_metrics_sink() is registry
+        other_registry = MetricsRegistry()
+        assert get_metrics_sink(other_registry) is other_registry
+        with get_metrics_sink().timer(NORMALIZATION_STAGE_SECONDS, stage='total'):
+            pass
+        assert registry.get_histogram(NORMALIZATION_STAGE_SECONDS, stage='total').count == 1
+    finally:
+        set_metrics_sink(None)
+    assert isinstance(get_metrics_sink(), NullMetricsSink)
+
+
+def test_clingen_request_metrics(clingen_url):
+    registry = MetricsRegistry()
+    clingen_service = ClinGenService(metrics=registry)
+    clingen_service.url = clingen_url
+
+    batch_results = clingen_service.get_batch_of_synonyms(['CAID:CA1', 'CAID:CA2'])
+    assert [batch_result.id for batch_result in batch_results] == ['CAID:CA1', 'CAID:CA2']
+    assert clingen_service.get_synonyms_by_other_id('DBSNP:rs1')[0].success
+    assert clingen_service.get_synonyms_by_other_id('DBSNP:rs2')[0].error_type == 'IncorrectRequest'
+    assert registry.get_counter(CLINGEN_REQUESTS, endpoint='batch_id', status=200, error_type='') == 1
+    assert registry.get_counter(CLINGEN_REQUESTS, endpoint='dbSNP.rs', status=200, error_type='') == 1
+    assert registry.get_counter(CLINGEN_REQUESTS, endpoint='dbSNP.rs', status=400,
+                                error_type='IncorrectRequest') == 1
+    assert registry.get_histogram(CLINGEN_REQUEST_SECONDS, endpoint='dbSNP.rs').count == 2
+
+    # nothing listening, every attempt fails
+    with socket.socket() as unused_socket:
+        unused_socket.bind(('127.0.0.1', 0))
+        clingen_service.url = f'http://127.0.0.1:{unused_socket.getsockname()[1]}/'
+    query_response = clingen_service.query_service(f'{clingen_service.url}alleles?dbSNP.rs=1')
+    assert query_response.error_type == 'RequestException'
+    assert registry.get_counter(CLINGEN_REQUESTS, endpoint='lookup', status='none',
+                                error_type='RequestException') == 3
+    assert registry.get_counter(CLINGEN_REQUEST_RETRIES, endpoint='lookup') == 2
+    assert registry.get_histogram(CLINGEN_REQUEST_SECONDS, endpoint='lookup').count == 3
+
+
+def test_normalization_metrics(clingen_url):
+    registry = MetricsRegistry()
+    genetics_normalizer = GeneticsNormalizer(metrics=registry, clingen_url=clingen_url)
+    genetics_normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+
+    normalizations = genetics_normalizer.normalize_variants(['CAID:CA1', 'CAID:CA2', 'CAID:CA3', 'DBSNP:rs1'])
+    assert normalizations['CAID:CA2'][0]['id'] == 'CAID:CA2'
+    assert normalizations['DBSNP:rs1'][0]['name'] == 'rs1'
+    assert registry.get_counter(NORMALIZATION_VARIANTS, stage='requested') == 4
+    assert registry.get_counter(NORMALIZATION_VARIANTS, stage='clingen_batch') == 3
+    assert registry.get_counter(NORMALIZATION_VARIANTS, stage='clingen_single') == 1
+    assert registry.get_histogram(NORMALIZATION_STAGE_SECONDS, stage='total').count == 1
+    assert registry.get_histogram(NORMALIZATION_STAGE_SECONDS, stage='clingen_batch').count == 1
+    # no HGVS variants, so no empty batch was timed
+    assert registry.get_counter_total(CLINGEN_REQUESTS) == 2
+
+
+@pytest.mark.skipif('ROBO_GENETICS_CACHE_HOST' not in os.environ, reason='Cache environment variables not set.')
+def test_cache_metrics(clingen_url):
+    testing_prefix = 'robo-testing-metrics-'
+    registry = MetricsRegistry()
+    genetics_cache = GeneticsCache(prefix=testing_prefix, membership_filter='local', metrics=registry)
+    genetics_cache.delete_all_keys_with_prefix(testing_prefix)
+    genetics_normalizer = GeneticsNormalizer(cache=genetics_cache, cache_write_behind=True, metrics=registry,
+                                             clingen_url=clingen_url)
+    genetics_normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+
+    genetics_normalizer.normalize_variants(['CAID:CA1', 'CAID:CA2'])
+    # nothing was cached yet, so the membership filter answers without asking redis
+    assert registry.get_counter(CACHE_LOOKUPS, cache='normalization', result='filtered') == 2
+    genetics_normalizer.normalize_variants(['CAID:CA1', 'CAID:CA2', 'CAID:CA3'])
+    assert registry.get_counter(CACHE_LOOKUPS, cache='normalization', result='hit') == 2
+    assert registry.get_counter(CACHE_LOOKUPS, cache='normalization', result='filtered') == 3
+    assert registry.get_counter(NORMALIZATION_VARIANTS, stage='cache_lookup') == 2
+    assert registry.get_counter(NORMALIZATION_VARIANTS, stage='clingen_batch') == 3
+    assert registry.get_histogram(CACHE_PIPELINE_COMMANDS, operation='get_normalization').sum == 2
+    assert registry.get_histogram(NORMALIZATION_STAGE_SECONDS, stage='cache_flush').count == 2
+    genetics_normalizer.close()
+    genetics_cache.delete_all_keys_with_prefix(testing_prefix)
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+import robokop_genetics.node_types as node_types
+from robokop_genetics.genetics_cache import GeneticsCache
+from robokop_genetics.genetics_normalization import GeneticsNormalizer, PIPELINE_MAX_CHUNKS_AHEAD
+from robokop_genetics.metrics import MetricsRegistry, NORMALIZATION_VARIANTS
+
+TESTING_PREFIX = 'robo-testing-pipelined-'
+
+
+"""Check that pipelined normalization gives the same results as running the stages one after another, and overlaps them
+"""
+
+
+def make_normalizer(clingen_url: str, **kwargs):
+    normalizer = GeneticsNormalizer(clingen_url=clingen_url, **kwargs)
+    normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+    return normalizer
+
+
+def get_normalized_ids(normalization_results: dict):
+    return {curie: [normalization.get('id') for normalization in normalizations]
+            for curie, normalizations in normalization_results.items()}
+
+
+def test_pipelined_normalization(redis_stand_in, clingen_url):
+    variant_ids = [f'CAID:CA{i}' for i in range(10)] + \
+                  ['HGVS:NC_000011.10:g.68032291C>G', 'HGVS:NC_000023.9:g.32389644G>A'] + \
+                  ['DBSNP:rs1', 'DBSNP:rs2', 'DBSNP:rs3', 'BOGUS:1']
+
+    # the stand-in names alleles by their place in a batch, so only the ids are the same for different chunk sizes
+    expected_ids = get_normalized_ids(make_normalizer(clingen_url).normalize_variants(variant_ids))
+    results = make_normalizer(clingen_url, pipelined=True, pipeline_chunk_size=3,
+                              pipeline_single_lookup_workers=2).normalize_variants(variant_ids)
+    assert get_normalized_ids(results) == expected_ids
+    assert results['DBSNP:rs1'][0]['id'] == 'CAID:CA1'
+    assert 'error_type' in results['DBSNP:rs2'][0]
+
+    # with a cache, results are written as they arrive and read back by the next run
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+    metrics = MetricsRegistry()
+    normalizer = make_normalizer(clingen_url, cache=cache, metrics=metrics, pipelined=True, pipeline_chunk_size=4)
+    results = normalizer.normalize_variants(variant_ids)
+    assert get_normalized_ids(results) == expected_ids
+    assert cache.get_batch_normalization(variant_ids) == results
+    assert metrics.get_counter_total(NORMALIZATION_VARIANTS, stage='cache_lookup') == 0
+    assert normalizer.normalize_variants(variant_ids) == results
+    assert metrics.get_counter_total(NORMALIZATION_VARIANTS, stage='cache_lookup') == len(variant_ids)
+    assert metrics.get_counter_total(NORMALIZATION_VARIANTS, stage='clingen_batch') == 12
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+
+
+class SlowClinGenNormalizer(GeneticsNormalizer):
+
+    stage_seconds = 0.3
+
+    def get_batch_sequence_variant_normalization(self, curies: list):
+        time.sleep(self.stage_seconds)
+        return super().get_batch_sequence_variant_normalization(curies)
+
+    def get_sequence_variant_normalization(self, variant_curie: str):
+        time.sleep(self.stage_seconds)
+        return super().get_sequence_variant_normalization(variant_curie)
+
+
+def test_pipelined_stages_overlap(clingen_url):
+    # a CAID batch, an HGVS batch and two single lookups
+    variant_ids = ['CAID:CA1', 'HGVS:NC_000011.10:g.68032291C>G', 'DBSNP:rs1', 'DBSNP:rs2']
+    normalizer = SlowClinGenNormalizer(clingen_url=clingen_url, pipelined=True)
+    normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+    start_time = time.monotonic()
+    assert set(normalizer.normalize_variants(variant_ids)) == set(variant_ids)
+    # the stages take 4 x 0.3s one after another
+    assert time.monotonic() - start_time < 3 * SlowClinGenNormalizer.stage_seconds
+
+
+class FailingClinGenNormalizer(GeneticsNormalizer):
+
+    def get_batch_sequence_variant_normalization(self, curies: list):
+        time.sleep(0.3)
+        raise RuntimeError('ClinGen is down')
+
+
+def test_pipelined_stage_failure(redis_stand_in, clingen_url):
+    # while the first stage fails, the lookup thread looks up every chunk, fills the queue and waits to say it's done
+    num_chunks = 2 * PIPELINE_MAX_CHUNKS_AHEAD + 1
+    normalizer = FailingClinGenNormalizer(clingen_url=clingen_url, pipelined=True, pipeline_chunk_size=1)
+    normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+    with pytest.raises(RuntimeError):
+        normalizer.normalize_variants([f'CAID:CA{i}' for i in range(num_chunks)])
+    # the lookup thread gives up instead of waiting forever for room in the queue
+    deadline = time.monotonic() + 2
+    while any(thread.name == 'normalization-cache-lookup' for thread in threading.enumerate()):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+    # cache leases need every stage to run on the leased variants, so they can't be pipelined
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+    with pytest.raises(ValueError):
+        GeneticsNormalizer(cache=cache, cache_lease_seconds=30, pipelined=True)
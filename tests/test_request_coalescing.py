@@ -0,0 +1,139 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from robokop_genetics.genetics_cache import GeneticsCache
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+
+TESTING_PREFIX = 'robo-testing-coalescing-'
+
+
+class SlowCountingNormalizer(GeneticsNormalizer):
+    """A GeneticsNormalizer that fakes clingen batches, counting how many times each curie is requested."""
+
+    def __init__(self, request_counter=None, batch_seconds: float = 0.3, **kwargs):
+        super().__init__(**kwargs)
+        self.requested_curies = []
+        self.request_counter = request_counter
+        self.batch_seconds = batch_seconds
+
+    def get_batch_sequence_variant_normalization(self, curies: list):
+        if curies:
+            time.sleep(self.batch_seconds)
+        self.requested_curies.extend(curies)
+        if self.request_counter:
+            self.request_counter(curies)
+        return {curie: [{'id': curie, 'name': curie.split(':')[1]}] for curie in curies}
+
+
+def test_single_flight_normalization():
+    normalizer = SlowCountingNormalizer(use_cache=False)
+    requests = [[f'CAID:CA{i}' for i in range(0, 10)],
+                [f'CAID:CA{i}' for i in range(5, 15)],
+                [f'CAID:CA{i}' for i in range(0, 15)],
+                ['CAID:CA3', 'CAID:CA3']]
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        normalization_maps = list(executor.map(normalizer.normalize_variants, requests))
+
+    # every request got all of its results, but each curie was only looked up once
+    for request, normalization_map in zip(requests, normalization_maps):
+        assert set(normalization_map.keys()) == set(request)
+        for curie in request:
+            assert normalization_map[curie][0]['id'] == curie
+    assert sorted(normalizer.requested_curies) == sorted(f'CAID:CA{i}' for i in range(15))
+
+
+def test_single_flight_failure():
+    normalizer = SlowCountingNormalizer(use_cache=False)
+
+    def failing_batch(curies: list):
+        time.sleep(0.3)
+        raise RuntimeError('clingen is down')
+    normalizer.get_batch_sequence_variant_normalization = failing_batch
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first_request = executor.submit(normalizer.normalize_variants, ['CAID:CA1', 'CAID:CA2'])
+        time.sleep(0.1)
+        second_request = executor.submit(normalizer.normalize_variants, ['CAID:CA2'])
+        with pytest.raises(RuntimeError):
+            first_request.result()
+        with pytest.raises(RuntimeError):
+            second_request.result()
+    assert not normalizer.in_flight_normalizations.in_flight
+
+
+def normalize_with_leases(redis_connection: dict, variant_ids: list):
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_connection)
+
+    def count_requests(curies: list):
+        pipeline = cache.redis.pipeline()
+        for curie in curies:
+            pipeline.incr(f'{TESTING_PREFIX}requests-{curie}')
+        pipeline.execute()
+
+    normalizer = SlowCountingNormalizer(request_counter=count_requests, cache=cache, cache_lease_seconds=10)
+    normalization_map = normalizer.normalize_variants(variant_ids)
+    return {curie: normalization[0]['id'] for curie, normalization in normalization_map.items()}
+
+
+def test_cache_leases_across_processes(redis_stand_in):
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+
+    requests = [[f'CAID:CA{i}' for i in range(0, 20)],
+                [f'CAID:CA{i}' for i in range(10, 30)],
+                [f'CAID:CA{i}' for i in range(0, 30)]]
+    with multiprocessing.get_context('spawn').Pool(len(requests)) as pool:
+        normalization_maps = pool.starmap(normalize_with_leases, [(redis_stand_in, request) for request in requests])
+
+    for request, normalization_map in zip(requests, normalization_maps):
+        assert normalization_map == {curie: curie for curie in request}
+
+    # every curie was requested from "clingen" by exactly one worker
+    request_counts = cache.redis.mget([f'{TESTING_PREFIX}requests-CAID:CA{i}' for i in range(30)])
+    assert request_counts == [b'1'] * 30
+    assert not list(cache.scan_keys_with_prefix(cache.NORMALIZATION_LEASE_KEY_PREFIX))
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+
+
+def test_expired_cache_leases_are_taken_over(redis_stand_in):
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+
+    # a worker that leased a variant and then died
+    dead_worker_cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+    assert dead_worker_cache.acquire_normalization_leases(['CAID:CA1'], lease_seconds=1) == ['CAID:CA1']
+    assert cache.acquire_normalization_leases(['CAID:CA1', 'CAID:CA2'], lease_seconds=1) == ['CAID:CA2']
+    cache.release_normalization_leases(['CAID:CA1', 'CAID:CA2'])
+
+    normalizer = SlowCountingNormalizer(cache=cache, cache_lease_seconds=10)
+    normalization_map = normalizer.normalize_variants(['CAID:CA1', 'CAID:CA2'])
+    assert normalization_map['CAID:CA1'][0]['id'] == 'CAID:CA1'
+    assert sorted(normalizer.requested_curies) == ['CAID:CA1', 'CAID:CA2']
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+
+
+def test_cache_leases_are_renewed(redis_stand_in):
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+    other_worker_cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+
+    # the clingen batch takes several times longer than the lease, which is kept while it runs
+    normalizer = SlowCountingNormalizer(cache=cache, cache_lease_seconds=0.3, batch_seconds=1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        normalization = executor.submit(normalizer.normalize_variants, ['CAID:CA1', 'CAID:CA2'])
+        time.sleep(0.8)
+        assert other_worker_cache.acquire_normalization_leases(['CAID:CA1', 'CAID:CA2'], lease_seconds=1) == []
+        assert set(normalization.result()) == {'CAID:CA1', 'CAID:CA2'}
+    assert not list(cache.scan_keys_with_prefix(cache.NORMALIZATION_LEASE_KEY_PREFIX))
+
+    # only leases that are still ours are renewed
+    assert other_worker_cache.acquire_normalization_leases(['CAID:CA3'], lease_seconds=10) == ['CAID:CA3']
+    assert cache.acquire_normalization_leases(['CAID:CA4'], lease_seconds=10) == ['CAID:CA4']
+    assert cache.renew_normalization_leases(['CAID:CA3', 'CAID:CA4'], lease_seconds=20) == ['CAID:CA4']
+    assert cache.redis.pttl(f'{cache.NORMALIZATION_LEASE_KEY_PREFIX}CAID:CA3') <= 10_000
+    assert cache.redis.pttl(f'{cache.NORMALIZATION_LEASE_KEY_PREFIX}CAID:CA4') > 10_000
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
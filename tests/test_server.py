@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import robokop_genetics.node_types as node_types
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+from robokop_genetics.metrics import MetricsRegistry, CLINGEN_REQUESTS, SERVER_REQUESTS, SERVER_BATCH_REQUESTS
+from robokop_genetics.server import MicroBatcher, GeneticsServer
+
+
+"""Check that concurrent requests are merged into batches and that each caller gets its own results back
+"""
+
+
+def test_micro_batcher():
+    processed_batches = []
+
+    def process_batch(batch_key, items: dict):
+        processed_batches.append((batch_key, list(items)))
+        if batch_key == 'failing':
+            raise RuntimeError('clingen is down')
+        return {item_key: f'{batch_key}:{item_key}' for item_key in items if item_key != 'missing'}
+
+    batcher = MicroBatcher(process_batch, batch_window=0.3, max_batch_size=1000)
+    requests = [(dict.fromkeys(['a', 'b']), 'x'),
+                (dict.fromkeys(['b', 'c', 'missing']), 'x'),
+                (dict.fromkeys(['a']), 'y')]
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        results = list(executor.map(lambda request: batcher.submit(*request), requests))
+    assert results == [{'a': 'x:a', 'b': 'x:b'}, {'b': 'x:b', 'c': 'x:c'}, {'a': 'y:a'}]
+    # one batch for each batch key, with the distinct items
+    assert sorted(processed_batches) == [('x', ['a', 'b', 'c', 'missing']), ('y', ['a'])]
+
+    with pytest.raises(RuntimeError):
+        batcher.submit({'a': None}, 'failing')
+    batcher.close()
+    with pytest.raises(RuntimeError):
+        batcher.submit({'a': None})
+
+    # the size cap closes the window early
+    batcher = MicroBatcher(process_batch, batch_window=60, max_batch_size=2)
+    start_time = time.monotonic()
+    assert batcher.submit(dict.fromkeys(['a', 'b'])) == {'a': 'None:a', 'b': 'None:b'}
+    assert time.monotonic() - start_time < 30
+    batcher.close()
+
+
+def post_json(url: str, request_json):
+    request = urllib.request.Request(url, data=json.dumps(request_json).encode('utf-8'), method='POST')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+@pytest.fixture()
+def genetics_server(clingen_url):
+    registry = MetricsRegistry()
+    normalizer = GeneticsNormalizer(metrics=registry, clingen_url=clingen_url)
+    normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+    server = GeneticsServer(('127.0.0.1', 0), normalizer, batch_window=0.5, priority_max_variants=2,
+                            metrics=registry)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_normalization_server(genetics_server):
+    registry = genetics_server.metrics
+    requests = [[f'CAID:CA{i}' for i in range(0, 5)],
+                [f'CAID:CA{i}' for i in range(3, 8)],
+                [f'CAID:CA{i}' for i in range(6, 10)]]
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        responses = list(executor.map(lambda curies: post_json(genetics_server.url + 'normalize', {'curies': curies}),
+                                      requests))
+    for curies, response in zip(requests, responses):
+        assert list(response['results']) == curies
+        for curie in curies:
+            assert response['results'][curie][0]['id'] == curie
+    # the three requests were one clingen batch
+    assert registry.get_counter_total(CLINGEN_REQUESTS, endpoint='batch_id') == 1
+    assert registry.get_histogram(SERVER_BATCH_REQUESTS, endpoint='normalize', lane='bulk').sum == 3
+
+    # small requests take the priority lane
+    response = post_json(genetics_server.url + 'normalize', {'curies': ['DBSNP:rs1']})
+    assert response['results']['DBSNP:rs1'][0]['id'] == 'CAID:CA1'
+    assert registry.get_counter(SERVER_REQUESTS, endpoint='normalize', lane='priority', status_code='200') == 1
+
+    for bad_request in ({'curies': 'CAID:CA1'}, ['CAID:CA1']):
+        with pytest.raises(urllib.error.HTTPError) as http_error:
+            post_json(genetics_server.url + 'normalize', bad_request)
+        assert http_error.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as http_error:
+        post_json(genetics_server.url + 'variant_to_gene', {'variants': []})
+    assert http_error.value.code == 404
+
+    with urllib.request.urlopen(genetics_server.url + 'health') as response:
+        assert json.loads(response.read()) == {'status': 'ok'}
+    with urllib.request.urlopen(genetics_server.url + 'metrics') as response:
+        assert f'{SERVER_REQUESTS}{{endpoint="normalize",lane="bulk",status_code="200"}} 3' in \
+               response.read().decode('utf-8').split('\n')
+
+
+class VariantToGeneStandIn(object):
+    """Answers get_variant_to_gene with no genes, like GeneticsServices for variants far from any gene."""
+
+    def get_variant_to_gene(self, services: list, variant_nodes: list, **kwargs):
+        return {variant_node.id: [] for variant_node in variant_nodes}
+
+
+def test_malformed_variant_to_gene_requests(clingen_url):
+    normalizer = GeneticsNormalizer(clingen_url=clingen_url)
+    server = GeneticsServer(('127.0.0.1', 0), normalizer, genetics_services=VariantToGeneStandIn(), batch_window=0.1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    variants = [{'id': 'CAID:CA1', 'synonyms': ['ROBO_VARIANT:HG38|17|58206171|58206172|A|G']}]
+    for bad_parameters in ({'flanking_region_size': [1]}, {'flanking_region_size': True}, {'nearest_k': -1},
+                           {'nearest_k': '3'}, {'gene_biotypes': 'protein_coding'}, {'services': [['Ensembl']]}):
+        with pytest.raises(urllib.error.HTTPError) as http_error:
+            post_json(server.url + 'variant_to_gene', {'variants': variants, **bad_parameters})
+        assert http_error.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as http_error:
+        post_json(server.url + 'variant_to_gene', {'variants': [{'id': 'CAID:CA1', 'synonyms': [[1]]}]})
+    assert http_error.value.code == 400
+    # the lane still works after the bad requests
+    response = post_json(server.url + 'variant_to_gene', {'variants': variants, 'nearest_k': 3,
+                                                          'gene_biotypes': ['protein_coding']})
+    assert response == {'results': {'CAID:CA1': []}}
+    server.shutdown()
+    server.server_close()
+
+
+def test_micro_batcher_with_bad_batch_keys():
+    batcher = MicroBatcher(lambda batch_key, items: dict.fromkeys(items, batch_key), batch_window=0.1,
+                           max_concurrent_batches=1)
+    # an unhashable batch key fails the requests that were taken with it, not the dispatcher
+    with pytest.raises(TypeError):
+        batcher.submit({'a': None}, ['unhashable'])
+    assert batcher.submit({'a': None}, 'x') == {'a': 'x'}
+    batcher.close()
@@ -0,0 +1,123 @@
+import copy
+import dataclasses
+import pickle
+
+import pytest
+
+from robokop_genetics.simple_graph_components import SimpleNode, SimpleEdge, FrozenSimpleNode, GraphInterner
+
+
+def test_simple_node():
+    node = SimpleNode(id='CAID:CA1', type='biolink:SequenceVariant', name='')
+    assert node.synonyms == {'CAID:CA1'}
+    assert node.get_synonyms_by_prefix('CAID') == {'CAID:CA1'}
+    assert node.get_synonyms_by_prefix('ROBO_VARIANT') == set()
+    assert node.properties == {}
+
+    # prefixes are matched like Text.get_curie, upper case
+    node.add_synonyms({'ROBO_VARIANT:HG38|1|1|2|A|G', 'CAID:CA2', 'caid:CA3', 'NOPREFIX'})
+    assert node.synonyms == {'CAID:CA1', 'CAID:CA2', 'caid:CA3', 'NOPREFIX', 'ROBO_VARIANT:HG38|1|1|2|A|G'}
+    assert node.get_synonyms_by_prefix('CAID') == {'CAID:CA1', 'CAID:CA2', 'caid:CA3'}
+    assert node.get_synonyms_by_prefix('caid') == set()
+    assert node.get_synonyms_by_prefix(None) == {'NOPREFIX'}
+    # the returned sets are copies
+    node.get_synonyms_by_prefix('CAID').clear()
+    assert len(node.get_synonyms_by_prefix('CAID')) == 3
+
+    # synonyms is a plain set, changing it or replacing it is seen by get_synonyms_by_prefix
+    assert type(node.synonyms) is set
+    assert type(node.synonyms | {'DBSNP:rs1'}) is set
+    node.synonyms.discard('CAID:CA2')
+    assert node.get_synonyms_by_prefix('CAID') == {'CAID:CA1', 'caid:CA3'}
+    node.synonyms.add('DBSNP:rs1')
+    assert node.get_synonyms_by_prefix('DBSNP') == {'DBSNP:rs1'}
+    node.synonyms = {'CAID:CA4'}
+    assert node.get_synonyms_by_prefix('CAID') == {'CAID:CA4'}
+
+    # including changes that leave it the same size, after any number of lookups
+    node = SimpleNode(id='CAID:CA1', type='biolink:SequenceVariant', name='', synonyms={'CAID:CA1', 'DBSNP:rs1'})
+    for _ in range(6):
+        assert node.get_synonyms_by_prefix('DBSNP') == {'DBSNP:rs1'}
+    node.synonyms.discard('DBSNP:rs1')
+    node.synonyms.add('DBSNP:rs2')
+    assert node.get_synonyms_by_prefix('DBSNP') == {'DBSNP:rs2'}
+
+    gene_node = SimpleNode(id='ENSEMBL:ENSG1', type='biolink:Gene', name='GENE1')
+    assert gene_node == SimpleNode('ENSEMBL:ENSG1', 'biolink:Gene', 'GENE1', properties={}, synonyms=set())
+    assert gene_node != SimpleNode('ENSEMBL:ENSG1', 'biolink:Gene', 'GENE1', synonyms={'HGNC:1'})
+    assert repr(gene_node) == "SimpleNode(id='ENSEMBL:ENSG1', type='biolink:Gene', name='GENE1', properties={}, " \
+                              "synonyms={'ENSEMBL:ENSG1'})"
+    assert pickle.loads(pickle.dumps(node)) == node
+    assert copy.deepcopy(node) == node
+    assert not hasattr(node, '__dict__')
+
+
+def test_dataclass_api():
+    node = SimpleNode(id='CAID:CA1', type='biolink:SequenceVariant', name='', synonyms={'CAID:CA1', 'DBSNP:rs1'})
+    assert dataclasses.is_dataclass(node)
+    assert [node_field.name for node_field in dataclasses.fields(node)] == \
+           ['id', 'type', 'name', 'properties', 'synonyms']
+    assert dataclasses.asdict(node) == {'id': 'CAID:CA1', 'type': 'biolink:SequenceVariant', 'name': '',
+                                        'properties': {}, 'synonyms': {'CAID:CA1', 'DBSNP:rs1'}}
+    renamed_node = dataclasses.replace(node, name='rs1')
+    assert renamed_node.name == 'rs1' and renamed_node.synonyms == node.synonyms
+    assert renamed_node.get_synonyms_by_prefix('DBSNP') == {'DBSNP:rs1'}
+
+    edge = SimpleEdge('a', 'b', 'c', 'd', 'e', 'f', 1, properties={'distance': 10})
+    assert dataclasses.asdict(edge) == {'source_id': 'a', 'target_id': 'b', 'provided_by': 'c', 'input_id': 'd',
+                                        'predicate_id': 'e', 'predicate_label': 'f', 'ctime': 1,
+                                        'properties': {'distance': 10}}
+    assert dataclasses.replace(edge, ctime=2) == SimpleEdge('a', 'b', 'c', 'd', 'e', 'f', 2, {'distance': 10})
+
+
+def test_simple_edge():
+    edge = SimpleEdge(source_id='CAID:CA1',
+                      target_id='ENSEMBL:ENSG1',
+                      provided_by='ensembl.sequence_variant_to_gene',
+                      input_id='ROBO_VARIANT:HG38|1|1|2|A|G',
+                      predicate_id='GAMMA:0000102',
+                      predicate_label='is_nearby_variant_of',
+                      ctime=1,
+                      properties={'distance': 10})
+    assert edge == pickle.loads(pickle.dumps(edge))
+    assert SimpleEdge('a', 'b', 'c', 'd', 'e', 'f', 1).properties == {}
+    assert repr(edge).startswith("SimpleEdge(source_id='CAID:CA1', target_id='ENSEMBL:ENSG1'")
+    assert edge != SimpleEdge('a', 'b', 'c', 'd', 'e', 'f', 1)
+    assert not hasattr(edge, '__dict__')
+
+
+def test_frozen_nodes_and_interner():
+    interner = GraphInterner()
+    gene_node = interner.get_node('ENSEMBL:ENSG1', 'biolink:Gene', 'GENE1')
+    assert interner.get_node(''.join(['ENSEMBL:', 'ENSG1']), 'biolink:Gene', 'GENE1') is gene_node
+    assert interner.intern(''.join(['ENSEMBL:', 'ENSG1'])) is gene_node.id
+    assert isinstance(gene_node, FrozenSimpleNode)
+    assert gene_node == SimpleNode(id='ENSEMBL:ENSG1', type='biolink:Gene', name='GENE1')
+    assert gene_node.synonyms == {'ENSEMBL:ENSG1'}
+    assert gene_node.get_synonyms_by_prefix('ENSEMBL') == {'ENSEMBL:ENSG1'}
+    assert gene_node.properties == {}
+    assert {gene_node: 1}[interner.get_node('ENSEMBL:ENSG1', 'biolink:Gene', 'GENE1')] == 1
+
+    # shared nodes can't be changed, a mutable copy can
+    with pytest.raises(AttributeError):
+        gene_node.name = 'CHANGED'
+    with pytest.raises(AttributeError):
+        gene_node.add_synonyms({'HGNC:1'})
+    with pytest.raises(TypeError):
+        gene_node.properties['distance'] = 1
+    mutable_gene_node = gene_node.mutable_copy()
+    mutable_gene_node.add_synonyms({'HGNC:1'})
+    assert mutable_gene_node.synonyms == {'ENSEMBL:ENSG1', 'HGNC:1'}
+    assert pickle.loads(pickle.dumps(gene_node)) == gene_node
+    assert dataclasses.asdict(gene_node) == dataclasses.asdict(SimpleNode('ENSEMBL:ENSG1', 'biolink:Gene', 'GENE1'))
+    assert dataclasses.replace(gene_node, name='RENAMED').name == 'RENAMED'
+
+    # a different name for the same id replaces the shared node
+    renamed_gene_node = interner.get_node('ENSEMBL:ENSG1', 'biolink:Gene', 'RENAMED')
+    assert renamed_gene_node.name == 'RENAMED' and gene_node.name == 'GENE1'
+
+    string_interner = GraphInterner(share_nodes=False)
+    first_node = string_interner.get_node('ENSEMBL:ENSG1', 'biolink:Gene', 'GENE1')
+    second_node = string_interner.get_node(''.join(['ENSEMBL:', 'ENSG1']), 'biolink:Gene', 'GENE1')
+    assert first_node is not second_node and first_node.id is second_node.id
+    second_node.add_synonyms({'HGNC:1'})
@@ -0,0 +1,100 @@
+import os
+import time
+
+import pytest
+
+import robokop_genetics.node_types as node_types
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+from robokop_genetics.tracing import Tracer, NULL_SPAN, TRACING_ENV_VARIABLE, span, record_span, get_tracer
+
+
+"""Check traced runs, their summaries and slow call logging, profile sampling, and the spans recorded by normalization
+"""
+
+
+def test_tracing_off(monkeypatch):
+    monkeypatch.delenv(TRACING_ENV_VARIABLE, raising=False)
+    tracer = Tracer()
+    assert not tracer.enabled
+    assert tracer.trace_run('normalize_variants') is NULL_SPAN
+    # outside of a traced run spans do nothing
+    with span('redis_pipeline', commands=10) as redis_span:
+        redis_span.set(operation='get_normalization')
+    assert redis_span is NULL_SPAN
+    record_span('worker', 1.0)
+    assert tracer.last_run is None
+    assert tracer.profile('normalize_variants') is NULL_SPAN
+
+    monkeypatch.setenv(TRACING_ENV_VARIABLE, '1')
+    assert Tracer().enabled
+    assert get_tracer(False).enabled is False
+
+
+def test_traced_run():
+    tracer = Tracer(enabled=True, slow_thresholds={'slow_stage': 0.01}, max_spans_per_run=3)
+    with tracer.trace_run('run', variants=5) as root_span:
+        for i in range(3):
+            with span('stage', variants=2):
+                with span('redis_pipeline', operation='get', commands=10):
+                    pass
+        with span('slow_stage'):
+            time.sleep(0.02)
+        record_span('worker', 0.5, edges=7)
+        # a run started inside another run is part of it
+        with tracer.trace_run('nested'):
+            pass
+        with pytest.raises(KeyError):
+            with span('failing'):
+                raise KeyError('x')
+
+    trace_run = tracer.last_run
+    assert trace_run.root_span is root_span
+    assert root_span.duration >= 0.02
+    summaries = {summary.path: summary for summary in trace_run.get_summary()}
+    assert summaries['run'].count == 1
+    assert summaries['run'].sizes == {'variants': 5}
+    assert summaries['run/stage'].count == 3
+    assert summaries['run/stage'].sizes == {'variants': 6}
+    assert summaries['run/stage/redis_pipeline'].sizes == {'commands': 30}
+    assert summaries['run/worker'].seconds == 0.5
+    assert summaries['run/nested'].count == 1
+    assert [slow_span.path for slow_span in trace_run.slow_spans] == ['run/slow_stage']
+    assert trace_run.num_spans == 10
+    # only the first spans are kept, everything is in the summary
+    assert len(root_span.children) == 2
+    assert len(root_span.children[0].children) == 1
+    assert summaries['run/failing'].count == 1
+    assert 'run/stage/redis_pipeline: 3 calls' in trace_run.format_summary()
+
+    # the run is over
+    assert span('stage') is NULL_SPAN
+
+
+def test_profile_sampling(tmp_path):
+    tracer = Tracer(enabled=False, profile_sample_rate=1, profile_dir=str(tmp_path))
+    with tracer.profile('normalize_variants'):
+        sum(range(1000))
+    assert os.path.dirname(tracer.last_profile_path) == str(tmp_path)
+    assert os.path.getsize(tracer.last_profile_path) > 0
+    assert Tracer(enabled=False, profile_sample_rate=0).profile('normalize_variants') is NULL_SPAN
+
+
+def test_normalization_spans(clingen_url):
+    genetics_normalizer = GeneticsNormalizer(tracing=True, clingen_url=clingen_url)
+    genetics_normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+    genetics_normalizer.normalize_variants(['CAID:CA1', 'CAID:CA2', 'DBSNP:rs1'])
+
+    summaries = {summary.path: summary for summary in genetics_normalizer.tracer.last_run.get_summary()}
+    assert summaries['normalize_variants'].sizes == {'variants': 3}
+    assert summaries['normalize_variants/clingen_batch'].sizes == {'variants': 2}
+    clingen_http_summary = summaries['normalize_variants/clingen_batch/clingen_http']
+    assert clingen_http_summary.count == 1
+    assert clingen_http_summary.sizes['request_bytes'] == len('CA1\nCA2')
+    assert summaries['normalize_variants/clingen_batch/clingen_http/json_decode'].count == 1
+    assert summaries['normalize_variants/clingen_batch/parse_result'].sizes == {'alleles': 2}
+    assert summaries['normalize_variants/clingen_single/clingen_http'].count == 1
+    assert summaries['normalize_variants/clingen_single/parse_result'].sizes == {'alleles': 1}
+
+    # the process wide tracer is off unless the environment variable is set
+    if TRACING_ENV_VARIABLE not in os.environ:
+        assert GeneticsNormalizer().tracer.trace_run('normalize_variants') is NULL_SPAN
@@ -0,0 +1,31 @@
+import pytest
+
+from robokop_genetics.services.clingen import ClinGenService
+from robokop_genetics.variant_keys import RobokopVariant, parse_robokop_variant_id, format_robokop_variant_id
+
+
+"""Check parsing and formatting robokop variant keys
+"""
+
+
+def test_parse_robokop_variant_id():
+    robokop_variant = parse_robokop_variant_id('ROBO_VARIANT:HG38|17|58206171|58206172|A|G')
+    assert robokop_variant == RobokopVariant('HG38', '17', 58206171, 58206172, 'A', 'G')
+    assert format_robokop_variant_id(robokop_variant) == 'ROBO_VARIANT:HG38|17|58206171|58206172|A|G'
+    assert parse_robokop_variant_id('HG19|X|10|10||T').reference_allele == ''
+    for bad_key in ('ROBO_VARIANT:HG38|17|58206171', 'ROBO_VARIANT:HG38|17|start|58206172|A|G'):
+        with pytest.raises(ValueError):
+            parse_robokop_variant_id(bad_key)
+
+
+def test_clingen_robokop_variant():
+    clingen = ClinGenService()
+    allele_json = {'@id': 'http://reg.genome.network/allele/CA1',
+                   'genomicAlleles': [{'hgvs': ['NC_000017.11:g.58206171A>G'],
+                                       'referenceGenome': 'GRCh38',
+                                       'chromosome': '17',
+                                       'coordinates': [{'allele': 'G', 'referenceAllele': 'A',
+                                                        'start': 58206171, 'end': 58206172}]}]}
+    synonymization_result = clingen.parse_result(allele_json)
+    assert synonymization_result.robokop_variant_id == 'ROBO_VARIANT:HG38|17|58206171|58206172|A|G'
+    assert synonymization_result.robokop_variant.alternate_allele == 'G'
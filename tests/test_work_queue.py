@@ -0,0 +1,128 @@
+import multiprocessing
+import time
+
+import robokop_genetics.node_types as node_types
+from robokop_genetics.genetics_cache import GeneticsCache
+from robokop_genetics.genetics_normalization import GeneticsNormalizer
+from robokop_genetics.work_queue import NormalizationWorkQueue, NormalizationWorker
+
+TESTING_PREFIX = 'robo-testing-work-queue-'
+
+
+"""Check that a work queue in redis is normalized by several workers, with expired leases reclaimed
+"""
+
+
+def make_worker(redis_connection: dict, clingen_url: str, job_id: str, cache_write_behind: bool = False,
+                **queue_parameters):
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_connection)
+    normalizer = GeneticsNormalizer(cache=cache, cache_write_behind=cache_write_behind, clingen_url=clingen_url)
+    normalizer.sequence_variant_node_types = [node_types.NAMED_THING, node_types.SEQUENCE_VARIANT]
+    return NormalizationWorker(NormalizationWorkQueue(cache, job_id, **queue_parameters), normalizer)
+
+
+def run_worker(redis_connection: dict, clingen_url: str):
+    return make_worker(redis_connection, clingen_url, 'processes').run(poll_interval=0.1)
+
+
+def test_work_queue_across_processes(redis_stand_in, clingen_url):
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+    work_queue = NormalizationWorkQueue(cache, 'processes')
+    variant_ids = [f'CAID:CA{i}' for i in range(100)]
+    assert work_queue.enqueue(iter(variant_ids), chunk_size=10) == 10
+
+    with multiprocessing.get_context('spawn').Pool(3) as pool:
+        chunks_per_worker = pool.starmap(run_worker, [(redis_stand_in, clingen_url)] * 3)
+    assert sum(chunks_per_worker) == 10
+
+    progress = work_queue.get_progress()
+    assert progress.finished
+    assert (progress.num_chunks, progress.chunks_done, progress.num_variants, progress.variants_done) == \
+           (10, 10, 100, 100)
+    # the results are in the cache
+    cached_normalizations = cache.get_batch_normalization(variant_ids)
+    assert {curie: normalizations[0]['id'] for curie, normalizations in cached_normalizations.items()} == \
+           {curie: curie for curie in variant_ids}
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+
+
+def test_expired_leases_are_reclaimed(redis_stand_in, clingen_url):
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+    NormalizationWorkQueue(cache, 'leases').enqueue([f'CAID:CA{i}' for i in range(6)], chunk_size=2)
+
+    # a worker that claimed a chunk and then died
+    dead_worker = make_worker(redis_stand_in, clingen_url, 'leases', lease_seconds=0.5)
+    dead_chunk = dead_worker.work_queue.claim_chunk()
+    assert dead_chunk.variant_ids == ['CAID:CA0', 'CAID:CA1']
+
+    worker = make_worker(redis_stand_in, clingen_url, 'leases', lease_seconds=0.5)
+    start_time = time.monotonic()
+    assert worker.run(poll_interval=0.1) == 3
+    assert time.monotonic() - start_time >= 0.4
+    assert worker.work_queue.get_progress().chunks_done == 3
+    # the chunk was taken over, the dead worker can't acknowledge it anymore
+    assert not dead_worker.work_queue.acknowledge(dead_chunk)
+    assert worker.work_queue.get_progress().variants_done == 6
+
+    # a chunk that keeps failing is set aside
+    failing_worker = make_worker(redis_stand_in, clingen_url, 'failing', max_attempts=2)
+    failing_worker.work_queue.enqueue(['CAID:CA1', 'CAID:CA2'])
+
+    def failing_normalization(variant_ids: list):
+        raise RuntimeError('clingen is down')
+    failing_worker.normalizer.normalize_variants = failing_normalization
+    assert failing_worker.run(poll_interval=0.1) == 0
+    progress = failing_worker.work_queue.get_progress()
+    assert progress.finished
+    assert (progress.chunks_failed, progress.chunks_done) == (1, 0)
+    assert failing_worker.work_queue.get_failed_variant_ids() == ['CAID:CA1', 'CAID:CA2']
+    failing_worker.work_queue.delete()
+    assert not list(cache.scan_keys_with_prefix(f'{TESTING_PREFIX}work-failing-'))
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+
+
+def test_chunks_are_not_acknowledged_without_cached_results(redis_stand_in, clingen_url):
+    worker = make_worker(redis_stand_in, clingen_url, 'cache-down', cache_write_behind=True)
+    worker.work_queue.delete()
+    worker.work_queue.enqueue(['CAID:CA1', 'CAID:CA2'])
+    cache = worker.normalizer.cache
+
+    def failing_write(normalization_map: dict):
+        raise ConnectionError('redis is down')
+    cache.set_batch_normalization = failing_write
+    # the results never reached the cache, so the chunk is released for another attempt
+    assert not worker.process_chunk(worker.work_queue.claim_chunk())
+    assert worker.work_queue.get_progress().chunks_done == 0
+
+    del cache.set_batch_normalization
+    with worker.normalizer:
+        assert worker.run(poll_interval=0.1) == 1
+    assert not worker.normalizer.cache_writer.thread.is_alive()
+    assert set(cache.get_batch_normalization(['CAID:CA1', 'CAID:CA2'])) == {'CAID:CA1', 'CAID:CA2'}
+    worker.work_queue.delete()
+    cache.delete_all_keys_with_prefix(TESTING_PREFIX)
+
+
+def test_workers_sharing_a_cache(redis_stand_in, clingen_url):
+    # two workers in one process, sharing one cache
+    cache = GeneticsCache(use_default_credentials=False, prefix=TESTING_PREFIX, **redis_stand_in)
+    normalizer = GeneticsNormalizer(cache=cache, clingen_url=clingen_url)
+    stalled_worker = NormalizationWorker(NormalizationWorkQueue(cache, 'shared', lease_seconds=0.3), normalizer)
+    worker = NormalizationWorker(NormalizationWorkQueue(cache, 'shared', lease_seconds=0.3), normalizer)
+    worker.work_queue.delete()
+    worker.work_queue.enqueue(['CAID:CA1', 'CAID:CA2'])
+
+    stalled_chunk = stalled_worker.work_queue.claim_chunk()
+    time.sleep(0.5)
+    work_chunk = worker.work_queue.claim_chunk()
+    assert work_chunk.chunk_id == stalled_chunk.chunk_id and work_chunk.attempt == 2
+    # the stalled worker's lease was taken over, even though it uses the same cache
+    assert not stalled_worker.work_queue.renew_lease(stalled_chunk)
+    assert not stalled_worker.work_queue.release(stalled_chunk)
+    assert not stalled_worker.work_queue.acknowledge(stalled_chunk)
+    assert worker.work_queue.renew_lease(work_chunk)
+    assert worker.work_queue.acknowledge(work_chunk)
+    assert worker.work_queue.get_progress().chunks_done == 1
+    worker.work_queue.delete()